@@ -13,4 +13,15 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'analoguebailout.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# imported once django is set up
+from backendservice.streams import EVENTS_PATH, transaction_events  # noqa: E402
+
+
+async def application(scope, receive, send):
+    # event streams are served outside django, its asgi handler iterates streaming responses
+    # synchronously and would block the event loop for as long as a stream is open
+    if scope["type"] == "http" and scope["path"] == EVENTS_PATH:
+        return await transaction_events(scope, receive, send)
+    return await django_application(scope, receive, send)
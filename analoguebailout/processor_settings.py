@@ -0,0 +1,21 @@
+"""
+Settings of the transaction processors.
+
+The web settings without the apps only the web service uses, the processors
+never serve the admin, sessions or the API documentation and skip loading them
+at startup.
+"""
+
+from analoguebailout.settings import *  # noqa: F401,F403
+from analoguebailout.settings import INSTALLED_APPS
+
+# drf_yasg alone imports pkg_resources, a good part of the processor startup
+WEB_ONLY_APPS = [
+    'django.contrib.admin',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+    "drf_yasg",
+]
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in WEB_ONLY_APPS]
@@ -0,0 +1,89 @@
+import os
+import hashlib
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.cache import patch_cache_control
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_GET
+from rest_framework import permissions
+from drf_yasg.views import get_schema_view
+from drf_yasg.codecs import OpenAPICodecJson
+from drf_yasg import openapi
+
+
+api_info = openapi.Info(
+    title="Analogue Bailout API",
+    default_version='v1',
+    description="Analogue Bailout description",
+    terms_of_service="https://www.analogue-bailout.com/policies/terms/",
+    contact=openapi.Contact(email="contact@analogue-bailout.local"),
+    license=openapi.License(name="Analogue Bailout License"),
+)
+
+schema_view = get_schema_view(
+    api_info,
+    public=True,
+    permission_classes=(permissions.AllowAny,),
+)
+
+
+def generate_schema():
+    '''
+        - introspects every view and serializer, the expensive part the schema file saves
+        - no request is involved, the documentation pages use the host they are served from
+        :return: the OpenAPI document as json bytes
+    '''
+    generator = schema_view.generator_class(info=api_info)
+    schema = generator.get_schema(request=None, public=True)
+    return OpenAPICodecJson(validators=[]).encode(schema)
+
+
+def write_schema(path, schema):
+    # write to a temporary file first so a web worker never reads a torn schema
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, "wb") as schema_file:
+        schema_file.write(schema)
+    os.replace(tmp_path, path)
+
+
+# (modification time, body, etag) of the schema file last read
+_loaded = None
+
+
+def load_schema(path):
+    '''
+        :return: the body and etag of the schema file, read again only when the file changed
+    '''
+    global _loaded
+    modified = os.stat(path).st_mtime_ns
+    if _loaded is None or _loaded[0] != modified:
+        with open(path, "rb") as schema_file:
+            body = schema_file.read()
+        _loaded = (modified, body, quote_etag(hashlib.md5(body).hexdigest()))
+    return _loaded[1], _loaded[2]
+
+
+@require_GET
+def schema_file_view(request):
+    '''
+        - serves the schema written by the generate_schema command, the swagger and redoc pages load it
+        - in DEBUG the schema is generated on every request so changes show up without a rebuild
+    '''
+    if settings.DEBUG:
+        response = HttpResponse(generate_schema(), content_type="application/json")
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    try:
+        body, etag = load_schema(settings.API_SCHEMA_PATH)
+    except FileNotFoundError:
+        raise Http404("The API schema has not been generated, run: python manage.py generate_schema")
+
+    if etag in request.headers.get("If-None-Match", ""):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=settings.API_SCHEMA_MAX_AGE)
+    return response
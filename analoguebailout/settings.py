@@ -19,9 +19,10 @@ from sentry_sdk.integrations.django import DjangoIntegration
 sentry_sdk.init(
     dsn=os.environ.get("SENTRY_DSN"),
     integrations=[DjangoIntegration()],
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    traces_sample_rate=1.0,
+    # Every transaction is recorded, TailSamplingMiddleware and the processor
+    # decide once it is done whether it is sent, see TRACES_SLOW_THRESHOLD.
+    # Lower it to record fewer transactions in the first place.
+    traces_sample_rate=float(os.environ.get("TRACES_HEAD_SAMPLE_RATE", 1.0)),
     # If you wish to associate users to errors (assuming you are using
     # django.contrib.auth) you may enable sending PII data.
     send_default_pii=True,
@@ -59,6 +60,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'utils.middleware.TailSamplingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -66,6 +68,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'utils.middleware.QueryCountMiddleware',
+    'utils.middleware.ProfilingMiddleware',
 ]
 
 AUTH_USER_MODEL = "backendservice.User"
@@ -109,7 +113,104 @@ REST_FRAMEWORK = {
     "EXCEPTION_HANDLER": "utils.exeptionhandler.custom_exception_handler",
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+    ),
+    # orjson when it is installed, the same bytes as the default JSONRenderer
+    'DEFAULT_RENDERER_CLASSES': (
+        'utils.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+}
+
+# "rabbitmq" publishes transactions to the broker, "local" keeps them in an
+# in-memory queue for replays and tests
+TRANSACTION_TRANSPORT = os.environ.get("TRANSACTION_TRANSPORT", "rabbitmq")
+
+# where profiles are written, "cprofile" writes pstats files and "sample"
+# writes collapsed stacks from a low overhead stack sampler
+PROFILE_DIR = os.environ.get("PROFILE_DIR", str(BASE_DIR / "profiles"))
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "cprofile")
+# comma separated url names of the views to profile, one request in every
+# PROFILE_SAMPLE_EVERY is profiled
+PROFILE_VIEWS = [name for name in os.environ.get("PROFILE_VIEWS", "").split(",") if name]
+PROFILE_SAMPLE_EVERY = int(os.environ.get("PROFILE_SAMPLE_EVERY", 100))
+
+# traces slower than TRACES_SLOW_THRESHOLD seconds or failed are always sent
+# to sentry, the others only at TRACES_BASELINE_RATE
+TRACES_SLOW_THRESHOLD = float(os.environ.get("TRACES_SLOW_THRESHOLD", 0.5))
+TRACES_BASELINE_RATE = float(os.environ.get("TRACES_BASELINE_RATE", 0.01))
+
+# per request query counting, see utils.middleware.QueryCountMiddleware
+QUERY_COUNT_ENABLED = os.environ.get("QUERY_COUNT_ENABLED", "true") == "true"
+QUERY_COUNT_HEADERS = os.environ.get("QUERY_COUNT_HEADERS", str(DEBUG).lower()) == "true"
+QUERY_COUNT_WARN_THRESHOLD = int(os.environ.get("QUERY_COUNT_WARN_THRESHOLD", 20))
+
+# signature curve of the keys of new wallets, one of utils.gen_key_sign_verify.CURVES,
+# existing wallets keep the curve they were created with
+WALLET_DEFAULT_CURVE = os.environ.get("WALLET_DEFAULT_CURVE", "NIST192p")
+
+# PBKDF2 rounds of new password hashes, passwords hashed with other rounds are
+# rehashed on their next successful login
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", 260000))
+# login passwords hashed at once per web worker, logins waiting for their turn
+# beyond LOGIN_HASH_QUEUE or longer than LOGIN_HASH_TIMEOUT seconds get a 503
+LOGIN_HASH_WORKERS = int(os.environ.get("LOGIN_HASH_WORKERS", os.cpu_count()))
+LOGIN_HASH_QUEUE = int(os.environ.get("LOGIN_HASH_QUEUE", 64))
+LOGIN_HASH_TIMEOUT = float(os.environ.get("LOGIN_HASH_TIMEOUT", 5))
+
+# priority lanes of the transfers, see utils.producer.priority_lane: transfers of at
+# least TRANSFER_BULK_AMOUNTS of their currency go to the bulk lane, the others to
+# the interactive lane. The processors serve the lanes in proportion to their
+# weight, a transfer waiting longer than TRANSFER_LANE_MAX_WAIT seconds is served next
+TRANSFER_BULK_AMOUNTS = {
+    "Bitcoin": float(os.environ.get("TRANSFER_BULK_AMOUNT_BITCOIN", 1)),
+    "Ethereum": float(os.environ.get("TRANSFER_BULK_AMOUNT_ETHEREUM", 30)),
+}
+TRANSFER_LANE_WEIGHTS = {
+    "interactive": int(os.environ.get("TRANSFER_LANE_WEIGHT_INTERACTIVE", 4)),
+    "bulk": int(os.environ.get("TRANSFER_LANE_WEIGHT_BULK", 1)),
+}
+TRANSFER_LANE_MAX_WAIT = float(os.environ.get("TRANSFER_LANE_MAX_WAIT", 5))
+
+# publishing gives up on the broker after PRODUCER_CONNECT_TIMEOUT seconds, after
+# PRODUCER_FAILURE_THRESHOLD failures in a row it is not tried for PRODUCER_RESET_TIMEOUT
+# seconds. Meanwhile transactions are spooled to PRODUCER_SPOOL_DIR and published
+# from there every PRODUCER_SPOOL_DRAIN_INTERVAL seconds once the broker is back
+PRODUCER_CONNECT_TIMEOUT = float(os.environ.get("PRODUCER_CONNECT_TIMEOUT", 1))
+PRODUCER_FAILURE_THRESHOLD = int(os.environ.get("PRODUCER_FAILURE_THRESHOLD", 3))
+PRODUCER_RESET_TIMEOUT = float(os.environ.get("PRODUCER_RESET_TIMEOUT", 10))
+PRODUCER_SPOOL_DIR = os.environ.get("PRODUCER_SPOOL_DIR", str(BASE_DIR / "spool"))
+PRODUCER_SPOOL_DRAIN_INTERVAL = float(os.environ.get("PRODUCER_SPOOL_DRAIN_INTERVAL", 5))
+
+# events buffered per open transaction event stream before the client is told it
+# missed some, and seconds between keepalive comments on an idle stream
+EVENTS_SUBSCRIBER_BUFFER = int(os.environ.get("EVENTS_SUBSCRIBER_BUFFER", 100))
+EVENTS_KEEPALIVE = float(os.environ.get("EVENTS_KEEPALIVE", 15))
+
+# the OpenAPI schema written by the generate_schema command, served at /schema.json
+# and cached by clients for API_SCHEMA_MAX_AGE seconds, generated per request in DEBUG
+API_SCHEMA_PATH = os.environ.get("API_SCHEMA_PATH", str(BASE_DIR / "schema" / "openapi.json"))
+API_SCHEMA_MAX_AGE = int(os.environ.get("API_SCHEMA_MAX_AGE", 86400))
+
+# the wallet lists and the transaction list are versioned by VERSION_TAG_SHARDS tags each,
+# writers of different users bump different tags, see backendservice/versioning.py
+VERSION_TAG_SHARDS = int(os.environ.get("VERSION_TAG_SHARDS", 16))
+
+# the processor checkpoints a wallet balance every WALLET_CHECKPOINT_EVERY confirmed
+# transfers of the wallet, statements replay at most that many transfers before their range
+WALLET_CHECKPOINT_EVERY = int(os.environ.get("WALLET_CHECKPOINT_EVERY", 100))
+
+# retries of a transfer with the same Idempotency-Key get the stored response of the
+# first request, keys are purged IDEMPOTENCY_KEY_TTL hours after their first use. A key
+# whose request has been in progress for IDEMPOTENCY_KEY_LEASE seconds is taken over by
+# its next retry, keep it above the request timeout of the web workers
+IDEMPOTENCY_KEY_TTL = float(os.environ.get("IDEMPOTENCY_KEY_TTL", 24))
+IDEMPOTENCY_KEY_LEASE = float(os.environ.get("IDEMPOTENCY_KEY_LEASE", 60))
+
+SWAGGER_SETTINGS = {
+    "SPEC_URL": "schema-json",
+}
+REDOC_SETTINGS = {
+    "SPEC_URL": "schema-json",
 }
 
 SIMPLE_JWT = {
@@ -118,6 +219,15 @@ SIMPLE_JWT = {
 }
 
 
+PASSWORD_HASHERS = [
+    # same "pbkdf2_sha256" hashes as django's default hasher, with configurable rounds
+    'utils.passwords.ConfigurablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
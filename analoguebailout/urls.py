@@ -15,28 +15,15 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
 
-
-schema_view = get_schema_view(
-    openapi.Info(
-        title="Analogue Bailout API",
-        default_version='v1',
-        description="Analogue Bailout description",
-        terms_of_service="https://www.analogue-bailout.com/policies/terms/",
-        contact=openapi.Contact(email="contact@analogue-bailout.local"),
-        license=openapi.License(name="Analogue Bailout License"),
-    ),
-    public=True,
-    permission_classes=(permissions.AllowAny,),
-)
+from analoguebailout.schema import schema_view, schema_file_view
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/", include("backendservice.urls")),
+    # the pages only render a shell, the schema itself comes from schema.json, see SWAGGER_SETTINGS
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    path('schema.json', schema_file_view, name='schema-json'),
 ]
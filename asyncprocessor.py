@@ -0,0 +1,291 @@
+import os
+import time
+import signal
+import asyncio
+import functools
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# sets up django and the processor log before any worker thread or process exists
+from transactionprocessor import (TransactionProcessor, TRANSIENT_ERRORS, AlreadySettled, failure_route,
+                                  record_failure, retry_queues, logger)
+from django.conf import settings
+from django.db import connections
+from utils.gen_key_sign_verify import GenKeySignAndVerify
+from utils.metrics import metrics
+from utils.producer import CURRENCY_TYPES, LANES
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+
+def run_orm(function, *args):
+    '''
+        - runs a blocking ORM call on a thread of the ORM pool
+        - drops the thread's connection on transient errors so the next call reconnects
+    '''
+    try:
+        return function(*args)
+    except TRANSIENT_ERRORS:
+        connections.close_all()
+        raise
+
+
+class PipelineItem:
+    __slots__ = ("message", "lane", "received", "transaction_info", "source_wallet", "transaction",
+                 "is_transaction_valid", "wallet_keys", "predecessors", "done")
+
+    def __init__(self, message, lane, done):
+        self.message = message
+        self.lane = lane
+        self.received = time.perf_counter()
+        self.transaction_info = None
+        self.source_wallet = None
+        self.transaction = None
+        self.is_transaction_valid = None
+        self.wallet_keys = ()
+        # completion futures of earlier messages touching the same wallets
+        self.predecessors = []
+        self.done = done
+
+
+class AsyncTransactionProcessor:
+    '''
+        - decodes, fetches, verifies and commits transfers in bounded stages connected by queues
+        - ORM calls run on a dedicated thread pool, signature checks on a process pool
+        - transfers touching the same wallet are committed in the order they were delivered
+    '''
+
+    def __init__(self, fetch_workers, verify_workers, commit_workers, max_in_flight, currency_type=None):
+        self.processor = TransactionProcessor(currency_type)
+        self.fetch_workers = fetch_workers
+        self.verify_workers = verify_workers
+        self.commit_workers = commit_workers
+        self.max_in_flight = max_in_flight
+
+        # fork the verifiers now, before the event loop and the ORM threads exist
+        self.cpu_pool = ProcessPoolExecutor(
+            max_workers=verify_workers, mp_context=multiprocessing.get_context("fork"))
+        list(self.cpu_pool.map(abs, range(verify_workers)))
+        self.orm_pool = ThreadPoolExecutor(max_workers=fetch_workers + commit_workers, thread_name_prefix="orm")
+        self.commit_slots = None
+
+        self.decode_queue = None
+        self.fetch_queue = None
+        self.verify_queue = None
+        self.commit_queue = None
+
+        # completion future of the last delivered message per (currency, user) wallet
+        self.wallet_tails = {}
+        self.in_flight = 0
+        # commits waiting on their predecessors, referenced so they are not garbage collected
+        self.committing = set()
+        self.drained = None
+        self.channel = None
+
+    async def orm(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.orm_pool, run_orm, function, *args)
+
+    async def on_message(self, lane, message):
+        self.in_flight += 1
+        self.drained.clear()
+        metrics.set("processor_in_flight", self.in_flight)
+        await self.decode_queue.put(PipelineItem(message, lane, asyncio.get_running_loop().create_future()))
+
+    async def decode(self, item):
+        item.transaction_info = self.processor.decode(item.message.body)
+
+        # a single decoder registers messages in delivery order, which fixes the commit order per wallet
+        currency_type = item.transaction_info["currency_type"]
+        item.wallet_keys = {
+            (currency_type, item.transaction_info["source_user"]),
+            (currency_type, item.transaction_info["target_user"]),
+        }
+        for key in item.wallet_keys:
+            if key in self.wallet_tails:
+                item.predecessors.append(self.wallet_tails[key])
+            self.wallet_tails[key] = item.done
+
+    async def fetch(self, item):
+        item.source_wallet, item.transaction = await self.orm(self.processor.fetch, item.transaction_info)
+
+    async def verify(self, item):
+        if item.source_wallet is None:
+            # already settled, nothing to verify
+            return
+        item.is_transaction_valid = await asyncio.get_running_loop().run_in_executor(
+            self.cpu_pool, GenKeySignAndVerify.verify_transaction_signature,
+            item.source_wallet.public_key, item.transaction_info['signature'],
+            self.processor.signed_data(item.transaction_info), item.source_wallet.curve)
+
+    async def commit(self, item):
+        try:
+            # never hold a commit slot while waiting, the predecessor may need it
+            await asyncio.gather(*item.predecessors)
+            if item.source_wallet is None:
+                self.processor.skip(item.transaction_info, item.transaction)
+            else:
+                async with self.commit_slots:
+                    try:
+                        await self.orm(self.processor.settle, item.transaction_info, item.transaction,
+                                       item.is_transaction_valid)
+                    except AlreadySettled:
+                        self.processor.skip(item.transaction_info, item.transaction)
+        except Exception as e:
+            await self.fail(item, e)
+            return
+
+        # settled, whatever fails from here on must not retry or park it
+        try:
+            await item.message.ack()
+            metrics.incr("processor_messages_processed_total", currency=item.transaction_info["currency_type"])
+            self.processor.record_lag(item.transaction_info, item.lane)
+            metrics.observe("processor_lane_latency_seconds", time.perf_counter() - item.received, lane=item.lane)
+        except Exception as e:
+            # an unacked message is redelivered once the channel is recovered and skipped as settled
+            logger.error(f'Could not ack settled transaction {item.transaction_info["identifier"]}: {e!r}')
+        self.finish(item)
+
+    async def fail(self, item, error):
+        queue, headers = failure_route(item.message.routing_key, item.message.headers, error)
+        try:
+            await self.channel.default_exchange.publish(
+                aio_pika.Message(body=item.message.body, headers=headers,
+                                 delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+                routing_key=queue)
+            record_failure(queue, headers, error)
+            await item.message.ack()
+        except Exception as e:
+            # left unacked, the broker redelivers it once the channel is recovered
+            logger.error(f'Could not route failed transaction to {queue}: {e!r}')
+        self.finish(item)
+
+    def finish(self, item):
+        item.done.set_result(None)
+        for key in item.wallet_keys:
+            if self.wallet_tails.get(key) is item.done:
+                del self.wallet_tails[key]
+
+        self.in_flight -= 1
+        metrics.set("processor_in_flight", self.in_flight)
+        metrics.flush()
+        if not self.in_flight:
+            self.drained.set()
+
+    async def stage(self, inbox, outbox, handler):
+        while True:
+            item = await inbox.get()
+            try:
+                await handler(item)
+            except Exception as e:
+                await self.fail(item, e)
+            else:
+                await outbox.put(item)
+
+    async def dispatch_commits(self):
+        while True:
+            item = await self.commit_queue.get()
+            task = asyncio.ensure_future(self.commit(item))
+            self.committing.add(task)
+            task.add_done_callback(self.committing.discard)
+
+    def start(self):
+        '''
+            - creates the stage queues and workers
+            :return: the worker tasks
+        '''
+        self.decode_queue = asyncio.Queue(self.max_in_flight)
+        self.fetch_queue = asyncio.Queue(self.max_in_flight)
+        self.verify_queue = asyncio.Queue(self.max_in_flight)
+        self.commit_queue = asyncio.Queue(self.max_in_flight)
+        self.commit_slots = asyncio.Semaphore(self.commit_workers)
+        self.drained = asyncio.Event()
+        self.drained.set()
+
+        tasks = [asyncio.ensure_future(self.stage(self.decode_queue, self.fetch_queue, self.decode))]
+        tasks += [asyncio.ensure_future(self.stage(self.fetch_queue, self.verify_queue, self.fetch))
+                  for _ in range(self.fetch_workers)]
+        tasks += [asyncio.ensure_future(self.stage(self.verify_queue, self.commit_queue, self.verify))
+                  for _ in range(self.verify_workers)]
+        tasks.append(asyncio.ensure_future(self.dispatch_commits()))
+        return tasks
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, stopping.set)
+        loop.add_signal_handler(signal.SIGINT, stopping.set)
+
+        tasks = self.start()
+
+        connection = await aio_pika.connect_robust(host='localhost')
+        # retried and parked messages must reach the broker before the original is acked
+        self.channel = await connection.channel(publisher_confirms=True)
+
+        consumers = []
+        weights = settings.TRANSFER_LANE_WEIGHTS
+        for lane in LANES:
+            lane_channel = await connection.channel()
+            # the messages held by all the stages together are shared out by lane weight,
+            # a bulk run can not take the pipeline slots of the interactive lane
+            await lane_channel.set_qos(
+                prefetch_count=max(1, self.max_in_flight * weights[lane] // sum(weights.values())))
+
+            for queue_name in self.processor.queues(lane):
+                queue = await lane_channel.declare_queue(queue_name, durable=True)
+                for retry_queue, arguments in retry_queues(queue_name):
+                    await lane_channel.declare_queue(retry_queue, durable=True, arguments=arguments)
+                await lane_channel.declare_queue(f'{queue_name}.parking', durable=True)
+                consumers.append((queue, await queue.consume(functools.partial(self.on_message, lane))))
+        print(' [*] Waiting for logs. To exit press CTRL+C')
+
+        await stopping.wait()
+
+        # stop deliveries, then let every message already in the pipeline commit and ack
+        for queue, consumer_tag in consumers:
+            await queue.cancel(consumer_tag)
+        await self.drained.wait()
+
+        for task in tasks:
+            task.cancel()
+        await connection.close()
+        self.orm_pool.shutdown()
+        self.cpu_pool.shutdown()
+        metrics.remove()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Processes transactions with an asyncio pipeline")
+    parser.add_argument(
+        "--fetch-workers", type=int, default=int(os.environ.get("PROCESSOR_FETCH_WORKERS", 8)),
+        help="Concurrent wallet and transaction lookups")
+    parser.add_argument(
+        "--verify-workers", type=int, default=int(os.environ.get("PROCESSOR_VERIFY_WORKERS", os.cpu_count())),
+        help="Processes verifying signatures")
+    parser.add_argument(
+        "--commit-workers", type=int, default=int(os.environ.get("PROCESSOR_COMMIT_WORKERS", 8)),
+        help="Concurrent database commits")
+    parser.add_argument(
+        "--max-in-flight", type=int, default=int(os.environ.get("PROCESSOR_MAX_IN_FLIGHT", 256)),
+        help="Messages held by the pipeline at once")
+    parser.add_argument(
+        "--currency", choices=CURRENCY_TYPES,
+        help="Only process the transfers of this currency, defaults to all currencies")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    if aio_pika is None:
+        raise SystemExit("The asyncio processor needs aio-pika, install it with: pip install aio-pika")
+
+    args = parse_args()
+    asyncio.run(AsyncTransactionProcessor(
+        fetch_workers=args.fetch_workers,
+        verify_workers=args.verify_workers,
+        commit_workers=args.commit_workers,
+        max_in_flight=args.max_in_flight,
+        currency_type=args.currency,
+    ).run())
@@ -0,0 +1,59 @@
+from django.db import transaction, IntegrityError
+from django.db.models import F, Sum, Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from backendservice.models import DailyTransactionAggregate
+
+
+def _add(user, currency_type, day, **increments):
+    '''
+        - adds the increments to the user's aggregate of the day, creating it when missing
+    '''
+    aggregates = DailyTransactionAggregate.objects.filter(user=user, currency_type=currency_type, day=day)
+    updates = {field: F(field) + value for field, value in increments.items()}
+    if aggregates.update(**updates):
+        return
+
+    try:
+        with transaction.atomic():
+            DailyTransactionAggregate.objects.create(user_id=user, currency_type=currency_type, day=day, **increments)
+    except IntegrityError:
+        # created meanwhile by another writer
+        aggregates.update(**updates)
+
+
+def record_transfer(currency_type, source_user, target_user, amount, processed):
+    '''
+        - counts a confirmed transfer in the daily aggregates of both users
+        - must run in the atomic block that confirms the transfer, while both wallets
+          are locked, so the aggregate rows of a user are never written concurrently
+    '''
+    day = timezone.localdate(processed)
+    _add(source_user, currency_type, day, sent_amount=amount, sent_count=1)
+    _add(target_user, currency_type, day, received_amount=amount, received_count=1)
+
+
+def daily_totals(*transactions, users=None):
+    '''
+        :param transactions: querysets of confirmed transactions, live or archived
+        :param users: only compute the aggregates of these users, of every user when None
+        :return: {(user, currency_type, day): DailyTransactionAggregate} computed with GROUP BY
+    '''
+    aggregates = {}
+
+    for queryset in transactions:
+        queryset = queryset.annotate(day=TruncDate("processed")).order_by()
+        for direction, user_field in (("sent", "source_user"), ("received", "target_user")):
+            rows = queryset if users is None else queryset.filter(**{f'{user_field}__in': users})
+            rows = rows.values(user_field, "currency_type", "day").annotate(
+                amount=Sum("amount"), count=Count("identifier"))
+            for row in rows:
+                key = (row[user_field], row["currency_type"], row["day"])
+                if key not in aggregates:
+                    aggregates[key] = DailyTransactionAggregate(
+                        user_id=row[user_field], currency_type=row["currency_type"], day=row["day"])
+                aggregate = aggregates[key]
+                setattr(aggregate, f'{direction}_amount', getattr(aggregate, f'{direction}_amount') + row["amount"])
+                setattr(aggregate, f'{direction}_count', getattr(aggregate, f'{direction}_count') + row["count"])
+    return aggregates
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class BackendserviceConfig(AppConfig):
     name = 'backendservice'
+
+    def ready(self):
+        # registers the system checks
+        from backendservice import checks  # noqa: F401
@@ -0,0 +1,116 @@
+import uuid
+import heapq
+import decimal
+from django.conf import settings
+from django.db.models import Q
+
+from backendservice.models import BitcoinWallet, EthereumWallet, Transaction, ArchivedTransaction, WalletCheckpoint
+
+
+currency_types = {
+    "Bitcoin": BitcoinWallet,
+    "Ethereum": EthereumWallet
+}
+
+# the ledger spans the live and the archived transactions
+ledger_tables = [Transaction, ArchivedTransaction]
+
+# identifier a checkpoint holds when no transfer precedes it, orders before every transaction
+NO_TRANSACTION = uuid.UUID(int=0)
+
+
+def rounded(currency_type, amount):
+    '''
+        :return: the amount rounded the way the wallet balance column of the currency stores it
+    '''
+    decimal_places = currency_types[currency_type]._meta.get_field("balance").decimal_places
+    return amount.quantize(decimal.Decimal(1).scaleb(-decimal_places))
+
+
+def write_checkpoint(wallet, currency_type, processed, transaction_identifier):
+    '''
+        - checkpoints the balance of the wallet at the given position of its transfers
+        - the caller saves the wallet, which resets its transfer counter
+    '''
+    WalletCheckpoint.objects.create(
+        user_id=wallet.user_id, currency_type=currency_type, balance=rounded(currency_type, wallet.balance),
+        processed=processed, transaction=transaction_identifier)
+    wallet.transfers_since_checkpoint = 0
+
+
+def count_transfer(wallet, currency_type, transaction):
+    '''
+        - counts a confirmed transfer on the wallet, every WALLET_CHECKPOINT_EVERY transfers its balance is checkpointed
+        - must run in the atomic block that confirms the transfer, once the new balance and the processed
+          time are set and before the wallet is saved
+    '''
+    wallet.transfers_since_checkpoint += 1
+    if wallet.transfers_since_checkpoint >= settings.WALLET_CHECKPOINT_EVERY:
+        write_checkpoint(wallet, currency_type, transaction.processed, transaction.identifier)
+
+
+def _after(position):
+    processed, identifier = position
+    return Q(processed__gt=processed) | Q(processed=processed, identifier__gt=identifier)
+
+
+def transfers(user, currency_type, after=None, until=None):
+    '''
+        :param after: exclusive start, a (processed, identifier) position, a datetime or None for the first transfer
+        :param until: inclusive end, a (processed, identifier) position, a datetime or None for the last transfer
+        :return: iterator of (identifier, processed, counterparty, signed amount) of the user's confirmed
+                 transfers, live and archived, in (processed, identifier) order
+    '''
+    querysets = []
+    for table in ledger_tables:
+        queryset = table.objects.filter(
+            Q(source_user=user) | Q(target_user=user), currency_type=currency_type, state="Confirmed")
+        if isinstance(after, tuple):
+            queryset = queryset.filter(_after(after))
+        elif after is not None:
+            queryset = queryset.filter(processed__gt=after)
+        if isinstance(until, tuple):
+            queryset = queryset.exclude(_after(until))
+        elif until is not None:
+            queryset = queryset.filter(processed__lte=until)
+        querysets.append(queryset.order_by("processed", "identifier").values_list(
+            "identifier", "processed", "source_user", "target_user", "amount").iterator())
+
+    # both tables are read in ledger order, merged without loading either
+    for identifier, processed, source_user, target_user, amount in heapq.merge(
+            *querysets, key=lambda row: (row[1], row[0])):
+        if str(source_user) == str(user):
+            yield identifier, processed, target_user, -amount
+        else:
+            yield identifier, processed, source_user, amount
+
+
+def opening(user, currency_type, wallet, since):
+    '''
+        - the balance of the wallet right after its last transfer up to since, from the nearest checkpoint
+        - replays forward from the last checkpoint before since or backwards from the first one after it;
+          wallets never checkpointed replay forward from their opening balance or, created before
+          opening balances were kept, backwards from their current balance
+        :return: the opening balance of a statement starting after since
+    '''
+    checkpoints = WalletCheckpoint.objects.filter(user=user, currency_type=currency_type)
+    before = checkpoints.filter(processed__lte=since).order_by("-processed", "-transaction").first()
+    after = checkpoints.filter(processed__gt=since).order_by("processed", "transaction").first() \
+        if before is None else None
+
+    if before is not None or (after is None and wallet.opening_balance is not None):
+        if before is not None:
+            balance, position = before.balance, (before.processed, before.transaction)
+        else:
+            balance, position = wallet.opening_balance, None
+        for _, _, _, amount in transfers(user, currency_type, after=position, until=since):
+            balance = rounded(currency_type, balance + amount)
+        return rounded(currency_type, balance)
+
+    if after is not None:
+        balance, anchor = after.balance, (after.processed, after.transaction)
+    else:
+        balance, anchor = wallet.balance, None
+    for _, _, _, amount in transfers(user, currency_type, after=since, until=anchor):
+        balance = balance - amount
+    return rounded(currency_type, balance)
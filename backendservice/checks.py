@@ -0,0 +1,28 @@
+import os
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+from utils.gen_key_sign_verify import CURVES
+
+
+@register()
+def check_wallet_default_curve(app_configs, **kwargs):
+    if settings.WALLET_DEFAULT_CURVE in CURVES:
+        return []
+    return [Error(
+        f'WALLET_DEFAULT_CURVE {settings.WALLET_DEFAULT_CURVE} is not supported by the installed ecdsa package',
+        hint=f'Use one of {", ".join(CURVES)}, Ed25519 needs ecdsa 0.18 or later',
+        id="backendservice.E001",
+    )]
+
+
+@register()
+def check_api_schema(app_configs, **kwargs):
+    # DEBUG generates the schema per request, everywhere else it is served from the file
+    if settings.DEBUG or os.path.exists(settings.API_SCHEMA_PATH):
+        return []
+    return [Warning(
+        f'The API schema {settings.API_SCHEMA_PATH} does not exist, /schema.json and the documentation pages return 404',
+        hint="Run: python manage.py generate_schema",
+        id="backendservice.W001",
+    )]
@@ -0,0 +1,100 @@
+from typing import Dict, List, Union
+from rest_framework import serializers
+
+from backendservice.models import (BitcoinWallet, EthereumWallet, Transaction, TransactionHistory,
+                                   ArchivedTransactionHistory)
+
+
+# read only serialization for the list endpoints: rows are selected with values()
+# and mapped to dicts, the output is the same as the model serializers' output.
+# Single field instances format decimals and dates exactly like the serializers do.
+datetime_field = serializers.DateTimeField()
+amount_field = serializers.DecimalField(max_digits=26, decimal_places=18)
+balance_fields = {
+    BitcoinWallet: serializers.DecimalField(max_digits=16, decimal_places=8),
+    EthereumWallet: serializers.DecimalField(max_digits=26, decimal_places=18),
+}
+
+transaction_columns = ["identifier", "amount", "currency_type", "signature", "created", "processed", "state",
+                       "source_user", "target_user"]
+user_columns = ["identifier", "name", "email", "max_amount_per_transaction"]
+
+
+def _optional(field, value):
+    return None if value is None else field.to_representation(value)
+
+
+def _user(row: Dict, prefix: str) -> Dict[str, str]:
+    return {
+        "identifier": str(row[f'{prefix}identifier']),
+        "name": row[f'{prefix}name'],
+        "email": row[f'{prefix}email'],
+        "max_amount_per_transaction": amount_field.to_representation(row[f'{prefix}max_amount_per_transaction']),
+    }
+
+
+def _transaction(row: Dict, prefix: str = "") -> Dict[str, Union[str, None]]:
+    return {
+        "identifier": str(row[f'{prefix}identifier']),
+        "amount": amount_field.to_representation(row[f'{prefix}amount']),
+        "currency_type": row[f'{prefix}currency_type'],
+        "signature": row[f'{prefix}signature'],
+        "created": _optional(datetime_field, row[f'{prefix}created']),
+        "processed": _optional(datetime_field, row[f'{prefix}processed']),
+        "state": row[f'{prefix}state'],
+        "source_user": str(row[f'{prefix}source_user']),
+        "target_user": str(row[f'{prefix}target_user']),
+    }
+
+
+def serialize_wallets(WalletType) -> List[Dict]:
+    '''
+        :param WalletType: BitcoinWallet or EthereumWallet
+        :return: what the wallet serializer returns for every wallet, with its owner
+    '''
+    balance_field = balance_fields[WalletType]
+    rows = WalletType.objects.values(
+        "identifier", "public_key", "balance", *[f'user__{column}' for column in user_columns])
+
+    return [
+        {
+            "identifier": str(row["identifier"]),
+            "public_key": row["public_key"],
+            "balance": balance_field.to_representation(row["balance"]),
+            "owner": _user(row, "user__"),
+        }
+        for row in rows
+    ]
+
+
+def serialize_transactions(queryset=None) -> List[Dict]:
+    '''
+        :return: what TransactionsSerializer returns for every transaction
+    '''
+    queryset = Transaction.objects.all() if queryset is None else queryset
+    return [_transaction(row) for row in queryset.values(*transaction_columns)]
+
+
+def serialize_history(user, include_archived=False) -> List[Dict]:
+    '''
+        :param include_archived: also return the history moved to the archive tables
+        :return: what TransactionHistorySerializer returns for every history entry of the user
+    '''
+    columns = [
+        "identifier",
+        *[f'transaction__{column}' for column in transaction_columns],
+        *[f'user__{column}' for column in user_columns],
+    ]
+    rows = list(TransactionHistory.objects.filter(user=user).values(*columns))
+    if include_archived:
+        # archived rows have the same columns as the live ones
+        rows += ArchivedTransactionHistory.objects.filter(user=user).values(*columns)
+
+    return [
+        {
+            "identifier": str(row["identifier"]),
+            "transaction": _transaction(row, "transaction__"),
+            "user": _user(row, "user__"),
+        }
+        for row in rows
+    ]
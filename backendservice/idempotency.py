@@ -0,0 +1,132 @@
+import json
+import hashlib
+import datetime
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+from backendservice.models import IdempotencyKey
+
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field("key").max_length
+
+
+class ReservationLost(APIException):
+    # the request outlived its lease and a retry took its key over, its changes are rolled back
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "The request took too long and was taken over by a retry with the same Idempotency-Key"
+    default_code = "reservation_lost"
+
+
+def fingerprint(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def replay(reservation, request_fingerprint):
+    '''
+        :return: the stored response of the request that reserved the key
+    '''
+    if reservation.fingerprint != request_fingerprint:
+        return Response(
+            {"Message": f'The {IDEMPOTENCY_HEADER} was already used for a different request'},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+    if reservation.status is None:
+        return Response(
+            {"Message": f'A request with this {IDEMPOTENCY_HEADER} is still in progress, retry later'},
+            status=status.HTTP_409_CONFLICT
+        )
+
+    response = Response(reservation.response, status=reservation.status)
+    response["Idempotent-Replayed"] = "true"
+    return response
+
+
+def reserve(request):
+    '''
+        - a retry costs one lookup on the unique (user, key) index and gets the stored response
+        - a first request reserves the key, a concurrent request with the same key gets a 409
+        - a reservation in progress for longer than IDEMPOTENCY_KEY_LEASE seconds belongs to a request
+          that died, e.g. a killed worker, the retry takes it over and runs the request again
+        :return: (reservation, None) to go on with the request, (None, response) to answer with the response,
+                 (None, None) for requests without a key
+    '''
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return None, None
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return None, Response(
+            {"Message": f'{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    request_fingerprint = fingerprint(request.data)
+    reservation = IdempotencyKey.objects.filter(user=request.user, key=key).first()
+    if reservation is not None:
+        if reservation.fingerprint == request_fingerprint and take_over(reservation):
+            return reservation, None
+        return None, replay(reservation, request_fingerprint)
+
+    try:
+        with transaction.atomic():
+            reservation = IdempotencyKey.objects.create(user=request.user, key=key, fingerprint=request_fingerprint)
+    except IntegrityError:
+        # reserved meanwhile by a concurrent request with the same key
+        return None, replay(IdempotencyKey.objects.get(user=request.user, key=key), request_fingerprint)
+    return reservation, None
+
+
+def _held(reservation):
+    # the reservation as long as it is in progress and was not taken over since
+    return IdempotencyKey.objects.filter(
+        identifier=reservation.identifier, status__isnull=True, reserved=reservation.reserved)
+
+
+def take_over(reservation):
+    '''
+        :return: whether the expired reservation was taken over, only one of concurrent retries wins
+    '''
+    now = timezone.now()
+    if reservation.status is not None or reservation.reserved > now - datetime.timedelta(
+            seconds=settings.IDEMPOTENCY_KEY_LEASE):
+        return False
+    if not _held(reservation).update(reserved=now):
+        return False
+    reservation.reserved = now
+    return True
+
+
+def renew(reservation):
+    '''
+        - starts the lease of the reservation over, call it in the atomic block that commits the changes
+          of the request when the request has more to do before it can complete the key
+        - raises ReservationLost when a retry took the key over meanwhile, which rolls the changes back
+    '''
+    if reservation is None:
+        return
+    now = timezone.now()
+    if not _held(reservation).update(reserved=now):
+        raise ReservationLost()
+    reservation.reserved = now
+
+
+def complete(reservation, payload, status_code):
+    '''
+        - stores the response of the request that reserved the key, once nothing the response
+          announces can fail anymore: a retry never gets a response for changes that were rolled back
+        - raises ReservationLost when a retry took the key over meanwhile
+    '''
+    if reservation is not None and not _held(reservation).update(status=status_code, response=payload):
+        raise ReservationLost()
+
+
+def release(reservation):
+    '''
+        - frees the key of a request that failed before storing its response, its retry runs again
+    '''
+    if reservation is not None:
+        _held(reservation).delete()
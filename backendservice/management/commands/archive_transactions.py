@@ -0,0 +1,82 @@
+import time
+import datetime
+from django.db import transaction
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from backendservice.models import Transaction, TransactionHistory, ArchivedTransaction, ArchivedTransactionHistory
+from backendservice.versioning import bump, history_key, transactions_key
+
+
+SETTLED_STATES = ["Confirmed", "Rejected"]
+
+
+def _columns(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def archivable_transactions(cutoff):
+    return Transaction.objects.filter(state__in=SETTLED_STATES, created__lt=cutoff).order_by("created")
+
+
+def archive_batch(identifiers):
+    '''
+        - moves the transactions and their history to the archive tables in one atomic block,
+          an interrupted run loses nothing and the next run picks up the same rows
+        :return: the number of archived transactions
+    '''
+    with transaction.atomic():
+        # the archive keeps every column except the archival time, which defaults to now
+        transaction_columns = _columns(Transaction)
+        transactions = list(Transaction.objects.filter(identifier__in=identifiers).values(*transaction_columns))
+        history = list(TransactionHistory.objects.filter(transaction__in=identifiers).values(
+            *_columns(TransactionHistory)))
+
+        ArchivedTransaction.objects.bulk_create([ArchivedTransaction(**row) for row in transactions])
+        ArchivedTransactionHistory.objects.bulk_create([ArchivedTransactionHistory(**row) for row in history])
+
+        TransactionHistory.objects.filter(transaction__in=identifiers).delete()
+        Transaction.objects.filter(identifier__in=identifiers).delete()
+
+        bump(*[transactions_key(row["source_user_id"]) for row in transactions],
+             *[history_key(user) for user in {row["user_id"] for row in history}])
+
+    return len(transactions)
+
+
+class Command(BaseCommand):
+    help = "Moves settled transactions older than a cutoff, with their history, to the archive tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=90,
+            help="Archive settled transactions created more than this many days ago")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of transactions moved per database transaction")
+        parser.add_argument(
+            "--sleep", type=float, default=0,
+            help="Seconds to wait between batches, to leave room for the live traffic")
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only count the transactions that would be archived")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+
+        if options["dry_run"]:
+            self.stdout.write(f'{archivable_transactions(cutoff).count()} transactions created before {cutoff} would be archived')
+            return
+
+        archived = 0
+        while True:
+            identifiers = list(archivable_transactions(cutoff).values_list(
+                "identifier", flat=True)[:options["batch_size"]])
+            if not identifiers:
+                break
+
+            archived += archive_batch(identifiers)
+            self.stdout.write(f'{archived} transactions archived')
+            time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} transactions created before {cutoff}'))
@@ -0,0 +1,63 @@
+from django.db import transaction
+from django.core.management.base import BaseCommand
+
+from backendservice.aggregates import daily_totals
+from backendservice.models import (BitcoinWallet, EthereumWallet, DailyTransactionAggregate, Transaction,
+                                   ArchivedTransaction)
+
+
+currency_types = {
+    "Bitcoin": BitcoinWallet,
+    "Ethereum": EthereumWallet
+}
+
+
+def rebuild_batch(currency_type, identifiers, batch_size):
+    '''
+        - rebuilds the aggregates of the owners of the given wallets in one atomic block
+        - the processor updates the aggregates of a transfer while it holds the transfer's wallet
+          locks, locking the wallets of the batch, in the processor's order, holds off only the
+          transfers of these users until their aggregates are rebuilt
+        :return: the number of aggregates rebuilt
+    '''
+    with transaction.atomic():
+        users = list(currency_types[currency_type].objects.select_for_update().filter(
+            identifier__in=identifiers).order_by("identifier").values_list("user", flat=True))
+
+        aggregates = daily_totals(
+            Transaction.objects.filter(currency_type=currency_type, state="Confirmed"),
+            ArchivedTransaction.objects.filter(currency_type=currency_type, state="Confirmed"),
+            users=users)
+        DailyTransactionAggregate.objects.filter(currency_type=currency_type, user__in=users).delete()
+        DailyTransactionAggregate.objects.bulk_create(aggregates.values(), batch_size=batch_size)
+    return len(aggregates)
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the daily transaction aggregates from the confirmed transactions, archived ones included"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--currency", action="append", choices=list(currency_types),
+            help="Currency to rebuild, can be repeated. Defaults to all currencies")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of aggregates inserted per query")
+        parser.add_argument(
+            "--users-per-batch", type=int, default=100,
+            help="Number of users whose aggregates are rebuilt, and whose wallets are locked, at a time")
+
+    def handle(self, *args, **options):
+        currencies = options["currency"] or list(currency_types)
+
+        for currency_type in currencies:
+            identifiers = list(currency_types[currency_type].objects.order_by("identifier").values_list(
+                "identifier", flat=True))
+            rebuilt = 0
+            for start in range(0, len(identifiers), options["users_per_batch"]):
+                rebuilt += rebuild_batch(
+                    currency_type, identifiers[start:start + options["users_per_batch"]], options["batch_size"])
+
+            self.stdout.write(f'{currency_type}: {rebuilt} daily aggregates rebuilt')
+
+        self.stdout.write(self.style.SUCCESS("Daily transaction aggregates rebuilt"))
@@ -0,0 +1,86 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
+from django.test import override_settings
+from django.test.utils import setup_databases, teardown_databases
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory
+
+from backendservice.models import User
+from backendservice.views import LoginAPIView
+from backendservice.management.commands.replay_traffic import percentile
+
+
+class Command(BaseCommand):
+    help = "Measures login latency and throughput against a disposable database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50, help="Number of accounts logging in")
+        parser.add_argument("--logins", type=int, default=500, help="Number of logins")
+        parser.add_argument("--concurrency", type=int, default=8, help="Logins sent at once")
+        parser.add_argument(
+            "--iterations", type=int,
+            help="PBKDF2 rounds of the stored passwords, defaults to PASSWORD_HASH_ITERATIONS")
+
+    def handle(self, *args, **options):
+        overrides = {}
+        if options["iterations"]:
+            overrides["PASSWORD_HASH_ITERATIONS"] = options["iterations"]
+
+        self.stdout.write("Creating a disposable database")
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(**overrides):
+                emails = self.seed(options["users"])
+                latencies, statuses = self.bench(emails, options["logins"], options["concurrency"])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        self.report(latencies, statuses)
+
+    def seed(self, users):
+        # one hash shared by every account, seeding should not take as long as the benchmark
+        password = make_password("bench1234")
+        User.objects.bulk_create([
+            User(name=f'bench {index}', description="login benchmark", email=f'bench{index}@bench.local',
+                 max_amount_per_transaction=100, password=password)
+            for index in range(users)
+        ])
+        return [f'bench{index}@bench.local' for index in range(users)]
+
+    def bench(self, emails, logins, concurrency):
+        view = LoginAPIView.as_view()
+        factory = APIRequestFactory()
+
+        def login(index):
+            request = factory.post("/api/login/", {
+                "email": emails[index % len(emails)],
+                "password": "bench1234",
+            }, format="json")
+            request_started = time.perf_counter()
+            response = view(request)
+            latency = time.perf_counter() - request_started
+            # what django does at the end of every request
+            close_old_connections()
+            return latency, response.status_code
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(login, range(logins)))
+        self.elapsed = time.perf_counter() - started
+
+        return [latency for latency, _ in results], [status_code for _, status_code in results]
+
+    def report(self, latencies, statuses):
+        succeeded = statuses.count(200)
+        self.stdout.write(
+            f'login: {len(latencies)} logins, {len(latencies) / self.elapsed:.1f} logins/s, '
+            f'p50 {percentile(latencies, 0.5) * 1000:.2f}ms, p95 {percentile(latencies, 0.95) * 1000:.2f}ms, '
+            f'p99 {percentile(latencies, 0.99) * 1000:.2f}ms')
+
+        if succeeded == len(statuses):
+            self.stdout.write(self.style.SUCCESS("  every login succeeded"))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'  {len(statuses) - succeeded} logins failed, {statuses.count(503)} of them shed with 503'))
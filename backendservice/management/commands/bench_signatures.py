@@ -0,0 +1,55 @@
+import time
+import uuid
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.gen_key_sign_verify import GenKeySignAndVerify, CURVES
+
+
+class Command(BaseCommand):
+    help = "Compares key generation, signing and verification throughput of the wallet curves"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--curve", action="append",
+            help="Curve to benchmark, can be repeated. Defaults to every curve the installed ecdsa supports")
+        parser.add_argument("--operations", type=int, default=200, help="Signatures made and verified per curve")
+
+    def handle(self, *args, **options):
+        curve_names = options["curve"] or list(CURVES)
+        unsupported = [curve_name for curve_name in curve_names if curve_name not in CURVES]
+        if unsupported:
+            raise CommandError(f'Not supported by the installed ecdsa package: {", ".join(unsupported)}')
+
+        operations = options["operations"]
+        transfers = [{
+            "source_user": str(uuid.uuid4()),
+            "target_user": str(uuid.uuid4()),
+            "currency_type": "Bitcoin",
+            "amount": index + 0.5,
+        } for index in range(operations)]
+
+        for curve_name in curve_names:
+            started = time.perf_counter()
+            keys = [GenKeySignAndVerify.generate_keys(curve_name) for _ in range(operations)]
+            generate_rate = operations / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            signatures = [
+                GenKeySignAndVerify.sign_transaction(private_key, transfer, curve_name)
+                for (private_key, _), transfer in zip(keys, transfers)
+            ]
+            sign_rate = operations / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            verified = [
+                GenKeySignAndVerify.verify_transaction_signature(public_key, signature, transfer, curve_name)
+                for (_, public_key), signature, transfer in zip(keys, signatures, transfers)
+            ]
+            verify_rate = operations / (time.perf_counter() - started)
+
+            if not all(verified):
+                raise CommandError(f'{curve_name}: {verified.count(None)} signatures did not verify')
+
+            self.stdout.write(
+                f'{curve_name}: {generate_rate:.0f} keys/s, {sign_rate:.0f} signatures/s, '
+                f'{verify_rate:.0f} verifications/s')
@@ -0,0 +1,34 @@
+import os
+import glob
+import pika
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.producer import drain_spool
+
+
+class Command(BaseCommand):
+    help = "Publishes the transactions spooled on local disk while the broker was unavailable"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--spool-dir", default=settings.PRODUCER_SPOOL_DIR,
+            help="Directory of the spool files, defaults to PRODUCER_SPOOL_DIR")
+
+    def handle(self, *args, **options):
+        spool_dir = options["spool_dir"]
+        if not os.path.isdir(spool_dir):
+            self.stdout.write("Nothing spooled")
+            return
+
+        try:
+            published = drain_spool(spool_dir)
+        except (pika.exceptions.AMQPError, OSError) as e:
+            raise CommandError(f'The broker is still unavailable, drained files resume where they stopped: {e!r}')
+
+        self.stdout.write(self.style.SUCCESS(f'Published {published} spooled transactions'))
+
+        # files of running web workers are drained by the workers themselves
+        remaining = glob.glob(os.path.join(spool_dir, "*.spool")) + glob.glob(os.path.join(spool_dir, "*.draining"))
+        if remaining:
+            self.stdout.write(self.style.WARNING(f'  {len(remaining)} spool files are owned by running processes'))
@@ -0,0 +1,290 @@
+import os
+import json
+import shutil
+import datetime
+import contextlib
+from django.db import connection, transaction
+from django.utils import timezone
+from django.core.management.base import BaseCommand, CommandError
+
+from backendservice.models import BitcoinWallet, EthereumWallet, Transaction, ArchivedTransaction
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+currency_types = {
+    "Bitcoin": BitcoinWallet,
+    "Ethereum": EthereumWallet
+}
+
+# the ledger spans the live and the archived transactions
+ledger_tables = [Transaction, ArchivedTransaction]
+
+# states a transaction never leaves, only those are exported
+SETTLED_STATES = ["Confirmed", "Rejected"]
+
+transaction_columns = ["identifier", "source_user", "target_user", "currency_type", "amount", "state", "created",
+                       "processed"]
+wallet_columns = ["identifier", "user", "balance"]
+
+# an int64 holds 18 digits, wider amounts are split in two int64 columns for numpy
+NUMPY_SPLIT = 10 ** 18
+
+
+def column_kind(model, column):
+    field = model._meta.get_field(column)
+    if field.get_internal_type() in ("UUIDField", "ForeignKey", "OneToOneField"):
+        return "uuid"
+    if field.get_internal_type() == "DecimalField":
+        return "amount"
+    if field.get_internal_type() == "DateTimeField":
+        return "timestamp"
+    return "string"
+
+
+def base_units(amount, decimal_places):
+    '''
+        :return: the amount as an integer of its smallest unit, e.g. satoshi for a bitcoin balance
+    '''
+    return int(amount.scaleb(decimal_places))
+
+
+def utc(value):
+    return timezone.make_naive(value, datetime.timezone.utc) if value is not None else None
+
+
+class ArrowWriter:
+    '''
+        - one Arrow IPC or Parquet file per chunk
+        - uuids as 16 byte fixed size binary, amounts as decimal128 which stores the integer
+          base units, timestamps in microseconds UTC, strings dictionary encoded
+    '''
+
+    def __init__(self, parquet=False):
+        self.parquet = parquet
+        self.extension = ".parquet" if parquet else ".arrow"
+
+    def array(self, model, column, values):
+        kind = column_kind(model, column)
+        if kind == "uuid":
+            return pyarrow.array([value.bytes for value in values], type=pyarrow.binary(16))
+        if kind == "amount":
+            field = model._meta.get_field(column)
+            return pyarrow.array(values, type=pyarrow.decimal128(field.max_digits, field.decimal_places))
+        if kind == "timestamp":
+            return pyarrow.array(values, type=pyarrow.timestamp("us", tz="UTC"))
+        return pyarrow.array(values, type=pyarrow.string()).dictionary_encode()
+
+    def write(self, path, model, columns, rows):
+        values = list(zip(*rows))
+        table = pyarrow.table({
+            column: self.array(model, column, column_values) for column, column_values in zip(columns, values)
+        })
+        tmp_path = f'{path}.tmp'
+        if self.parquet:
+            pyarrow.parquet.write_table(table, tmp_path)
+        else:
+            with pyarrow.ipc.new_file(tmp_path, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, f'{path}{self.extension}')
+
+
+class NumpyWriter:
+    '''
+        - one directory of .npy files per chunk, a file per column
+        - uuids as 16 byte void, amounts as int64 base units, amounts wider than 18 digits
+          as <column>_hi and <column>_lo with value = hi * 10**18 + lo, timestamps as
+          datetime64[us] UTC with NaT for nulls, strings as fixed width bytes
+    '''
+
+    extension = ""
+
+    def arrays(self, model, column, values):
+        kind = column_kind(model, column)
+        if kind == "uuid":
+            return {column: numpy.frombuffer(b"".join(value.bytes for value in values), dtype="V16")}
+        if kind == "amount":
+            field = model._meta.get_field(column)
+            units = [base_units(value, field.decimal_places) for value in values]
+            if field.max_digits <= 18:
+                return {column: numpy.array(units, dtype=numpy.int64)}
+            return {
+                f'{column}_hi': numpy.array([unit // NUMPY_SPLIT for unit in units], dtype=numpy.int64),
+                f'{column}_lo': numpy.array([unit % NUMPY_SPLIT for unit in units], dtype=numpy.int64),
+            }
+        if kind == "timestamp":
+            return {column: numpy.array([utc(value) for value in values], dtype="datetime64[us]")}
+        field = model._meta.get_field(column)
+        return {column: numpy.array([value.encode("utf-8") for value in values], dtype=f'S{field.max_length}')}
+
+    def write(self, path, model, columns, rows):
+        tmp_path = f'{path}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for column, values in zip(columns, zip(*rows)):
+            for name, array in self.arrays(model, column, values).items():
+                numpy.save(os.path.join(tmp_path, f'{name}.npy'), array)
+        os.replace(tmp_path, path)
+
+
+def get_writer(export_format):
+    if export_format == "auto":
+        export_format = "arrow" if pyarrow is not None else "npy"
+
+    if export_format in ("arrow", "parquet"):
+        if pyarrow is None:
+            raise CommandError(f'The {export_format} format needs pyarrow, install it with: pip install pyarrow')
+        return export_format, ArrowWriter(parquet=export_format == "parquet")
+
+    if numpy is None:
+        raise CommandError("Exporting needs pyarrow or numpy, install one with: pip install pyarrow")
+    return export_format, NumpyWriter()
+
+
+def chunks(queryset, columns, chunk_size):
+    '''
+        - walks the queryset in primary key order, one query per chunk
+    '''
+    last_identifier = None
+    while True:
+        chunk = queryset
+        if last_identifier is not None:
+            chunk = chunk.filter(identifier__gt=last_identifier)
+        rows = list(chunk.order_by("identifier").values_list(*columns)[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_identifier = rows[-1][0]
+
+
+@contextlib.contextmanager
+def snapshot():
+    '''
+        - one transaction reading a single snapshot of the database: a transfer the archiver moves while
+          the export runs is read either from the live or from the archived table, never from both
+        - django runs mysql at READ COMMITTED, which reads every query from a new snapshot
+    '''
+    if connection.vendor == "mysql" and not connection.in_atomic_block:
+        with connection.cursor() as cursor:
+            # applies to the next transaction only
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    with transaction.atomic():
+        yield
+
+
+def _watermark_path(output):
+    return os.path.join(output, "watermark.json")
+
+
+def _load_watermark(output):
+    path = _watermark_path(output)
+    if not os.path.exists(path):
+        return None, None
+    with open(path) as watermark_file:
+        watermark = json.load(watermark_file)
+    return datetime.datetime.fromisoformat(watermark["created"]), watermark["format"]
+
+
+def _save_watermark(output, created, export_format):
+    # write to a temporary file first so a crash never leaves a torn watermark
+    path = _watermark_path(output)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, "w") as watermark_file:
+        json.dump({"created": created.isoformat(), "format": export_format}, watermark_file)
+    os.replace(tmp_path, path)
+
+
+def _stamp(moment):
+    return moment.strftime("%Y%m%dT%H%M%S%fZ") if moment is not None else "initial"
+
+
+class Command(BaseCommand):
+    help = "Exports transactions and wallet balances to columnar files for analytics"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Export directory, later runs append to it")
+        parser.add_argument("--chunk-size", type=int, default=50000, help="Rows per query and per file")
+        parser.add_argument(
+            "--format", choices=["auto", "arrow", "parquet", "npy"], default="auto",
+            help="Arrow IPC when pyarrow is installed, .npy files per column otherwise")
+        parser.add_argument(
+            "--lag", type=float, default=60,
+            help="Seconds behind now the export stops, transfers committed later than their created time "
+                 "are picked up by the next run")
+
+    def handle(self, *args, **options):
+        output = options["output"]
+        chunk_size = options["chunk_size"]
+        since, previous_format = _load_watermark(output)
+        export_format, writer = get_writer(options["format"])
+        if previous_format is not None and previous_format != export_format:
+            raise CommandError(
+                f'{output} holds a {previous_format} export, export to a new directory to change the format')
+
+        with snapshot():
+            until = timezone.now() - datetime.timedelta(seconds=options["lag"])
+            # rows are never exported twice, the export stops short of the oldest transaction still
+            # waiting for the processor and picks it up once it is settled
+            pending = Transaction.objects.filter(state="Unconfirmed", created__lte=until)
+            if since is not None:
+                pending = pending.filter(created__gt=since)
+            oldest_pending = pending.order_by("created").values_list("created", "identifier").first()
+            if oldest_pending is not None:
+                until = oldest_pending[0] - datetime.timedelta(microseconds=1)
+                self.stdout.write(f'Holding the export before {oldest_pending[0].isoformat()}, transaction '
+                                  f'{oldest_pending[1]} is not settled yet')
+            if since is not None and until <= since:
+                self.stdout.write("Nothing to export yet")
+                return
+
+            # transactions created in (since, until], appended to the earlier runs
+            transactions_dir = os.path.join(output, "transactions")
+            os.makedirs(transactions_dir, exist_ok=True)
+            prefix = f'part-{_stamp(since)}-'
+            for name in os.listdir(transactions_dir):
+                if name.startswith(prefix):
+                    # left over by an interrupted run over the same window, it is exported again
+                    path = os.path.join(transactions_dir, name)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+
+            part = 0
+            exported = 0
+            for table in ledger_tables:
+                queryset = table.objects.filter(created__lte=until, state__in=SETTLED_STATES)
+                if since is not None:
+                    queryset = queryset.filter(created__gt=since)
+                for rows in chunks(queryset, transaction_columns, chunk_size):
+                    writer.write(os.path.join(transactions_dir, f'{prefix}{part:06d}'), table, transaction_columns, rows)
+                    part += 1
+                    exported += len(rows)
+
+            # balances are a snapshot, every run writes all of them
+            wallets_exported = 0
+            for currency_type, WalletType in currency_types.items():
+                snapshot_dir = os.path.join(output, "wallets", currency_type.lower(), f'snapshot-{_stamp(until)}')
+                # written aside and renamed once complete, readers never see half a snapshot
+                tmp_dir = f'{snapshot_dir}.tmp'
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+                for part, rows in enumerate(chunks(WalletType.objects.all(), wallet_columns, chunk_size)):
+                    writer.write(os.path.join(tmp_dir, f'part-{part:06d}'), WalletType, wallet_columns, rows)
+                    wallets_exported += len(rows)
+                os.replace(tmp_dir, snapshot_dir)
+
+        _save_watermark(output, until, export_format)
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {exported} transactions created until {until.isoformat()} and {wallets_exported} '
+            f'wallet balances as {export_format} to {output}'))
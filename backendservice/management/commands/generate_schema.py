@@ -0,0 +1,20 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from analoguebailout.schema import generate_schema, write_schema
+
+
+class Command(BaseCommand):
+    help = "Writes the OpenAPI schema served at /schema.json, run it on every build"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output", default=settings.API_SCHEMA_PATH, help="Schema file, defaults to API_SCHEMA_PATH")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        schema = generate_schema()
+        write_schema(options["output"], schema)
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {len(schema)} bytes to {options["output"]} in {time.perf_counter() - started:.2f}s'))
@@ -0,0 +1,66 @@
+import os
+import sys
+import subprocess
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+
+
+def parse_importtime(output):
+    '''
+        :param output: what python -X importtime writes to stderr
+        :return: (self microseconds, cumulative microseconds, depth, module) per import, in import order
+    '''
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, module = line[len("import time:"):].split("|")
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((int(self_time), int(cumulative), depth, module.strip()))
+    return imports
+
+
+class Command(BaseCommand):
+    help = "Reports what importing an entry point costs, e.g. the transaction processor startup"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--module", default="transactionprocessor", help="Module to import")
+        parser.add_argument("--top", type=int, default=15, help="Rows of each table")
+        parser.add_argument(
+            "--module-settings",
+            help="DJANGO_SETTINGS_MODULE of the import, defaults to the one the module picks itself")
+
+    def handle(self, *args, **options):
+        module = options["module"]
+        # a fresh interpreter, nothing is imported yet; the module picks its own settings
+        env = dict(os.environ)
+        env.pop("DJANGO_SETTINGS_MODULE", None)
+        if options["module_settings"]:
+            env["DJANGO_SETTINGS_MODULE"] = options["module_settings"]
+        code = (f'import time; started = time.perf_counter(); import {module}; '
+                f'print(time.perf_counter() - started)')
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code], env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise CommandError(f'Importing {module} failed:\n{result.stderr[-2000:]}')
+
+        imports = parse_importtime(result.stderr)
+        elapsed = float(result.stdout.strip().splitlines()[-1])
+        # -X importtime itself slows imports down, the times below are relative, not absolute
+        self.stdout.write(
+            f'{module}: {len(imports)} modules imported, {elapsed * 1000:.0f}ms in total including '
+            f'the code run at import time (django.setup(), logging, sentry)')
+
+        top = options["top"]
+        # the direct imports of the module, what it pulls in and could defer
+        direct = [(cumulative, name) for _, cumulative, depth, name in imports if depth == 1]
+        self.stdout.write("\nslowest imports of the module, including what they import:")
+        for cumulative, name in sorted(direct, reverse=True)[:top]:
+            self.stdout.write(f'  {cumulative / 1000:8.1f}ms  {name}')
+
+        packages = Counter()
+        for self_time, _, _, name in imports:
+            packages[name.split(".")[0]] += self_time
+        self.stdout.write("\ntime spent per top level package:")
+        for package, self_time in packages.most_common(top):
+            self.stdout.write(f'  {self_time / 1000:8.1f}ms  {package}')
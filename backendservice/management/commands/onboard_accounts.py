@@ -0,0 +1,210 @@
+import os
+import csv
+import json
+import time
+import decimal
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.db import connections, transaction
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+
+from backendservice.models import User, BitcoinWallet, EthereumWallet
+from backendservice.versioning import bump, wallets_key
+from utils.gen_key_sign_verify import GenKeySignAndVerify
+from utils.validators import validate_required_data, validate_auth_data
+
+
+# a wallet is created for every currency whose balance column is filled in
+wallet_columns = {
+    "Bitcoin": ("bitcoin_balance", BitcoinWallet),
+    "Ethereum": ("ethereum_balance", EthereumWallet),
+}
+
+required_columns = ["name", "description", "email", "password", "max_amount_per_transaction"]
+
+
+def read_records(path, file_format):
+    '''
+        - yields every record of a csv file with a header line, or of a jsonl file
+    '''
+    with open(path, newline='') as records_file:
+        if file_format == "csv":
+            yield from csv.DictReader(records_file)
+        else:
+            for line in records_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def prepare_account(record):
+    '''
+        - the cpu bound part of an account, run on the process pool
+        :return: the password hash and a (private key, public key) pair per wallet
+    '''
+    keys = {
+        currency_type: GenKeySignAndVerify.generate_keys(settings.WALLET_DEFAULT_CURVE)
+        for currency_type, (column, _) in wallet_columns.items()
+        if record.get(column) not in (None, "")
+    }
+    return make_password(record["password"]), keys
+
+
+def validate_record(record):
+    '''
+        :return: the reason the record can't be onboarded, None when it is valid
+    '''
+    is_not_input_valid = validate_required_data(required_columns, record)
+    if is_not_input_valid is not record:
+        return is_not_input_valid["Message"]
+
+    try:
+        record["max_amount_per_transaction"] = decimal.Decimal(str(record["max_amount_per_transaction"]))
+        for column, _ in wallet_columns.values():
+            if record.get(column) not in (None, ""):
+                record[column] = decimal.Decimal(str(record[column]))
+                if record[column] < 0:
+                    return f'{column} can\'t be negative'
+    except decimal.InvalidOperation:
+        return "amounts must be numbers"
+
+    is_not_input_valid = validate_auth_data({**record, "password": str(record["password"])})
+    if is_not_input_valid is not None:
+        return is_not_input_valid["Message"]
+    return None
+
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)["records"]
+
+
+def _save_checkpoint(path, records):
+    # write to a temporary file first so a crash never leaves a torn checkpoint
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump({"records": records}, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = "Creates users and their wallets in bulk from a csv or jsonl file"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "path",
+            help=f'Accounts to create, with the columns {", ".join(required_columns)} '
+                 f'and optionally bitcoin_balance and ethereum_balance')
+        parser.add_argument(
+            "--format", choices=["csv", "jsonl"],
+            help="Format of the file, guessed from its extension by default")
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000,
+            help="Number of accounts inserted per database transaction")
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(),
+            help="Processes hashing passwords and generating keys")
+        parser.add_argument(
+            "--checkpoint",
+            help="File recording the progress used to resume an interrupted run, defaults to <path>.onboard.json")
+        parser.add_argument(
+            "--reset", action="store_true",
+            help="Discard the checkpoint and start from the first record")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist')
+
+        file_format = options["format"] or ("csv" if path.endswith(".csv") else "jsonl")
+        checkpoint_path = options["checkpoint"] or f'{path}.onboard.json'
+        if options["reset"] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        done = _load_checkpoint(checkpoint_path)
+        if done:
+            self.stdout.write(f'Resuming after {done} records')
+
+        records = enumerate(read_records(path, file_format), start=1)
+        records = itertools.islice(records, done, None)
+
+        # forked workers must not share the parent's database connections
+        connections.close_all()
+
+        self.workers = options["workers"]
+        created = skipped = 0
+        started = time.monotonic()
+        mp_context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context) as executor:
+            while True:
+                chunk = list(itertools.islice(records, options["chunk_size"]))
+                if not chunk:
+                    break
+
+                chunk_created, chunk_skipped = self.onboard_chunk(chunk, executor)
+                created += chunk_created
+                skipped += chunk_skipped
+                done = chunk[-1][0]
+                _save_checkpoint(checkpoint_path, done)
+
+                rate = (created + skipped) / (time.monotonic() - started)
+                self.stdout.write(f'{done} records read, {created} accounts created, {skipped} skipped, {rate:.0f} records/s')
+
+        # the run is complete, the next one has to start from the beginning
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        self.stdout.write(self.style.SUCCESS(f'Onboarded {created} accounts, skipped {skipped}'))
+
+    def onboard_chunk(self, chunk, executor):
+        '''
+            - validates a chunk of records, prepares them on the process pool and inserts them
+              in one database transaction
+            - records whose email already exists are skipped, which also makes a chunk
+              committed just before a crash safe to replay
+            :return: the number of created and skipped accounts
+        '''
+        valid = {}
+        for line, record in chunk:
+            reason = validate_record(record)
+            if reason is not None:
+                self.stdout.write(self.style.WARNING(f'  record {line} skipped: {reason}'))
+                continue
+            record["email"] = User.objects.normalize_email(record["email"])
+            # the first record of an email wins
+            valid.setdefault(record["email"], record)
+
+        existing = set(User.objects.filter(email__in=list(valid)).values_list("email", flat=True))
+        records = [record for email, record in valid.items() if email not in existing]
+        accounts = executor.map(prepare_account, records, chunksize=max(1, len(records) // (4 * self.workers)))
+
+        users = []
+        wallets = {currency_type: [] for currency_type in wallet_columns}
+        for record, (password, keys) in zip(records, accounts):
+            user = User(
+                name=record["name"],
+                description=record["description"],
+                email=record["email"],
+                max_amount_per_transaction=record["max_amount_per_transaction"],
+                password=password,
+            )
+            users.append(user)
+
+            for currency_type, (private_key, public_key) in keys.items():
+                column, WalletType = wallet_columns[currency_type]
+                wallets[currency_type].append(WalletType(
+                    user=user, private_key=private_key, public_key=public_key, curve=settings.WALLET_DEFAULT_CURVE,
+                    balance=record[column], opening_balance=record[column]))
+
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+            for currency_type, currency_wallets in wallets.items():
+                _, WalletType = wallet_columns[currency_type]
+                WalletType.objects.bulk_create(currency_wallets)
+                bump(*{wallets_key(currency_type, wallet.user_id) for wallet in currency_wallets})
+
+        return len(users), len(chunk) - len(users)
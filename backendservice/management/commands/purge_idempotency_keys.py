@@ -0,0 +1,31 @@
+import datetime
+from django.conf import settings
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from backendservice.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Deletes idempotency keys older than IDEMPOTENCY_KEY_TTL hours, run it on a schedule"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours", type=float, default=settings.IDEMPOTENCY_KEY_TTL,
+            help="Delete keys created more than this many hours ago")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of keys deleted per query")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(hours=options["hours"])
+
+        deleted = 0
+        while True:
+            identifiers = list(IdempotencyKey.objects.filter(created__lt=cutoff).values_list(
+                "identifier", flat=True)[:options["batch_size"]])
+            if not identifiers:
+                break
+            deleted += IdempotencyKey.objects.filter(identifier__in=identifiers).delete()[0]
+
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} idempotency keys created before {cutoff}'))
@@ -0,0 +1,226 @@
+import os
+import json
+import decimal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from django.db import connections, transaction
+from django.db.models import Sum
+from django.core.management.base import BaseCommand
+
+from backendservice.models import BitcoinWallet, EthereumWallet, Transaction, ArchivedTransaction
+
+
+currency_types = {
+    "Bitcoin": BitcoinWallet,
+    "Ethereum": EthereumWallet
+}
+
+# the ledger spans the live and the archived transactions, scanned in this order
+ledger_tables = [Transaction, ArchivedTransaction]
+
+
+def _checkpoint_path(checkpoint_dir, currency_type):
+    return os.path.join(checkpoint_dir, f'{currency_type.lower()}.json')
+
+
+def _load_checkpoint(path):
+    if not os.path.exists(path):
+        return Transaction.__name__, None, {}
+
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+
+    flows = {user: decimal.Decimal(amount) for user, amount in checkpoint["flows"].items()}
+    # checkpoints written before the archive existed only covered Transaction
+    return checkpoint.get("table", Transaction.__name__), checkpoint["last_identifier"], flows
+
+
+def _save_checkpoint(path, table, last_identifier, flows):
+    # write to a temporary file first so a crash never leaves a torn checkpoint
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump({
+            "table": table,
+            "last_identifier": last_identifier,
+            "flows": {user: str(amount) for user, amount in flows.items()},
+        }, checkpoint_file)
+    os.replace(tmp_path, path)
+
+
+def _confirmed_transactions(currency_type, table=Transaction):
+    return table.objects.filter(currency_type=currency_type, state="Confirmed").order_by("identifier")
+
+
+def _chunk_bounds(table, currency_type, last_identifier, chunk_size):
+    '''
+        - walks the confirmed transactions of a ledger table in primary key order
+        - yields the (exclusive, inclusive] identifier range of each chunk
+    '''
+    queryset = _confirmed_transactions(currency_type, table)
+    while True:
+        chunk = queryset if last_identifier is None else queryset.filter(identifier__gt=last_identifier)
+        identifiers = list(chunk.values_list("identifier", flat=True)[:chunk_size])
+        if not identifiers:
+            return
+        yield last_identifier, str(identifiers[-1])
+        last_identifier = str(identifiers[-1])
+
+
+def _net_flows(queryset):
+    '''
+        - aggregates the money received minus the money sent per user with GROUP BY
+    '''
+    flows = {}
+    received = queryset.values("target_user").annotate(total=Sum("amount")).order_by()
+    for row in received:
+        user = str(row["target_user"])
+        flows[user] = flows.get(user, decimal.Decimal(0)) + row["total"]
+
+    sent = queryset.values("source_user").annotate(total=Sum("amount")).order_by()
+    for row in sent:
+        user = str(row["source_user"])
+        flows[user] = flows.get(user, decimal.Decimal(0)) - row["total"]
+    return flows
+
+
+def _expected_balance(wallet, flow):
+    exponent = decimal.Decimal(1).scaleb(-wallet._meta.get_field("balance").decimal_places)
+    return (wallet.opening_balance + flow).quantize(exponent)
+
+
+def _drifted_wallets(currency_type, flows, tolerance):
+    WalletType = currency_types[currency_type]
+    drifted = []
+    unbaselined = 0
+
+    for wallet in WalletType.objects.all().iterator():
+        if wallet.opening_balance is None:
+            unbaselined += 1
+            continue
+
+        flow = flows.get(str(wallet.user_id), decimal.Decimal(0))
+        expected = _expected_balance(wallet, flow)
+        if abs(wallet.balance - expected) > tolerance:
+            # the processor may have moved money while we were scanning, so
+            # recompute this one wallet from scratch before calling it drift,
+            # in one transaction so a row being archived is seen in exactly one table
+            with transaction.atomic():
+                wallet.refresh_from_db()
+                flow = decimal.Decimal(0)
+                for table in ledger_tables:
+                    user_transactions = _confirmed_transactions(currency_type, table).filter(
+                        source_user=wallet.user_id) | _confirmed_transactions(currency_type, table).filter(
+                        target_user=wallet.user_id)
+                    flow += _net_flows(user_transactions).get(str(wallet.user_id), decimal.Decimal(0))
+            expected = _expected_balance(wallet, flow)
+            if abs(wallet.balance - expected) > tolerance:
+                drifted.append({
+                    "user": str(wallet.user_id),
+                    "wallet": str(wallet.identifier),
+                    "balance": str(wallet.balance),
+                    "expected": str(expected),
+                    "drift": str(wallet.balance - expected),
+                })
+    return drifted, unbaselined
+
+
+def reconcile_currency(currency_type, chunk_size, checkpoint_dir, tolerance):
+    '''
+        - streams the live then the archived confirmed transactions of one currency in primary key chunks
+        - checkpoints the running per-user net flows after every chunk
+        - compares the flows against the wallet balances
+    '''
+    checkpoint_path = _checkpoint_path(checkpoint_dir, currency_type)
+    checkpoint_table, last_identifier, flows = _load_checkpoint(checkpoint_path)
+    table_names = [table.__name__ for table in ledger_tables]
+    chunks = 0
+
+    for table in ledger_tables[table_names.index(checkpoint_table):]:
+        if table.__name__ != checkpoint_table:
+            last_identifier = None
+
+        for lower, upper in _chunk_bounds(table, currency_type, last_identifier, chunk_size):
+            chunk = _confirmed_transactions(currency_type, table).filter(identifier__lte=upper)
+            if lower is not None:
+                chunk = chunk.filter(identifier__gt=lower)
+
+            for user, flow in _net_flows(chunk).items():
+                flows[user] = flows.get(user, decimal.Decimal(0)) + flow
+
+            _save_checkpoint(checkpoint_path, table.__name__, upper, flows)
+            chunks += 1
+
+    drifted, unbaselined = _drifted_wallets(currency_type, flows, tolerance)
+
+    # the run is complete, the next one has to start from the beginning
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    return {
+        "currency_type": currency_type,
+        "chunks": chunks,
+        "drifted": drifted,
+        "unbaselined": unbaselined,
+    }
+
+
+class Command(BaseCommand):
+    help = "Reconciles wallet balances against the confirmed transactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--currency", action="append", choices=list(currency_types),
+            help="Currency to reconcile, can be repeated. Defaults to all currencies")
+        parser.add_argument(
+            "--chunk-size", type=int, default=10000,
+            help="Number of transactions aggregated per query")
+        parser.add_argument(
+            "--checkpoint-dir", default=".reconcile",
+            help="Directory holding the checkpoints used to resume an interrupted run")
+        parser.add_argument(
+            "--reset", action="store_true",
+            help="Discard existing checkpoints and start from the first transaction")
+        parser.add_argument(
+            "--tolerance", type=decimal.Decimal, default=decimal.Decimal(0),
+            help="Absolute difference between balance and ledger still considered reconciled")
+
+    def handle(self, *args, **options):
+        currencies = options["currency"] or list(currency_types)
+        checkpoint_dir = options["checkpoint_dir"]
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        if options["reset"]:
+            for currency_type in currencies:
+                checkpoint_path = _checkpoint_path(checkpoint_dir, currency_type)
+                if os.path.exists(checkpoint_path):
+                    os.remove(checkpoint_path)
+
+        # forked workers must open their own database connections
+        connections.close_all()
+
+        mp_context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=len(currencies), mp_context=mp_context) as executor:
+            futures = [
+                executor.submit(reconcile_currency, currency_type, options["chunk_size"],
+                                checkpoint_dir, options["tolerance"])
+                for currency_type in currencies
+            ]
+            results = [future.result() for future in futures]
+
+        total_drifted = 0
+        for result in results:
+            self.stdout.write(
+                f'{result["currency_type"]}: scanned {result["chunks"]} chunks, '
+                f'{len(result["drifted"])} drifted wallets, '
+                f'{result["unbaselined"]} wallets without an opening balance')
+
+            for wallet in result["drifted"]:
+                self.stdout.write(self.style.WARNING(
+                    f'  wallet {wallet["wallet"]} of {wallet["user"]}: balance {wallet["balance"]}, '
+                    f'ledger {wallet["expected"]}, drift {wallet["drift"]}'))
+            total_drifted += len(result["drifted"])
+
+        if total_drifted:
+            self.stdout.write(self.style.ERROR(f'{total_drifted} wallets drifted from the ledger'))
+        else:
+            self.stdout.write(self.style.SUCCESS("All wallets match the ledger"))
@@ -0,0 +1,246 @@
+import re
+import json
+import time
+import datetime
+from django.conf import settings
+from django.test import override_settings
+from django.test.utils import setup_databases, teardown_databases
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from utils.producer import local_queue, transaction_producer
+from utils.gen_key_sign_verify import GenKeySignAndVerify
+from backendservice.models import User, BitcoinWallet, EthereumWallet
+from backendservice.views import TransactionsAPIView
+from backendservice.serializers import TransactionsSerializer
+
+
+currency_types = {
+    "Bitcoin": BitcoinWallet,
+    "Ethereum": EthereumWallet
+}
+
+# 2021-04-08 22:59:44,809 - Bitcoin transaction of value 0.5 BTC from <uuid> to <uuid> ...
+log_line_regex = re.compile(
+    r'^(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) - (?P<currency_type>\w+) transaction of value '
+    r'(?P<amount>[\d.]+) \w+ from (?P<source_user>[0-9a-f-]{36}) to (?P<target_user>[0-9a-f-]{36})'
+)
+
+
+def read_transactions_log(path):
+    '''
+        - parses the transfers recorded by the transaction processor log
+    '''
+    transfers = []
+    with open(path) as log_file:
+        for line in log_file:
+            match = log_line_regex.match(line.strip())
+            if not match:
+                continue
+            timestamp = datetime.datetime.strptime(match["timestamp"], "%Y-%m-%d %H:%M:%S,%f")
+            transfers.append({
+                "timestamp": timestamp.timestamp(),
+                "currency_type": match["currency_type"],
+                "amount": match["amount"],
+                "source_user": match["source_user"],
+                "target_user": match["target_user"],
+            })
+    return transfers
+
+
+def read_recorded_requests(path):
+    '''
+        - parses recorded api requests, one json object per line:
+          {"timestamp": 1617922784.8, "method": "POST", "path": "/api/transaction/",
+           "user": "<uuid>", "body": {"target_user": "<uuid>", "currency_type": "Bitcoin", "amount": "0.5"}}
+        - only transaction submissions are replayed, every other line is skipped
+    '''
+    transfers = []
+    with open(path) as requests_file:
+        for line in requests_file:
+            try:
+                recorded = json.loads(line)
+                if recorded.get("method") != "POST" or not recorded.get("path", "").rstrip("/").endswith("transaction"):
+                    continue
+                body = recorded["body"]
+                transfers.append({
+                    "timestamp": float(recorded.get("timestamp", 0)),
+                    "currency_type": body["currency_type"],
+                    "amount": str(body["amount"]),
+                    "source_user": recorded["user"],
+                    "target_user": body["target_user"],
+                })
+            except (ValueError, KeyError, TypeError, AttributeError):
+                continue
+    return transfers
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Command(BaseCommand):
+    help = "Replays recorded transfers against a disposable database to measure throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", help="Recorded api requests in jsonl format")
+        parser.add_argument("--transactions-log", help="Log written by the transaction processor")
+        parser.add_argument(
+            "--stage", choices=["api", "processor", "both"], default="both",
+            help="Which part of the pipeline the transfers are fed through")
+        parser.add_argument(
+            "--speed", type=float, default=0,
+            help="Real-time scale factor, 2 replays twice as fast as recorded. 0 replays as fast as possible")
+        parser.add_argument("--repeat", type=int, default=1, help="Number of times the recording is replayed")
+        parser.add_argument("--window", type=int, default=100, help="Number of transfers per latency window")
+        parser.add_argument(
+            "--degradation-factor", type=float, default=2.0,
+            help="Latency is considered degraded once a window's p95 exceeds the first window's p95 by this factor")
+        parser.add_argument(
+            "--seed-balance", default="1000000",
+            help="Balance given to every wallet created for the replay")
+
+    def handle(self, *args, **options):
+        transfers = []
+        if options["requests"]:
+            transfers += read_recorded_requests(options["requests"])
+        if options["transactions_log"]:
+            transfers += read_transactions_log(options["transactions_log"])
+        if not transfers:
+            raise CommandError("Nothing to replay, pass --requests and/or --transactions-log")
+        transfers.sort(key=lambda transfer: transfer["timestamp"])
+
+        # keep the replay from writing into the production transactions log
+        from transactionprocessor import TransactionProcessor, logger as processor_logger
+        processor_logger.disabled = True
+
+        self.stdout.write("Creating a disposable database")
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(TRANSACTION_TRANSPORT="local"):
+                users = self.seed(transfers, options["seed_balance"])
+                latencies = self.replay(transfers, users, TransactionProcessor(), options)
+        finally:
+            local_queue.clear()
+            teardown_databases(old_config, verbosity=0)
+
+        for stage, stage_latencies in latencies.items():
+            self.report(stage, stage_latencies, options["window"], options["degradation_factor"])
+
+    def seed(self, transfers, seed_balance):
+        '''
+            - creates every user seen in the recording with a funded wallet per currency
+        '''
+        users = {}
+        for transfer in transfers:
+            for user_identifier in (transfer["source_user"], transfer["target_user"]):
+                if user_identifier in users:
+                    continue
+                user = User.objects.create(
+                    identifier=user_identifier,
+                    name=f'replay-{user_identifier}',
+                    description="replay user",
+                    email=f'{user_identifier}@replay.local',
+                    max_amount_per_transaction=seed_balance,
+                )
+                for WalletType in currency_types.values():
+                    private_key, public_key = GenKeySignAndVerify.generate_keys(settings.WALLET_DEFAULT_CURVE)
+                    WalletType.objects.create(
+                        user=user, private_key=private_key, public_key=public_key,
+                        curve=settings.WALLET_DEFAULT_CURVE, balance=seed_balance, opening_balance=seed_balance)
+                users[user_identifier] = user
+        return users
+
+    def replay(self, transfers, users, processor, options):
+        view = TransactionsAPIView.as_view()
+        factory = APIRequestFactory()
+        latencies = {"api": [], "processor": []}
+        stage = options["stage"]
+        speed = options["speed"]
+
+        first_timestamp = transfers[0]["timestamp"]
+        started = time.perf_counter()
+
+        for _ in range(options["repeat"]):
+            for transfer in transfers:
+                if speed:
+                    # scaled real-time, wait until the transfer is due
+                    due = (transfer["timestamp"] - first_timestamp) / speed
+                    delay = due - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                if stage in ("api", "both"):
+                    request = factory.post("/api/transaction/", {
+                        "target_user": transfer["target_user"],
+                        "currency_type": transfer["currency_type"],
+                        "amount": transfer["amount"],
+                    }, format="json")
+                    force_authenticate(request, user=users[transfer["source_user"]])
+
+                    request_started = time.perf_counter()
+                    view(request)
+                    latencies["api"].append(time.perf_counter() - request_started)
+                else:
+                    self.enqueue_signed(transfer, users)
+
+                if stage in ("processor", "both"):
+                    while local_queue:
+                        body = local_queue.popleft()
+                        message_started = time.perf_counter()
+                        processor.processor(body)
+                        latencies["processor"].append(time.perf_counter() - message_started)
+                else:
+                    local_queue.clear()
+
+            # later rounds start their clock again
+            started = time.perf_counter()
+
+        return {stage_name: values for stage_name, values in latencies.items() if values}
+
+    def enqueue_signed(self, transfer, users):
+        '''
+            - builds the message the api would have published, without going through the api
+        '''
+        WalletType = currency_types[transfer["currency_type"]]
+        source_wallet = WalletType.objects.get(user=transfer["source_user"])
+        data = {
+            "target_user": transfer["target_user"],
+            "currency_type": transfer["currency_type"],
+            "amount": transfer["amount"],
+            "source_user": transfer["source_user"],
+        }
+        data["signature"] = GenKeySignAndVerify.sign_transaction(source_wallet.private_key, data, source_wallet.curve)
+        serializer = TransactionsSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        payload = serializer.data
+        payload["source_user"] = str(payload["source_user"])
+        payload["target_user"] = str(payload["target_user"])
+        transaction_producer(payload)
+
+    def report(self, stage, latencies, window, degradation_factor):
+        total = sum(latencies)
+        self.stdout.write(
+            f'{stage}: {len(latencies)} transfers, {len(latencies) / total:.1f} transfers/s, '
+            f'p50 {percentile(latencies, 0.5) * 1000:.2f}ms, p95 {percentile(latencies, 0.95) * 1000:.2f}ms, '
+            f'p99 {percentile(latencies, 0.99) * 1000:.2f}ms')
+
+        baseline = None
+        for start in range(0, len(latencies), window):
+            window_latencies = latencies[start:start + window]
+            p95 = percentile(window_latencies, 0.95)
+            self.stdout.write(
+                f'  transfers {start}-{start + len(window_latencies)}: '
+                f'{len(window_latencies) / sum(window_latencies):.1f} transfers/s, p95 {p95 * 1000:.2f}ms')
+
+            if baseline is None:
+                baseline = p95
+            elif p95 > baseline * degradation_factor:
+                self.stdout.write(self.style.WARNING(
+                    f'  {stage} latency degraded after {start} transfers '
+                    f'(p95 {p95 * 1000:.2f}ms against {baseline * 1000:.2f}ms at the start)'))
+                return
+
+        self.stdout.write(self.style.SUCCESS(f'  {stage} latency did not degrade'))
@@ -0,0 +1,59 @@
+from django.db import transaction
+from django.db.models import Q, Exists, OuterRef
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from backendservice.models import WalletCheckpoint
+from backendservice.checkpoints import currency_types, ledger_tables, write_checkpoint, NO_TRANSACTION
+
+
+def last_transfer(user, currency_type):
+    '''
+        :return: (processed, identifier) of the user's last confirmed transfer, live or archived, None without any
+    '''
+    positions = []
+    for table in ledger_tables:
+        position = table.objects.filter(
+            Q(source_user=user) | Q(target_user=user), currency_type=currency_type, state="Confirmed").order_by(
+            "-processed", "-identifier").values_list("processed", "identifier").first()
+        if position is not None:
+            positions.append(position)
+    return max(positions) if positions else None
+
+
+def checkpoint_wallet(WalletType, currency_type, identifier):
+    with transaction.atomic():
+        # the processor confirms no transfer of the wallet until the checkpoint is written
+        wallet = WalletType.objects.select_for_update().get(identifier=identifier)
+        position = last_transfer(wallet.user_id, currency_type)
+        if position is None:
+            # nothing transferred yet, the balance is the one the wallet was created with
+            position = (timezone.now(), NO_TRANSACTION)
+        write_checkpoint(wallet, currency_type, *position)
+        wallet.save(update_fields=["transfers_since_checkpoint"])
+
+
+class Command(BaseCommand):
+    help = "Checkpoints the balance of wallets with transfers since their last checkpoint, run it on a schedule"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-transfers", type=int, default=1,
+            help="Checkpoint wallets with at least this many transfers since their last checkpoint")
+
+    def handle(self, *args, **options):
+        written = 0
+        for currency_type, WalletType in currency_types.items():
+            checkpointed = WalletCheckpoint.objects.filter(user=OuterRef("user"), currency_type=currency_type)
+            # wallets never checkpointed get their first one whatever their number of transfers
+            identifiers = WalletType.objects.filter(
+                Q(transfers_since_checkpoint__gte=options["min_transfers"]) | ~Exists(checkpointed)).values_list(
+                "identifier", flat=True)
+            count = 0
+            for identifier in list(identifiers):
+                checkpoint_wallet(WalletType, currency_type, identifier)
+                count += 1
+            self.stdout.write(f'{currency_type}: {count} checkpoints written')
+            written += count
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} wallet checkpoints'))
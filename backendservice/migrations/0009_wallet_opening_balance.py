@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendservice', '0008_auto_20210404_1716'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bitcoinwallet',
+            name='opening_balance',
+            field=models.DecimalField(decimal_places=8, max_digits=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='ethereumwallet',
+            name='opening_balance',
+            field=models.DecimalField(decimal_places=18, max_digits=26, null=True),
+        ),
+    ]
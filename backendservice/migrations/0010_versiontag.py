@@ -0,0 +1,20 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendservice', '0009_wallet_opening_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionTag',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:34
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendservice', '0010_versiontag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTransactionAggregate',
+            fields=[
+                ('identifier', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('currency_type', models.CharField(choices=[('Bitcoin', 'Bitcoin'), ('Ethereum', 'Ethereum')], max_length=8)),
+                ('day', models.DateField()),
+                ('sent_amount', models.DecimalField(decimal_places=18, default=0, max_digits=36)),
+                ('sent_count', models.PositiveIntegerField(default=0)),
+                ('received_amount', models.DecimalField(decimal_places=18, default=0, max_digits=36)),
+                ('received_count', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_aggregates', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'currency_type', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:35
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendservice', '0011_dailytransactionaggregate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTransaction',
+            fields=[
+                ('identifier', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('amount', models.DecimalField(decimal_places=18, max_digits=26)),
+                ('currency_type', models.CharField(choices=[('Bitcoin', 'Bitcoin'), ('Ethereum', 'Ethereum')], max_length=8)),
+                ('signature', models.CharField(max_length=255)),
+                ('created', models.DateTimeField()),
+                ('processed', models.DateTimeField(null=True)),
+                ('state', models.CharField(choices=[('Unconfirmed', 'Unconfirmed'), ('Confirmed', 'Confirmed'), ('Rejected', 'Rejected')], max_length=11)),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now)),
+                ('source_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_source', to=settings.AUTH_USER_MODEL)),
+                ('target_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_target', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='created',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.CreateModel(
+            name='ArchivedTransactionHistory',
+            fields=[
+                ('identifier', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='history', to='backendservice.archivedtransaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_history', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendservice', '0012_transaction_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bitcoinwallet',
+            name='curve',
+            field=models.CharField(choices=[('NIST192p', 'NIST192p'), ('NIST256p', 'NIST256p'), ('SECP256k1', 'SECP256k1'), ('Ed25519', 'Ed25519')], default='NIST192p', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='ethereumwallet',
+            name='curve',
+            field=models.CharField(choices=[('NIST192p', 'NIST192p'), ('NIST256p', 'NIST256p'), ('SECP256k1', 'SECP256k1'), ('Ed25519', 'Ed25519')], default='NIST192p', max_length=16),
+        ),
+    ]
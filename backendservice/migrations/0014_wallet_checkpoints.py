@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendservice', '0013_wallet_curve'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bitcoinwallet',
+            name='transfers_since_checkpoint',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ethereumwallet',
+            name='transfers_since_checkpoint',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='WalletCheckpoint',
+            fields=[
+                ('identifier', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('currency_type', models.CharField(choices=[('Bitcoin', 'Bitcoin'), ('Ethereum', 'Ethereum')], max_length=8)),
+                ('balance', models.DecimalField(decimal_places=18, max_digits=26)),
+                ('processed', models.DateTimeField()),
+                ('transaction', models.UUIDField()),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='wallet_checkpoints', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='walletcheckpoint',
+            index=models.Index(fields=['user', 'currency_type', 'processed'], name='backendserv_user_id_03cbf6_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:18
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backendservice', '0015_idempotency_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='reserved',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -6,7 +6,15 @@ from django.contrib.auth.models import (
     BaseUserManager,
 )
 from django.core.validators import MinValueValidator
-from rest_framework_simplejwt.tokens import RefreshToken
+
+
+# signature curves of wallet keys, see utils/gen_key_sign_verify.py
+WalletCurve = [
+    ("NIST192p", "NIST192p"),
+    ("NIST256p", "NIST256p"),
+    ("SECP256k1", "SECP256k1"),
+    ("Ed25519", "Ed25519"),
+]
 
 
 class UserManager(BaseUserManager):
@@ -58,6 +66,9 @@ class User(AbstractBaseUser):
         return self.name
 
     def tokens(self):
+        # imported here, the processors load the models but never mint tokens
+        from rest_framework_simplejwt.tokens import RefreshToken
+
         refresh = RefreshToken.for_user(self)
         return {
             'refresh': str(refresh),
@@ -73,6 +84,12 @@ class BitcoinWallet(models.Model):
     balance = models.DecimalField(
         validators=[MinValueValidator(0)], default=0.0, max_digits=16, decimal_places=8
     )
+    # balance the wallet was created with, the baseline for ledger reconciliation
+    opening_balance = models.DecimalField(null=True, max_digits=16, decimal_places=8)
+    # signature curve of the keys, wallets created before curves were selectable use NIST192p
+    curve = models.CharField(max_length=16, choices=WalletCurve, default="NIST192p")
+    # confirmed transfers since the last balance checkpoint of the wallet
+    transfers_since_checkpoint = models.PositiveIntegerField(default=0)
 
     def __str__(self) -> str:
         return self.public_key
@@ -86,6 +103,12 @@ class EthereumWallet(models.Model):
     balance = models.DecimalField(
         validators=[MinValueValidator(0)], default=0.0, max_digits=26, decimal_places=18
     )
+    # balance the wallet was created with, the baseline for ledger reconciliation
+    opening_balance = models.DecimalField(null=True, max_digits=26, decimal_places=18)
+    # signature curve of the keys, wallets created before curves were selectable use NIST192p
+    curve = models.CharField(max_length=16, choices=WalletCurve, default="NIST192p")
+    # confirmed transfers since the last balance checkpoint of the wallet
+    transfers_since_checkpoint = models.PositiveIntegerField(default=0)
 
     def __str__(self) -> str:
         return self.public_key
@@ -116,7 +139,8 @@ class Transaction(models.Model):
         User, on_delete=models.CASCADE, related_name="target"
     )
     signature = models.CharField(max_length=255)
-    created = models.DateTimeField(default=timezone.now)
+    # indexed for the archival cutoff scans
+    created = models.DateTimeField(default=timezone.now, db_index=True)
     processed = models.DateTimeField(null=True)
     state = models.CharField(max_length=11, choices=State, default="Unconfirmed")
 
@@ -133,3 +157,104 @@ class TransactionHistory(models.Model):
 
     def __str__(self) -> str:
         return self.identifier
+
+
+class ArchivedTransaction(models.Model):
+    # settled transactions moved out of Transaction by the archive_transactions command,
+    # same fields and identifiers as the original rows
+    identifier = models.UUIDField(primary_key=True, editable=False)
+    amount = models.DecimalField(max_digits=26, decimal_places=18)
+    currency_type = models.CharField(max_length=8, choices=Transaction.CurrencyType)
+    source_user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="archived_source"
+    )
+    target_user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="archived_target"
+    )
+    signature = models.CharField(max_length=255)
+    created = models.DateTimeField()
+    processed = models.DateTimeField(null=True)
+    state = models.CharField(max_length=11, choices=Transaction.State)
+    archived = models.DateTimeField(default=timezone.now)
+
+    def __str__(self) -> str:
+        return str(self.identifier)
+
+
+class ArchivedTransactionHistory(models.Model):
+    identifier = models.UUIDField(primary_key=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="archived_history")
+    transaction = models.ForeignKey(
+        ArchivedTransaction, on_delete=models.CASCADE, related_name="history"
+    )
+
+    def __str__(self) -> str:
+        return str(self.identifier)
+
+
+class DailyTransactionAggregate(models.Model):
+    # confirmed transfers of a user in one currency on one day, kept up to date by the processor
+    identifier = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="daily_aggregates")
+    currency_type = models.CharField(max_length=8, choices=Transaction.CurrencyType)
+    day = models.DateField()
+    sent_amount = models.DecimalField(default=0, max_digits=36, decimal_places=18)
+    sent_count = models.PositiveIntegerField(default=0)
+    received_amount = models.DecimalField(default=0, max_digits=36, decimal_places=18)
+    received_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [("user", "currency_type", "day")]
+
+    def __str__(self) -> str:
+        return f'{self.user_id} {self.currency_type} {self.day}'
+
+
+class WalletCheckpoint(models.Model):
+    # balance of a wallet right after a confirmed transfer, statements replay forward from the nearest one
+    identifier = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="wallet_checkpoints")
+    currency_type = models.CharField(max_length=8, choices=Transaction.CurrencyType)
+    balance = models.DecimalField(max_digits=26, decimal_places=18)
+    # position of the last transfer included, transfers are ordered by (processed, identifier)
+    processed = models.DateTimeField()
+    # not a foreign key, the transaction moves to the archive at some point
+    transaction = models.UUIDField()
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "currency_type", "processed"])]
+
+    def __str__(self) -> str:
+        return f'{self.user_id} {self.currency_type} {self.processed}'
+
+
+class IdempotencyKey(models.Model):
+    # Idempotency-Key of a request, retries with the same key get the response of the first request
+    identifier = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="idempotency_keys")
+    key = models.CharField(max_length=255)
+    # sha256 of the request body, a key reused for a different request is refused
+    fingerprint = models.CharField(max_length=64)
+    # both null while the first request is in progress
+    status = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True)
+    # when the request in progress took the key, a retry takes over a reservation older
+    # than IDEMPOTENCY_KEY_LEASE seconds, its request is assumed dead
+    reserved = models.DateTimeField(default=timezone.now)
+    # indexed for the purge scans
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        unique_together = [("user", "key")]
+
+    def __str__(self) -> str:
+        return f'{self.user_id} {self.key}'
+
+
+class VersionTag(models.Model):
+    # bumped after every change to the data behind a cached read, see backendservice/versioning.py
+    key = models.CharField(primary_key=True, max_length=64)
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return f'{self.key}:{self.version}'
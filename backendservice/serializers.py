@@ -1,12 +1,14 @@
 from typing import Dict, Union, List
 from django.db import transaction
-from django.contrib import auth
 from rest_framework import serializers
 from rest_framework.exceptions import AuthenticationFailed
 from sentry_sdk import capture_exception
 
 
-from backendservice.models import User, BitcoinWallet, EthereumWallet, Transaction, TransactionHistory
+from backendservice.models import (User, BitcoinWallet, EthereumWallet, Transaction, TransactionHistory,
+                                   DailyTransactionAggregate)
+from backendservice.versioning import bump, wallets_key, transaction_keys
+from utils.passwords import authenticate
 from utils.validators import validate_required_data, validate_auth_data
 
 
@@ -82,12 +84,8 @@ class UserLoginSerializer(serializers.ModelSerializer):
         ]
 
     def get_tokens(self, obj):
-        user = User.objects.get(email=obj['email'])
-
-        return {
-            'refresh': user.tokens()['refresh'],
-            'access': user.tokens()['access']
-        }
+        # minted once by validate
+        return obj['tokens']
 
     def validate(self, data: Dict[str, str]) -> Dict[str, str]:
         """
@@ -103,7 +101,8 @@ class UserLoginSerializer(serializers.ModelSerializer):
         if is_not_input_valid is not None:
             raise serializers.ValidationError(is_not_input_valid["Message"])
 
-        user: Union[User, None] = auth.authenticate(email=email, password=password)
+        # the password check runs on the bounded hashing pool
+        user: Union[User, None] = authenticate(email=email, password=password)
 
         if not user:
             raise AuthenticationFailed("Invalid credetials, try again")
@@ -112,7 +111,7 @@ class UserLoginSerializer(serializers.ModelSerializer):
             'name': user.name,
             'identifier': user.identifier,
             'max_amount_per_transaction': user.max_amount_per_transaction,
-            'tokens': user.tokens,
+            'tokens': user.tokens(),
         }
 
 
@@ -127,8 +126,8 @@ class BitcoinWalletSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = BitcoinWallet
-        extra_kwargs = {"private_key": {"write_only": True}, "user": {"write_only": True}}
-        fields = ["identifier", "public_key", "private_key", "balance", "user", "owner"]
+        extra_kwargs = {"private_key": {"write_only": True}, "user": {"write_only": True}, "curve": {"write_only": True}}
+        fields = ["identifier", "public_key", "private_key", "curve", "balance", "user", "owner"]
 
     def validate(
         self, data: Dict[str, Union[str, float]]
@@ -156,7 +155,9 @@ class BitcoinWalletSerializer(serializers.ModelSerializer):
         try:
 
             with transaction.atomic():
+                validated_data["opening_balance"] = validated_data.get("balance", 0)
                 bitcoin_wallet: BitcoinWallet = BitcoinWallet.objects.create(**validated_data)
+                bump(wallets_key("Bitcoin", validated_data["user"].identifier))
                 return bitcoin_wallet
         except Exception as e:
             # send to sentry
@@ -168,8 +169,8 @@ class EthereumWalletSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = EthereumWallet
-        extra_kwargs = {"private_key": {"write_only": True}, "user": {"write_only": True}}
-        fields = ["identifier", "public_key", "private_key", "balance", "user", "owner"]
+        extra_kwargs = {"private_key": {"write_only": True}, "user": {"write_only": True}, "curve": {"write_only": True}}
+        fields = ["identifier", "public_key", "private_key", "curve", "balance", "user", "owner"]
 
     def validate(
         self, data: Dict[str, Union[str, float]]
@@ -197,7 +198,9 @@ class EthereumWalletSerializer(serializers.ModelSerializer):
         try:
 
             with transaction.atomic():
+                validated_data["opening_balance"] = validated_data.get("balance", 0)
                 ethereum_wallet: EthereumWallet = EthereumWallet.objects.create(**validated_data)
+                bump(wallets_key("Ethereum", validated_data["user"].identifier))
                 return ethereum_wallet
         except Exception as e:
             # send to sentry
@@ -252,6 +255,8 @@ class TransactionsSerializer(serializers.ModelSerializer):
                 # record transaction history for the target user
                 TransactionHistory.objects.create(user=validated_data["target_user"],
                                                   transaction=btc_transaction)
+                bump(*transaction_keys(validated_data["source_user"].identifier,
+                                       validated_data["target_user"].identifier))
                 return btc_transaction
         except Exception as e:
             # send to sentry
@@ -265,3 +270,57 @@ class TransactionHistorySerializer(serializers.ModelSerializer):
     class Meta:
         model = TransactionHistory
         fields = ["identifier", "transaction", "user"]
+
+
+class TransactionHistoryQuerySerializer(serializers.Serializer):
+    include_archived = serializers.BooleanField(default=False)
+
+
+class TransactionStatsQuerySerializer(serializers.Serializer):
+    currency_type = serializers.ChoiceField(choices=Transaction.CurrencyType, required=False)
+    since = serializers.DateField(required=False)
+    until = serializers.DateField(required=False)
+
+    def validate(self, data: Dict[str, str]) -> Dict[str, str]:
+        """
+
+        :param data: the query parameters of a stats request
+        :return: the passed data object after validation
+        """
+        since = data.get("since", None)
+        until = data.get("until", None)
+
+        if since and until and since > until:
+            raise serializers.ValidationError("since can't be after until")
+        return data
+
+
+class StatementQuerySerializer(serializers.Serializer):
+    currency_type = serializers.ChoiceField(choices=Transaction.CurrencyType)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+    def validate(self, data: Dict[str, str]) -> Dict[str, str]:
+        """
+
+        :param data: the query parameters of a statement request
+        :return: the passed data object after validation
+        """
+        since = data.get("since", None)
+        until = data.get("until", None)
+
+        if since and until and since > until:
+            raise serializers.ValidationError("since can't be after until")
+        return data
+
+
+class TransactionTotalsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailyTransactionAggregate
+        fields = ["currency_type", "sent_amount", "sent_count", "received_amount", "received_count"]
+
+
+class DailyTransactionAggregateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailyTransactionAggregate
+        fields = ["day", "currency_type", "sent_amount", "sent_count", "received_amount", "received_count"]
@@ -0,0 +1,157 @@
+import json
+import asyncio
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from backendservice.models import User
+from utils.events import bus, EVENTS_EXCHANGE
+
+try:
+    import aio_pika
+except ImportError:
+    aio_pika = None
+
+
+EVENTS_PATH = "/api/transaction-events/"
+
+
+class EventRelay:
+    '''
+        - one broker subscription per web worker, whatever the number of open streams
+        - relays the fanout exchange to the in-process bus the streams are subscribed to
+    '''
+
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._relay())
+
+    async def _relay(self):
+        connection = await aio_pika.connect_robust(host='localhost')
+        channel = await connection.channel()
+        exchange = await channel.declare_exchange(EVENTS_EXCHANGE, aio_pika.ExchangeType.FANOUT)
+        # a queue of this worker only, deleted with its connection
+        queue = await channel.declare_queue(exclusive=True)
+        await queue.bind(exchange)
+        async with queue.iterator(no_ack=True) as messages:
+            async for message in messages:
+                bus.publish(json.loads(message.body))
+
+
+relay = EventRelay()
+
+
+def _raw_token(scope):
+    headers = dict(scope["headers"])
+    parts = headers.get(b"authorization", b"").decode("latin-1").split()
+    if len(parts) == 2 and parts[0] in jwt_settings.AUTH_HEADER_TYPES:
+        return parts[1]
+    # browsers can not set headers on an EventSource
+    return parse_qs(scope["query_string"].decode("latin-1")).get("token", [None])[0]
+
+
+def _user_exists(user_id):
+    try:
+        return User.objects.filter(identifier=user_id).exists()
+    finally:
+        # what django does at the end of every request
+        close_old_connections()
+
+
+async def authenticate(scope):
+    '''
+        :return: the identifier of the user the access token belongs to, None when it is missing or invalid
+    '''
+    raw_token = _raw_token(scope)
+    if not raw_token:
+        return None
+    try:
+        user_id = AccessToken(raw_token).get(jwt_settings.USER_ID_CLAIM)
+    except TokenError:
+        return None
+    if user_id is None or not await sync_to_async(_user_exists)(user_id):
+        return None
+    return str(user_id)
+
+
+async def send_error(send, status, detail):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json")],
+    })
+    await send({"type": "http.response.body", "body": json.dumps({"detail": detail}).encode("utf-8")})
+
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def encode_event(event):
+    event = dict(event)
+    name = event.pop("event")
+    lines = [f'event: {name}']
+    if "identifier" in event:
+        lines.append(f'id: {event["identifier"]}')
+    lines.append(f'data: {json.dumps(event)}')
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+async def transaction_events(scope, receive, send):
+    '''
+        - streams the state changes of the transactions the user sends or receives as server-sent events
+        - a stream is an asyncio queue on the bus, a worker holds thousands of them without a thread each
+        - a comment line every EVENTS_KEEPALIVE seconds keeps proxies from closing idle streams
+    '''
+    if scope["method"] != "GET":
+        return await send_error(send, 405, f'Method "{scope["method"]}" not allowed.')
+
+    user = await authenticate(scope)
+    if user is None:
+        return await send_error(send, 401, "Authentication credentials were not provided or are invalid.")
+
+    if settings.TRANSACTION_TRANSPORT != "local":
+        if aio_pika is None:
+            return await send_error(send, 503, "Event streams need aio-pika, install it with: pip install aio-pika")
+        relay.start()
+
+    loop = asyncio.get_running_loop()
+    queue = bus.subscribe(user, loop)
+    disconnected = loop.create_task(wait_disconnect(receive))
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                # nginx would buffer the stream otherwise
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": b": connected\n\n", "more_body": True})
+
+        while True:
+            next_event = loop.create_task(queue.get())
+            done, _ = await asyncio.wait(
+                {next_event, disconnected}, timeout=settings.EVENTS_KEEPALIVE, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                next_event.cancel()
+                break
+            if next_event in done:
+                body = encode_event(next_event.result())
+            else:
+                next_event.cancel()
+                body = b": keepalive\n\n"
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        bus.unsubscribe(user, loop, queue)
+        disconnected.cancel()
@@ -1,3 +1,1179 @@
-from django.test import TestCase
+import io
+import os
+import json
+import uuid
+import decimal
+import asyncio
+import datetime
+import tempfile
+import threading
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync, sync_to_async
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.core.management import call_command
+from django.db import OperationalError, InterfaceError
+from django.db.models import F
+from django.utils import timezone
+from django.test import SimpleTestCase, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
 
-# Create your tests here.
+from backendservice import idempotency
+from backendservice.aggregates import record_transfer
+from backendservice.versioning import transactions_key, transactions_keys, wallets_keys, history_key
+from backendservice.fast_serializers import serialize_wallets, serialize_transactions, serialize_history
+from backendservice.serializers import BitcoinWalletSerializer, TransactionsSerializer, TransactionHistorySerializer
+from backendservice.streams import encode_event, transaction_events
+from backendservice.management.commands import onboard_accounts, reconcile_ledger
+from backendservice.management.commands.export_columnar import numpy
+from utils import passwords
+from utils.renderers import FastJSONRenderer
+from utils.events import EventBus
+from utils.backpressure import PrefetchController, CircuitBreaker
+from utils.lanes import LaneScheduler
+from utils.spool import Spool, drain
+from utils.producer import local_queue, INTERACTIVE_LANE
+from backendservice.models import (User, Transaction, DailyTransactionAggregate, ArchivedTransaction, BitcoinWallet,
+                                   WalletCheckpoint, IdempotencyKey, VersionTag, TransactionHistory)
+
+
+# queries each endpoint runs, pinned exactly: a change either way fails the test, lower
+# a budget when a query is saved and raise one only with a good reason.
+# Requests are authenticated with force_authenticate, so the user lookup done
+# by the JWT authentication is not counted. Tests run inside a transaction, so
+# the atomic blocks of the views count as SAVEPOINT queries.
+QUERY_BUDGETS = {
+    "register": 4,
+    "login": 1,
+    "bitcoin-wallet create": 6,
+    "bitcoin-wallet list": 2,
+    "ethereum-wallet create": 6,
+    "ethereum-wallet list": 2,
+    "transaction create": 11,
+    # a retry answered from the stored response of its Idempotency-Key
+    "transaction replay": 1,
+    "transaction list": 2,
+    "transaction-status": 1,
+    "transaction-history": 2,
+    "transaction-history archived": 3,
+    "transaction-stats": 2,
+    "transaction-status archived": 2,
+    # wallet, the checkpoints around the range, the transfers before and in the range in both tables
+    "statement": 10,
+    # a conditional get answered from the version tags alone
+    "not modified": 1,
+}
+
+
+@override_settings(TRANSACTION_TRANSPORT="local")
+class BackendTestCase(APITestCase):
+    # enough rows for an N+1 query to show in the query counts
+    users_count = 5
+
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(f'user {index}', "test user", f'user{index}@test.local', 100, "pass1234")
+            for index in range(self.users_count)
+        ]
+        self.user = self.users[0]
+
+    def create_wallets(self, users=None):
+        for user in users or self.users:
+            self.client.force_authenticate(user)
+            self.client.post("/api/bitcoin-wallet/", {"balance": "10"}, format="json")
+            self.client.post("/api/ethereum-wallet/", {"balance": "10"}, format="json")
+        self.client.force_authenticate(self.user)
+
+    def create_transactions(self, target_users=None):
+        for target_user in target_users or self.users[1:]:
+            self.client.post("/api/transaction/", {
+                "target_user": str(target_user.identifier),
+                "currency_type": "Bitcoin",
+                "amount": "0.5",
+            }, format="json")
+
+    def confirm_transactions(self, processed=None):
+        # confirm the transfers the way the processor does
+        for transaction in Transaction.objects.all():
+            transaction.state = "Confirmed"
+            transaction.processed = processed or timezone.now()
+            transaction.save()
+            record_transfer(transaction.currency_type, str(transaction.source_user_id),
+                            str(transaction.target_user_id), transaction.amount, transaction.processed)
+
+
+class QueryBudgetTests(BackendTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the tags exist once the service ran for a while, a bump is then a single update
+        keys = [*transactions_keys(), *wallets_keys("Bitcoin"), *wallets_keys("Ethereum"),
+                *[history_key(user.identifier) for user in self.users]]
+        VersionTag.objects.bulk_create([VersionTag(key=key) for key in keys])
+
+    def assertQueryBudget(self, endpoint, request):
+        with self.assertNumQueries(QUERY_BUDGETS[endpoint]):
+            response = request()
+        self.assertLess(response.status_code, 400, response.data)
+        return response
+
+    def test_register(self):
+        self.assertQueryBudget("register", lambda: self.client.post("/api/register/", {
+            "name": "new user",
+            "description": "budget user",
+            "email": "new@budget.local",
+            "password": "pass1234",
+            "max_amount_per_transaction": 10,
+        }, format="json"))
+
+    def test_login(self):
+        self.assertQueryBudget("login", lambda: self.client.post("/api/login/", {
+            "email": self.user.email,
+            "password": "pass1234",
+        }, format="json"))
+
+    def test_wallets(self):
+        for wallet in ("bitcoin-wallet", "ethereum-wallet"):
+            self.client.force_authenticate(self.user)
+            self.assertQueryBudget(f'{wallet} create', lambda: self.client.post(
+                f'/api/{wallet}/', {"balance": "10"}, format="json"))
+
+        self.create_wallets(self.users[1:])
+        for wallet in ("bitcoin-wallet", "ethereum-wallet"):
+            self.assertQueryBudget(f'{wallet} list', lambda: self.client.get(f'/api/{wallet}/'))
+
+    def test_transaction_create(self):
+        self.create_wallets()
+        self.assertQueryBudget("transaction create", lambda: self.client.post("/api/transaction/", {
+            "target_user": str(self.users[1].identifier),
+            "currency_type": "Bitcoin",
+            "amount": "0.5",
+        }, format="json"))
+
+    def test_transaction_replay(self):
+        self.create_wallets()
+        transfer = {"target_user": str(self.users[1].identifier), "currency_type": "Bitcoin", "amount": "0.5"}
+        self.client.post("/api/transaction/", transfer, format="json", HTTP_IDEMPOTENCY_KEY="transfer-1")
+        self.assertQueryBudget("transaction replay", lambda: self.client.post(
+            "/api/transaction/", transfer, format="json", HTTP_IDEMPOTENCY_KEY="transfer-1"))
+
+    def test_transaction_reads(self):
+        self.create_wallets()
+        self.create_transactions()
+        transaction = Transaction.objects.first()
+
+        self.assertQueryBudget("transaction list", lambda: self.client.get("/api/transaction/"))
+        self.assertQueryBudget("transaction-status", lambda: self.client.get(
+            f'/api/transaction/{transaction.identifier}/status/'))
+        self.assertQueryBudget("transaction-history", lambda: self.client.get("/api/transaction-history/"))
+
+    def test_not_modified(self):
+        self.create_wallets()
+        self.create_transactions(self.users[1:2])
+
+        for endpoint in ("/api/bitcoin-wallet/", "/api/transaction/", "/api/transaction-history/"):
+            etag = self.client.get(endpoint)["ETag"]
+            response = self.assertQueryBudget("not modified", lambda: self.client.get(
+                endpoint, HTTP_IF_NONE_MATCH=etag))
+            self.assertEqual(response.status_code, 304)
+
+    def test_transaction_stats(self):
+        self.create_wallets()
+        self.create_transactions()
+        self.confirm_transactions()
+        self.assertQueryBudget("transaction-stats", lambda: self.client.get(
+            "/api/transaction-stats/", {"currency_type": "Bitcoin"}))
+
+    def test_archived_reads(self):
+        self.create_wallets()
+        self.create_transactions()
+        Transaction.objects.update(state="Confirmed", processed=timezone.now(),
+                                   created=timezone.now() - datetime.timedelta(days=100))
+        transaction = Transaction.objects.first()
+        call_command("archive_transactions", "--days", "90", stdout=io.StringIO())
+
+        self.assertQueryBudget("transaction-history archived", lambda: self.client.get(
+            "/api/transaction-history/", {"include_archived": "true"}))
+        self.assertQueryBudget("transaction-status archived", lambda: self.client.get(
+            f'/api/transaction/{transaction.identifier}/status/'))
+
+    def test_statement(self):
+        self.create_wallets()
+        self.create_transactions()
+        self.confirm_transactions()
+        call_command("write_checkpoints", stdout=io.StringIO())
+        # the worst case, a checkpoint lookup on both sides of the range
+        since = timezone.now() - datetime.timedelta(hours=1)
+        self.assertQueryBudget("statement", lambda: self.client.get("/api/statement/", {
+            "currency_type": "Bitcoin", "since": since.isoformat()}))
+
+
+class ConditionalReadTests(BackendTestCase):
+
+    def test_changes_invalidate_etag(self):
+        self.create_wallets()
+        self.create_transactions(self.users[1:2])
+
+        history_etag = self.client.get("/api/transaction-history/")["ETag"]
+        self.create_transactions(self.users[2:3])
+        response = self.client.get("/api/transaction-history/", HTTP_IF_NONE_MATCH=history_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 2)
+
+    def test_list_tags_are_split_by_user(self):
+        self.create_wallets()
+        # two senders whose transfers bump different tags of the transaction list
+        source, other = next((source, other) for source in self.users for other in self.users
+                             if transactions_key(source.identifier) != transactions_key(other.identifier))
+        tags = VersionTag.objects.filter(key__startswith="transactions:")
+
+        etag = self.client.get("/api/transaction/")["ETag"]
+        for user in (source, other):
+            self.client.force_authenticate(user)
+            self.create_transactions([next(target for target in self.users if target != user)])
+        self.assertNotEqual(self.client.get("/api/transaction/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(dict(tags.values_list("key", "version")), {
+            transactions_key(source.identifier): 1, transactions_key(other.identifier): 1})
+
+
+class FastSerializerTests(BackendTestCase):
+
+    def render(self, fast_rows, serializer_rows):
+        # the list endpoints render the values() rows, the model serializers are the reference
+        return (FastJSONRenderer().render(sorted(fast_rows, key=lambda row: row["identifier"])),
+                JSONRenderer().render(sorted(serializer_rows, key=lambda row: row["identifier"])))
+
+    def assertSameJSON(self, fast_rows, serializer_rows):
+        fast, reference = self.render(fast_rows, serializer_rows)
+        self.assertTrue(fast_rows)
+        self.assertEqual(fast, reference)
+        # without orjson the fallback renders the same bytes
+        with mock.patch("utils.renderers.orjson", None):
+            self.assertEqual(self.render(fast_rows, serializer_rows)[0], reference)
+
+    def test_output_matches_the_model_serializers(self):
+        self.create_wallets()
+        self.create_transactions()
+        User.objects.filter(identifier=self.user.identifier).update(
+            max_amount_per_transaction=decimal.Decimal("0.000000000000000001"))
+        BitcoinWallet.objects.filter(user=self.user).update(balance=decimal.Decimal("12345678.00000001"))
+        # microseconds, an amount with every decimal place and an unprocessed transfer
+        processed = Transaction.objects.order_by("target_user").first()
+        processed.state = "Confirmed"
+        processed.processed = timezone.now().replace(microsecond=123456)
+        processed.amount = decimal.Decimal("0.123456789012345678")
+        processed.save()
+
+        self.assertSameJSON(serialize_wallets(BitcoinWallet),
+                            BitcoinWalletSerializer(BitcoinWallet.objects.all(), many=True).data)
+        self.assertSameJSON(serialize_transactions(),
+                            TransactionsSerializer(Transaction.objects.all(), many=True).data)
+        self.assertSameJSON(serialize_history(self.user),
+                            TransactionHistorySerializer(TransactionHistory.objects.filter(user=self.user),
+                                                         many=True).data)
+
+
+class LoginTests(BackendTestCase):
+
+    def test_login_rehashes_password(self):
+        with override_settings(PASSWORD_HASH_ITERATIONS=1000):
+            response = self.client.post("/api/login/", {
+                "email": self.user.email,
+                "password": "pass1234",
+            }, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data["tokens"]), {"refresh", "access"})
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("pbkdf2_sha256$1000$"))
+        self.assertTrue(self.user.check_password("pass1234"))
+
+    @override_settings(LOGIN_HASH_WORKERS=1, LOGIN_HASH_QUEUE=0, LOGIN_HASH_TIMEOUT=0.1)
+    def test_hashes_beyond_the_limit_are_shed(self):
+        limiter = passwords.PasswordHashLimiter()
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_hash():
+            started.set()
+            finish.wait(5)
+            return "hash"
+
+        hashing = threading.Thread(target=limiter.run, args=(slow_hash,))
+        hashing.start()
+        started.wait(5)
+        try:
+            with self.assertRaises(passwords.LoginUnavailable):
+                limiter.run(lambda: "hash")
+        finally:
+            finish.set()
+            hashing.join()
+        self.assertEqual(limiter.run(lambda: "hash"), "hash")
+
+
+class TransactionStatsTests(BackendTestCase):
+
+    def test_totals(self):
+        self.create_wallets()
+        self.create_transactions()
+        self.confirm_transactions()
+
+        response = self.client.get("/api/transaction-stats/", {"currency_type": "Bitcoin"})
+        self.assertEqual(response.data["totals"][0]["sent_count"], self.users_count - 1)
+        self.assertEqual(response.data["totals"][0]["sent_amount"], "2.000000000000000000")
+
+    def test_default_window_is_part_of_etag(self):
+        self.create_wallets()
+        self.create_transactions()
+        self.confirm_transactions()
+
+        etag = self.client.get("/api/transaction-stats/")["ETag"]
+        self.assertEqual(self.client.get("/api/transaction-stats/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # the month rolled over, nothing else changed
+        next_month = (timezone.localdate().replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        with mock.patch("backendservice.views.timezone.localdate", return_value=next_month):
+            response = self.client.get("/api/transaction-stats/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["since"], next_month)
+        self.assertEqual(response.data["totals"], [])
+
+    def test_backfill_matches_incremental_aggregates(self):
+        self.create_wallets()
+        self.create_transactions()
+        self.confirm_transactions()
+
+        incremental = set(DailyTransactionAggregate.objects.values_list(
+            "user", "currency_type", "day", "sent_amount", "sent_count", "received_amount", "received_count"))
+        # batches smaller than the users, transfers cross batches
+        call_command("backfill_aggregates", "--users-per-batch", "2", stdout=io.StringIO())
+        rebuilt = set(DailyTransactionAggregate.objects.values_list(
+            "user", "currency_type", "day", "sent_amount", "sent_count", "received_amount", "received_count"))
+        self.assertEqual(incremental, rebuilt)
+
+
+class ArchiveTests(BackendTestCase):
+
+    def test_archive_moves_settled_transactions(self):
+        self.create_wallets()
+        self.create_transactions()
+        Transaction.objects.update(state="Confirmed", processed=timezone.now(),
+                                   created=timezone.now() - datetime.timedelta(days=100))
+        transaction = Transaction.objects.first()
+        call_command("archive_transactions", "--days", "90", "--batch-size", "2", stdout=io.StringIO())
+
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(ArchivedTransaction.objects.count(), self.users_count - 1)
+
+        self.assertEqual(self.client.get("/api/transaction-history/").data, [])
+        response = self.client.get("/api/transaction-history/", {"include_archived": "true"})
+        self.assertEqual(len(response.data), self.users_count - 1)
+        response = self.client.get(f'/api/transaction/{transaction.identifier}/status/')
+        self.assertEqual(response.data["status"], "Confirmed")
+
+
+class InlineExecutor:
+    # runs the submitted calls right away on the calling thread
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class ReconcileLedgerTests(BackendTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.create_wallets()
+        self.create_transactions()
+        # confirm the transfers and move the balances the way the processor does
+        for transaction in Transaction.objects.all():
+            self.settle(transaction)
+        # some of the ledger is in the archive
+        Transaction.objects.filter(target_user__in=self.users[1:3]).update(
+            created=timezone.now() - datetime.timedelta(days=100))
+        call_command("archive_transactions", "--days", "90", stdout=io.StringIO())
+
+        checkpoint_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoint_dir.cleanup)
+        self.checkpoint_dir = checkpoint_dir.name
+
+    def settle(self, transaction):
+        transaction.state = "Confirmed"
+        transaction.processed = timezone.now()
+        transaction.save()
+        BitcoinWallet.objects.filter(user=transaction.source_user).update(balance=F("balance") - transaction.amount)
+        BitcoinWallet.objects.filter(user=transaction.target_user).update(balance=F("balance") + transaction.amount)
+
+    def reconcile(self):
+        output = io.StringIO()
+        # the currency workers run on the test connection, the only one that sees the rows of the test transaction
+        with mock.patch.object(reconcile_ledger, "ProcessPoolExecutor", InlineExecutor), \
+                mock.patch.object(reconcile_ledger.connections, "close_all"):
+            call_command("reconcile_ledger", "--currency", "Bitcoin", "--chunk-size", "1",
+                         "--checkpoint-dir", self.checkpoint_dir, stdout=output)
+        return output.getvalue()
+
+    def test_clean_wallets(self):
+        output = self.reconcile()
+
+        # one chunk per transfer, live then archived
+        self.assertIn(f'Bitcoin: scanned {self.users_count - 1} chunks, 0 drifted wallets', output)
+        self.assertIn("All wallets match the ledger", output)
+        self.assertEqual(os.listdir(self.checkpoint_dir), [])
+
+    def test_drift_is_reported(self):
+        wallet = BitcoinWallet.objects.get(user=self.users[1])
+        BitcoinWallet.objects.filter(identifier=wallet.identifier).update(balance=F("balance") + 1)
+
+        output = self.reconcile()
+
+        self.assertIn(f'wallet {wallet.identifier} of {wallet.user_id}: balance 11.50000000, '
+                      f'ledger 10.50000000, drift 1.00000000', output)
+        self.assertIn("1 wallets drifted from the ledger", output)
+
+    def test_interrupted_run_resumes_from_its_checkpoint(self):
+        net_flows = reconcile_ledger._net_flows
+        calls = []
+
+        def interrupted(queryset):
+            calls.append(queryset)
+            if len(calls) > 2:
+                raise KeyboardInterrupt
+            return net_flows(queryset)
+
+        with mock.patch.object(reconcile_ledger, "_net_flows", interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.reconcile()
+        self.assertEqual(os.listdir(self.checkpoint_dir), ["bitcoin.json"])
+
+        # settled meanwhile and ordered before the checkpoint: the scan misses it, the re-check of the wallet does not
+        transfer = Transaction.objects.create(
+            identifier=uuid.UUID(int=1), amount="0.25", currency_type="Bitcoin", source_user=self.users[1],
+            target_user=self.users[2], signature="signature")
+        self.settle(transfer)
+
+        output = self.reconcile()
+        self.assertIn(f'Bitcoin: scanned {self.users_count - 3} chunks, 0 drifted wallets', output)
+        self.assertIn("All wallets match the ledger", output)
+
+
+class OnboardAccountsTests(BackendTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "accounts.csv")
+        with open(self.path, "w") as accounts_file:
+            accounts_file.write("\n".join([
+                "name,description,email,password,max_amount_per_transaction,bitcoin_balance,ethereum_balance",
+                "new 1,new user,new1@test.local,pass1234,100,1.5,",
+                "new 2,new user,new2@test.local,pass1234,100,,2",
+                # invalid, a duplicate of a record in an earlier chunk, one in the same chunk and an existing user
+                "new 3,new user,new3@test.local,pass1234,100,-1,",
+                "new 1 again,new user,new1@TEST.LOCAL,pass1234,100,3,",
+                "new 4,new user,new4@test.local,pass1234,100,5,5",
+                "new 4 again,new user,new4@test.local,pass1234,100,6,6",
+                "user 0,new user,user0@test.local,pass1234,100,4,",
+            ]))
+
+    def onboard(self, *args):
+        output = io.StringIO()
+        # no database access on the workers, threads spare forking the test runner
+        with mock.patch.object(onboard_accounts, "ProcessPoolExecutor",
+                               lambda max_workers, mp_context: ThreadPoolExecutor(max_workers)), \
+                mock.patch.object(onboard_accounts.connections, "close_all"):
+            call_command("onboard_accounts", self.path, "--chunk-size", "2", "--workers", "2", *args, stdout=output)
+        return output.getvalue()
+
+    def test_accounts_are_created_once(self):
+        output = self.onboard()
+
+        self.assertIn("record 3 skipped: bitcoin_balance can't be negative", output)
+        self.assertIn("Onboarded 3 accounts, skipped 4", output)
+        self.assertEqual(User.objects.get(email="new1@test.local").name, "new 1")
+        self.assertEqual(User.objects.get(email="new4@test.local").name, "new 4")
+        self.assertEqual(User.objects.get(email="user0@test.local").name, "user 0")
+        self.assertFalse(User.objects.filter(email="new3@test.local").exists())
+        self.assertEqual(dict(BitcoinWallet.objects.values_list("user__email", "opening_balance")), {
+            "new1@test.local": decimal.Decimal("1.5"), "new4@test.local": decimal.Decimal("5")})
+        self.assertFalse(os.path.exists(f'{self.path}.onboard.json'))
+
+    def test_interrupted_run_resumes_from_its_checkpoint(self):
+        onboard_chunk = onboard_accounts.Command.onboard_chunk
+        calls = []
+
+        def interrupted(command, chunk, executor):
+            calls.append(chunk)
+            if len(calls) > 2:
+                raise KeyboardInterrupt
+            return onboard_chunk(command, chunk, executor)
+
+        with mock.patch.object(onboard_accounts.Command, "onboard_chunk", interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.onboard()
+        self.assertEqual(User.objects.filter(email__startswith="new").count(), 2)
+
+        output = self.onboard()
+        self.assertIn("Resuming after 4 records", output)
+        self.assertIn("Onboarded 1 accounts, skipped 2", output)
+        self.assertEqual(sorted(User.objects.filter(email__startswith="new").values_list("email", flat=True)),
+                         ["new1@test.local", "new2@test.local", "new4@test.local"])
+
+        # a complete run starts over, every record is then a duplicate
+        self.assertIn("Onboarded 0 accounts, skipped 7", self.onboard())
+
+
+@skipUnless(numpy is not None, "the npy export needs numpy")
+class ColumnarExportTests(BackendTestCase):
+
+    def export(self, output):
+        call_command("export_columnar", output, "--format", "npy", "--lag", "60", stdout=io.StringIO())
+        parts = os.path.join(output, "transactions")
+        return [numpy.load(os.path.join(parts, part, "state.npy")) for part in sorted(os.listdir(parts))]
+
+    def test_unsettled_transactions_wait_for_settlement(self):
+        self.create_wallets()
+        self.create_transactions(self.users[1:3])
+        settled, pending = Transaction.objects.order_by("target_user")
+        Transaction.objects.update(created=timezone.now() - datetime.timedelta(minutes=5))
+        Transaction.objects.filter(identifier=settled.identifier).update(state="Rejected", processed=timezone.now())
+
+        with tempfile.TemporaryDirectory() as output:
+            self.assertEqual(self.export(output), [])
+
+            Transaction.objects.filter(identifier=pending.identifier).update(
+                state="Confirmed", processed=timezone.now())
+            parts = self.export(output)
+            self.assertEqual(sorted(state for part in parts for state in part), [b"Confirmed", b"Rejected"])
+
+            # exported once, later runs only append newer transactions
+            self.assertEqual(len(self.export(output)), len(parts))
+
+
+class StatementTests(BackendTestCase):
+
+    def test_statement(self):
+        self.create_wallets()
+        self.create_transactions()
+        started = timezone.now()
+        # confirm the transfers a minute apart the way the processor does
+        for minute, transaction in enumerate(Transaction.objects.order_by("target_user")):
+            transaction.state = "Confirmed"
+            transaction.processed = started + datetime.timedelta(minutes=minute + 1)
+            transaction.save()
+            for user, amount in ((transaction.source_user_id, -transaction.amount),
+                                 (transaction.target_user_id, transaction.amount)):
+                wallet = BitcoinWallet.objects.get(user=user)
+                wallet.balance += amount
+                wallet.transfers_since_checkpoint += 1
+                wallet.save()
+        call_command("write_checkpoints", stdout=io.StringIO())
+        self.assertEqual(WalletCheckpoint.objects.count(), self.users_count * 2)
+        self.assertFalse(BitcoinWallet.objects.filter(transfers_since_checkpoint__gt=0).exists())
+
+        until = started + datetime.timedelta(hours=1)
+
+        def statement(since):
+            return self.client.get("/api/statement/", {
+                "currency_type": "Bitcoin", "since": since.isoformat(), "until": until.isoformat()})
+
+        # replayed backwards from the checkpoint after the range
+        response = statement(started)
+        self.assertEqual(response.data["opening_balance"], "10.00000000")
+        self.assertEqual([entry["balance"] for entry in response.data["entries"]],
+                         ["9.50000000", "9.00000000", "8.50000000", "8.00000000"])
+        self.assertEqual(response.data["closing_balance"], "8.00000000")
+
+        # replayed forward from the checkpoint before the range
+        response = statement(started + datetime.timedelta(minutes=30))
+        self.assertEqual(response.data["opening_balance"], "8.00000000")
+        self.assertEqual(response.data["entries"], [])
+
+        # wallets never checkpointed replay from their opening balance, or back from their balance
+        middle = started + datetime.timedelta(minutes=1, seconds=30)
+        WalletCheckpoint.objects.all().delete()
+        response = statement(middle)
+        self.assertEqual(response.data["opening_balance"], "9.50000000")
+        self.assertEqual(len(response.data["entries"]), 3)
+        BitcoinWallet.objects.filter(user=self.user).update(opening_balance=None)
+        self.assertEqual(statement(middle).data["opening_balance"], "9.50000000")
+
+    def test_default_window_is_part_of_etag(self):
+        self.create_wallets()
+
+        def statement(etag):
+            return self.client.get("/api/statement/", {"currency_type": "Bitcoin"}, HTTP_IF_NONE_MATCH=etag)
+
+        etag = statement("")["ETag"]
+        self.assertEqual(statement(etag).status_code, 304)
+        # a transfer of the user is part of the open ended window
+        self.create_transactions(self.users[1:2])
+        response = statement(etag)
+        self.assertEqual(response.status_code, 200)
+
+        # the next day the window starts a day later
+        tomorrow = timezone.localdate() + datetime.timedelta(days=1)
+        with mock.patch("backendservice.views.timezone.localdate", return_value=tomorrow):
+            self.assertEqual(statement(response["ETag"]).status_code, 200)
+
+
+class IdempotencyTests(BackendTestCase):
+
+    def test_idempotent_transaction_create(self):
+        self.create_wallets()
+        transfer = {"target_user": str(self.users[1].identifier), "currency_type": "Bitcoin", "amount": "0.5"}
+
+        def post(data, key="transfer-1"):
+            return self.client.post("/api/transaction/", dict(data), format="json", HTTP_IDEMPOTENCY_KEY=key)
+
+        created = post(transfer)
+        self.assertEqual(created.status_code, 201)
+        replayed = post(transfer)
+        self.assertEqual(replayed.status_code, 201)
+        self.assertEqual(replayed["Idempotent-Replayed"], "true")
+        self.assertEqual(replayed.data["identifier"], created.data["identifier"])
+        self.assertEqual(Transaction.objects.count(), 1)
+
+        self.assertEqual(post(dict(transfer, amount="0.6")).status_code, 422)
+        # failed requests free their key
+        missing = dict(transfer, target_user=str(self.user.identifier), currency_type="Dogecoin")
+        self.assertEqual(post(missing, key="transfer-2").status_code, 404)
+        self.assertFalse(IdempotencyKey.objects.filter(key="transfer-2").exists())
+
+    def test_expired_reservation_is_taken_over(self):
+        self.create_wallets()
+        transfer = {"target_user": str(self.users[1].identifier), "currency_type": "Bitcoin", "amount": "0.5"}
+        # a worker reserved the key and died before storing a response
+        IdempotencyKey.objects.create(user=self.user, key="transfer-1", fingerprint=idempotency.fingerprint(transfer))
+
+        def post():
+            return self.client.post("/api/transaction/", transfer, format="json", HTTP_IDEMPOTENCY_KEY="transfer-1")
+
+        self.assertEqual(post().status_code, 409)
+        IdempotencyKey.objects.update(reserved=timezone.now() - datetime.timedelta(minutes=5))
+        response = post()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Transaction.objects.count(), 1)
+        self.assertEqual(post().data["identifier"], response.data["identifier"])
+
+    def test_failed_publish_is_not_replayed(self):
+        self.create_wallets()
+        local_queue.clear()
+        transfer = {"target_user": str(self.users[1].identifier), "currency_type": "Bitcoin", "amount": "0.5"}
+
+        def post():
+            return self.client.post("/api/transaction/", transfer, format="json", HTTP_IDEMPOTENCY_KEY="transfer-1")
+
+        with mock.patch("backendservice.views.transaction_producer", side_effect=OSError("spool disk full")):
+            with self.assertRaises(OSError):
+                post()
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+        # the retry runs again instead of replaying a transfer that was never queued
+        response = post()
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(len(local_queue), 1)
+        self.assertEqual(IdempotencyKey.objects.get().status, 201)
+
+    def test_request_outliving_its_lease_is_rolled_back(self):
+        reservation = IdempotencyKey.objects.create(
+            user=self.user, key="transfer-1", fingerprint="", reserved=timezone.now() - datetime.timedelta(minutes=5))
+        retry = IdempotencyKey.objects.get(identifier=reservation.identifier)
+        self.assertTrue(idempotency.take_over(retry))
+        # the first request finishes late, the retry owns the key
+        with self.assertRaises(idempotency.ReservationLost):
+            idempotency.complete(reservation, {}, 201)
+        idempotency.release(reservation)
+        self.assertTrue(IdempotencyKey.objects.filter(identifier=reservation.identifier).exists())
+        self.assertFalse(idempotency.take_over(reservation))
+
+
+class ProcessorTests(BackendTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # imported here, the processor module sets up its own log on import
+        import transactionprocessor
+        self.transactionprocessor = transactionprocessor
+        self.processor = transactionprocessor.TransactionProcessor()
+        local_queue.clear()
+        self.create_wallets(self.users[:2])
+        self.create_transactions(self.users[1:2])
+        self.body = local_queue.popleft()
+
+    def balances(self):
+        return [wallet.balance for wallet in BitcoinWallet.objects.filter(user__in=self.users[:2]).order_by("user")]
+
+    def process(self, body):
+        # captured, the processor logs to transactions.log otherwise
+        with self.assertLogs("Transaction Processor", "INFO") as logs:
+            self.processor.processor(body)
+        return logs.output
+
+    def test_redelivered_settled_message_is_skipped(self):
+        self.process(self.body)
+        self.assertEqual(Transaction.objects.get().state, "Confirmed")
+        balances = self.balances()
+
+        # the transaction lookup only, no wallet read and no signature check
+        with self.assertNumQueries(1):
+            logs = self.process(self.body)
+        self.assertIn("skipped: already settled", logs[-1])
+        self.assertEqual(self.balances(), balances)
+
+    def test_concurrent_second_settle_rolls_back(self):
+        transaction_info = self.processor.decode(self.body)
+        # both deliveries fetched the transaction while it was unconfirmed
+        _, first = self.processor.fetch(transaction_info)
+        _, second = self.processor.fetch(transaction_info)
+        self.assertEqual(second.state, "Unconfirmed")
+
+        with self.assertLogs("Transaction Processor", "INFO"):
+            self.processor.settle(transaction_info, first, True)
+        balances = self.balances()
+        with self.assertRaises(self.transactionprocessor.AlreadySettled):
+            self.processor.settle(transaction_info, second, True)
+
+        self.assertEqual(self.balances(), balances)
+        self.assertEqual(DailyTransactionAggregate.objects.filter(user=self.user).get().sent_count, 1)
+
+
+class ConsumedQueuesTests(SimpleTestCase):
+
+    def setUp(self):
+        # imported here, the processor module sets up its own log on import
+        import transactionprocessor
+        self.transactionprocessor = transactionprocessor
+
+    def test_currency_pool_consumes_only_its_currency(self):
+        self.assertEqual(self.transactionprocessor.consumed_queues("Bitcoin"), [
+            "transactions.bitcoin.interactive", "transactions.bitcoin.bulk", "transactions.bitcoin"])
+        self.assertEqual(self.transactionprocessor.consumed_queues("Bitcoin", "bulk"), ["transactions.bitcoin.bulk"])
+
+    def test_legacy_queue_is_drained_once(self):
+        self.assertIn("transactions", self.transactionprocessor.consumed_queues())
+        self.assertNotIn("transactions", self.transactionprocessor.consumed_queues(lane="bulk"))
+
+        legacy = self.transactionprocessor.TransactionProcessor(legacy=True)
+        self.assertEqual(legacy.queues(), ["transactions"])
+        self.assertEqual(legacy.queues("bulk"), [])
+        # the pools of each currency together consume every queue but the legacy one
+        per_currency = [queue for currency_type in ("Bitcoin", "Ethereum")
+                        for queue in self.transactionprocessor.TransactionProcessor(currency_type).queues()]
+        self.assertEqual(sorted(per_currency + legacy.queues()),
+                         sorted(self.transactionprocessor.TransactionProcessor().queues()))
+
+
+@mock.patch.multiple("transactionprocessor", MAX_RETRIES=3, RETRY_BASE_DELAY=1000, RETRY_BACKOFF=4)
+class FailureRouteTests(SimpleTestCase):
+    queue = "transactions.bitcoin.interactive"
+
+    def setUp(self):
+        # imported here, the processor module sets up its own log on import
+        import transactionprocessor
+        self.transactionprocessor = transactionprocessor
+
+    def test_retry_tiers_back_off_and_dead_letter_to_their_queue(self):
+        tiers = self.transactionprocessor.retry_queues(self.queue)
+        self.assertEqual([queue for queue, _ in tiers], [f'{self.queue}.retry.{attempt}' for attempt in (1, 2, 3)])
+        self.assertEqual([arguments["x-message-ttl"] for _, arguments in tiers], [1000, 4000, 16000])
+        for _, arguments in tiers:
+            self.assertEqual(arguments["x-dead-letter-routing-key"], self.queue)
+
+    def test_failure_route(self):
+        cases = [
+            # error, headers of the failed message, expected queue, expected retry count
+            (OperationalError("database is locked"), None, ".retry.1", 1),
+            (InterfaceError("connection already closed"), {"x-retry-count": 1}, ".retry.2", 2),
+            (OperationalError("database is locked"), {"x-retry-count": 2}, ".retry.3", 3),
+            # the retries ran out
+            (OperationalError("database is locked"), {"x-retry-count": 3}, ".parking", 3),
+            # never worth retrying
+            (KeyError("source_user"), None, ".parking", None),
+        ]
+        for error, headers, suffix, retry_count in cases:
+            with self.subTest(error=error, headers=headers):
+                delivered = dict(headers or {})
+                queue, new_headers = self.transactionprocessor.failure_route(self.queue, headers, error)
+                self.assertEqual(queue, self.queue + suffix)
+                self.assertEqual(new_headers.get("x-retry-count"), retry_count)
+                self.assertEqual("x-error" in new_headers, suffix == ".parking")
+                # the headers of the delivered message are left alone
+                self.assertEqual(headers or {}, delivered)
+
+    def fail(self, routing_key, headers, error):
+        channel = mock.Mock()
+        processor = self.transactionprocessor.TransactionProcessor()
+        properties = mock.Mock(headers=headers)
+        with self.assertLogs("Transaction Processor") as logs:
+            processor.fail(channel, mock.Mock(routing_key=routing_key), properties, b"body", error)
+        publish = channel.basic_publish.call_args.kwargs
+        return publish["routing_key"], publish["properties"], logs.output
+
+    def test_message_back_from_a_retry_queue_moves_to_the_next_tier(self):
+        # dead-lettered back, it is delivered with the routing key of its queue and the broker's x-death
+        headers = {"x-retry-count": 1, "x-death": [{"queue": f'{self.queue}.retry.1', "count": 1}]}
+        queue, properties, logs = self.fail(self.queue, headers, OperationalError("database is locked"))
+
+        self.assertEqual(queue, f'{self.queue}.retry.2')
+        self.assertEqual(properties.headers["x-retry-count"], 2)
+        self.assertEqual(properties.headers["x-death"], headers["x-death"])
+        self.assertEqual(properties.delivery_mode, 2)
+        self.assertIn("retry 2 of 3 scheduled", logs[-1])
+
+    def test_message_out_of_retries_is_parked(self):
+        queue, properties, logs = self.fail(
+            self.queue, {"x-retry-count": 3}, OperationalError("database is locked"))
+
+        self.assertEqual(queue, f'{self.queue}.parking')
+        self.assertEqual(properties.headers["x-error"], "OperationalError('database is locked')")
+        self.assertIn("message parked", logs[-1])
+
+
+class FakeMessage:
+
+    def __init__(self, body):
+        self.body = body
+        self.routing_key = "transactions"
+        self.headers = {}
+        self.acked = False
+
+    async def ack(self):
+        self.acked = True
+
+
+class AsyncProcessorTests(BackendTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # imported here, it sets up the processor log on import
+        import asyncprocessor
+        # signature checks on threads, the ordering does not depend on forking the test runner
+        with mock.patch.object(asyncprocessor, "ProcessPoolExecutor",
+                               lambda max_workers, mp_context: ThreadPoolExecutor(max_workers)):
+            self.processor = asyncprocessor.AsyncTransactionProcessor(
+                fetch_workers=2, verify_workers=2, commit_workers=2, max_in_flight=8)
+        self.addCleanup(self.processor.cpu_pool.shutdown)
+        self.addCleanup(self.processor.orm_pool.shutdown)
+
+        async def orm(function, *args):
+            # back on the test thread, the only one that sees the rows of the test transaction
+            return await sync_to_async(function)(*args)
+        self.processor.orm = orm
+        local_queue.clear()
+        self.create_wallets(self.users[:3])
+
+    def transfer(self, target_user, amount):
+        self.client.post("/api/transaction/", {
+            "target_user": str(target_user.identifier),
+            "currency_type": "Bitcoin",
+            "amount": amount,
+        }, format="json")
+        return local_queue.popleft()
+
+    def run_pipeline(self, messages):
+        async def run():
+            tasks = self.processor.start()
+            for message in messages:
+                await self.processor.on_message(INTERACTIVE_LANE, message)
+            await asyncio.wait_for(self.processor.drained.wait(), 5)
+            for task in tasks:
+                task.cancel()
+
+        with self.assertLogs("Transaction Processor", "INFO") as logs:
+            async_to_sync(run)()
+        return logs.output
+
+    def test_transfers_from_one_wallet_settle_in_delivery_order(self):
+        # the source wallet holds 10, whichever transfer settles first leaves too little for the other
+        bodies = [self.transfer(self.users[1], "9.6"), self.transfer(self.users[2], "0.5")]
+        first = self.processor.processor.decode(bodies[0])["identifier"]
+        settled = []
+
+        settle = self.processor.processor.settle
+
+        def record_settle(transaction_info, transaction, is_transaction_valid):
+            settled.append(transaction_info["identifier"])
+            settle(transaction_info, transaction, is_transaction_valid)
+        self.processor.processor.settle = record_settle
+
+        verify = self.processor.verify
+
+        async def slow_first_verify(item):
+            # the second transfer reaches the commit stage first
+            if item.transaction_info["identifier"] == first:
+                await asyncio.sleep(0.1)
+            await verify(item)
+        self.processor.verify = slow_first_verify
+
+        messages = [FakeMessage(body) for body in bodies]
+        self.run_pipeline(messages)
+
+        self.assertEqual(settled, [first, self.processor.processor.decode(bodies[1])["identifier"]])
+        self.assertEqual([message.acked for message in messages], [True, True])
+        self.assertEqual(
+            list(Transaction.objects.order_by("-amount").values_list("state", flat=True)), ["Confirmed", "Rejected"])
+        self.assertEqual(self.processor.wallet_tails, {})
+
+    def test_settled_transfer_is_not_failed_when_the_ack_fails(self):
+        message = FakeMessage(self.transfer(self.users[1], "0.5"))
+        message.ack = mock.AsyncMock(side_effect=ConnectionError("channel closed"))
+        self.processor.fail = mock.AsyncMock()
+
+        logs = self.run_pipeline([message])
+
+        self.processor.fail.assert_not_called()
+        self.assertIn("Could not ack settled transaction", logs[-1])
+        self.assertEqual(Transaction.objects.get().state, "Confirmed")
+        self.assertEqual((self.processor.in_flight, self.processor.wallet_tails), (0, {}))
+
+
+class LaneSchedulerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        patcher = mock.patch("utils.lanes.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = LaneScheduler({"interactive": 3, "bulk": 1}, max_wait=5)
+
+    def drain(self):
+        lanes = []
+        while True:
+            popped = self.scheduler.pop()
+            if popped is None:
+                return lanes
+            lanes.append(popped[0])
+
+    def test_lanes_are_served_in_proportion_to_their_weight(self):
+        for index in range(8):
+            self.scheduler.push("interactive", index)
+            self.scheduler.push("bulk", index)
+
+        rounds = [["interactive"] * 3 + ["bulk"], ["interactive"] * 3 + ["bulk"], ["interactive"] * 2 + ["bulk"] * 6]
+        self.assertEqual(self.drain(), sum(rounds, []))
+
+    def test_idle_lane_hands_its_turn_over(self):
+        for index in range(4):
+            self.scheduler.push("bulk", index)
+        self.assertEqual(self.drain(), ["bulk"] * 4)
+        self.assertIsNone(self.scheduler.pop())
+
+    def test_message_waiting_too_long_is_served_next(self):
+        self.scheduler.push("bulk", "old")
+        self.scheduler.push("bulk", "older than its turn")
+        for index in range(6):
+            self.scheduler.push("interactive", index)
+        self.assertEqual(self.scheduler.pop()[0], "interactive")
+
+        self.now = 6
+        lane, item, waited = self.scheduler.pop()
+        self.assertEqual((lane, item, waited), ("bulk", "old", 6))
+        self.assertEqual(self.scheduler.pop()[1], "older than its turn")
+
+    def test_weights_below_one_are_rejected(self):
+        with self.assertRaises(ValueError):
+            LaneScheduler({"interactive": 4, "bulk": 0}, max_wait=5)
+
+
+class EventStreamTests(SimpleTestCase):
+
+    def test_encode_event(self):
+        event = {"event": "state", "identifier": "1234", "state": "Confirmed"}
+        self.assertEqual(
+            encode_event(event),
+            b'event: state\nid: 1234\ndata: {"identifier": "1234", "state": "Confirmed"}\n\n')
+        # the event is not consumed, every subscriber encodes the same one
+        self.assertEqual(event["event"], "state")
+        self.assertEqual(encode_event({"event": "overflow"}), b"event: overflow\ndata: {}\n\n")
+
+    @override_settings(EVENTS_SUBSCRIBER_BUFFER=3)
+    def test_subscriber_falling_behind_gets_overflow(self):
+        bus = EventBus()
+
+        async def subscribe_and_publish():
+            loop = asyncio.get_running_loop()
+            queue = bus.subscribe("target", loop)
+            for index in range(5):
+                bus.publish({"event": "state", "identifier": index, "source_user": "source",
+                             "target_user": "target"})
+            # publish hands the events to the loop
+            await asyncio.sleep(0)
+            events = [queue.get_nowait() for _ in range(queue.qsize())]
+            bus.unsubscribe("target", loop, queue)
+            return events
+
+        events = asyncio.run(subscribe_and_publish())
+        self.assertEqual([event.get("identifier") for event in events], [0, 1, None])
+        self.assertEqual(events[-1], {"event": "overflow"})
+        self.assertEqual(bus.subscriber_count(), 0)
+
+    def stream(self, method="GET", headers=()):
+        scope = {"type": "http", "method": method, "path": "/api/transaction-events/",
+                 "headers": list(headers), "query_string": b""}
+        sent = []
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(transaction_events(scope, receive, send))
+        return sent[0]["status"], json.loads(sent[1]["body"])
+
+    def test_events_need_get(self):
+        status, body = self.stream(method="POST")
+        self.assertEqual(status, 405)
+        self.assertEqual(body, {"detail": 'Method "POST" not allowed.'})
+
+    def test_events_need_a_valid_token(self):
+        for headers in [(), [(b"authorization", b"Bearer not-a-token")]]:
+            with self.subTest(headers=headers):
+                status, _ = self.stream(headers=headers)
+                self.assertEqual(status, 401)
+
+
+class PrefetchControllerTests(SimpleTestCase):
+
+    def controller(self, initial=4):
+        # commits are steered towards 50ms, the window stays between 2 and 8 messages
+        return PrefetchController(minimum=2, maximum=8, initial=initial, target_latency=0.05)
+
+    def test_prefetch_window(self):
+        fast, slow = 0.01, 0.2
+        cases = [
+            # name, initial window, observed (commit latency, in flight), expected returns
+            ("slow commits halve the window", 4, [(slow, 4)], [2]),
+            ("fast commits with a full window grow it", 4, [(fast, 4)], [5]),
+            ("fast commits with room left keep it", 4, [(fast, 3)], [None]),
+            ("commits near the target keep it", 4, [(0.03, 4)], [None]),
+            ("the window does not shrink below the minimum", 4, [(slow, 4)] + [(slow, 2)] * 3, [2, None, None, None]),
+            ("the window does not grow above the maximum", 8, [(fast, 8)], [None]),
+            # a change waits for a full window of messages at the new size before the next one
+            ("cooldown", 4, [(fast, 4)] + [(fast, 5)] * 6, [5] + [None] * 5 + [6]),
+            # the latency is a moving average, a single slow commit is not a trend
+            ("a single slow commit", 4, [(fast, 0), (slow, 0), (slow, 0)], [None, None, 2]),
+        ]
+        for name, initial, observations, expected in cases:
+            with self.subTest(name):
+                controller = self.controller(initial)
+                self.assertEqual(
+                    [controller.observe(latency, in_flight) for latency, in_flight in observations], expected)
+                self.assertEqual(controller.prefetch, [initial, *filter(None, expected)][-1])
+
+    def test_initial_window_is_clamped(self):
+        self.assertEqual(self.controller(initial=100).prefetch, 8)
+        self.assertEqual(self.controller(initial=0).prefetch, 2)
+
+
+class SpoolTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.published = []
+
+    def publish(self, queue, body):
+        self.published.append((queue, body))
+
+    def files(self):
+        return sorted(os.path.splitext(name)[1] for name in os.listdir(self.directory))
+
+    def spool(self, *bodies):
+        spool = Spool(self.directory)
+        for body in bodies:
+            spool.append({"queue": "transactions.bitcoin.interactive", "body": body})
+        return spool
+
+    def test_rotated_spool_is_drained(self):
+        spool = self.spool("first", "second")
+        self.assertTrue(spool.rotate())
+        self.assertEqual(self.files(), [".draining"])
+        self.assertFalse(spool.rotate())
+
+        self.assertEqual(drain(self.directory, self.publish), 2)
+        self.assertEqual([body for _, body in self.published], ["first", "second"])
+        self.assertEqual(self.files(), [])
+
+    def test_drain_resumes_after_the_last_published_record(self):
+        self.spool("first", "second", "third").rotate()
+
+        def publish_until_broker_fails(queue, body):
+            if body == "second":
+                raise ConnectionError("broker unavailable")
+            self.publish(queue, body)
+        with self.assertRaises(ConnectionError):
+            drain(self.directory, publish_until_broker_fails)
+        self.assertEqual(self.files(), [".draining", ".offset"])
+
+        self.assertEqual(drain(self.directory, self.publish), 2)
+        self.assertEqual([body for _, body in self.published], ["first", "second", "third"])
+        self.assertEqual(self.files(), [])
+
+    def test_torn_last_record_is_skipped(self):
+        # a process died while it wrote its last record, the record was never acknowledged
+        with open(os.path.join(self.directory, "dead-host-1.spool"), "w") as spool_file:
+            spool_file.write('{"queue": "transactions.bitcoin.interactive", "body": "written"}\n{"queue": "tra')
+
+        self.assertEqual(drain(self.directory, self.publish), 1)
+        self.assertEqual(self.published, [("transactions.bitcoin.interactive", "written")])
+        self.assertEqual(self.files(), [])
+
+    def test_spool_of_a_live_process_is_left_alone(self):
+        spool = self.spool("in use")
+        self.addCleanup(spool._file.close)
+
+        self.assertEqual(drain(self.directory, self.publish), 0)
+        self.assertEqual(self.files(), [".spool"])
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0
+        patcher = mock.patch("utils.backpressure.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    def test_open_half_open_close(self):
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertTrue(self.breaker.is_open)
+        self.assertFalse(self.breaker.allow())
+
+        # half open, a single trial call goes through
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        # the trial failed, open for another reset_timeout
+        self.breaker.failure()
+        self.now = 19
+        self.assertFalse(self.breaker.allow())
+
+        self.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertFalse(self.breaker.is_open)
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+        # the count of failures in a row starts over
+        self.breaker.failure()
+        self.assertFalse(self.breaker.is_open)
@@ -1,6 +1,7 @@
 from django.urls import path
 from backendservice.views import (RegistrationAPIView, LoginAPIView, BitcoinWalletAPIView,
-                                  EthereumWalletAPIView, TransactionsAPIView, TransactionStatusAPIView, TransactionHistoryAPIView)
+                                  EthereumWalletAPIView, TransactionsAPIView, TransactionStatusAPIView, TransactionHistoryAPIView,
+                                  TransactionStatsAPIView, StatementAPIView)
 
 
 urlpatterns = [
@@ -11,4 +12,6 @@ urlpatterns = [
     path("transaction/", TransactionsAPIView.as_view(), name="transaction"),
     path("transaction/<transaction_identifier>/status/", TransactionStatusAPIView.as_view(), name="transaction-status"),
     path("transaction-history/", TransactionHistoryAPIView.as_view(), name="transaction-history"),
+    path("transaction-stats/", TransactionStatsAPIView.as_view(), name="transaction-stats"),
+    path("statement/", StatementAPIView.as_view(), name="statement"),
 ]
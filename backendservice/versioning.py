@@ -0,0 +1,107 @@
+import zlib
+import hashlib
+from django.conf import settings
+from django.db.models import F
+from django.utils.http import parse_etags, quote_etag
+
+from backendservice.models import VersionTag
+
+
+# one tag per cached read: the history of each user, and VERSION_TAG_SHARDS tags each for the
+# wallet list of each currency and for the transaction list. A bump holds the row of its tag
+# locked until the change commits, the lists every user writes to are split over several rows
+# picked by user so that writers of different users rarely wait on one another
+
+
+def _shard(user):
+    return zlib.crc32(str(user).encode()) % settings.VERSION_TAG_SHARDS
+
+
+def wallets_key(currency_type, user):
+    return f'wallets:{currency_type}:{_shard(user)}'
+
+
+def wallets_keys(currency_type):
+    '''
+        :return: every key of the wallet list of the currency
+    '''
+    return [f'wallets:{currency_type}:{shard}' for shard in range(settings.VERSION_TAG_SHARDS)]
+
+
+def transactions_key(user):
+    return f'transactions:{_shard(user)}'
+
+
+def transactions_keys():
+    '''
+        :return: every key of the transaction list
+    '''
+    return [f'transactions:{shard}' for shard in range(settings.VERSION_TAG_SHARDS)]
+
+
+def history_key(user):
+    return f'history:{user}'
+
+
+def bump(*keys):
+    '''
+        - increments the version of every key, creating the missing ones
+        - call it in the atomic block of the change: the new tag commits with the new data or not
+          at all, and readers fetch the tags before the data, so no client keeps old data under a new tag
+    '''
+    keys = set(keys)
+    updated = VersionTag.objects.filter(key__in=keys).update(version=F("version") + 1)
+    if updated == len(keys):
+        return
+
+    missing = keys - set(VersionTag.objects.filter(key__in=keys).values_list("key", flat=True))
+    # a key created meanwhile by another writer is left as it is and still incremented
+    VersionTag.objects.bulk_create([VersionTag(key=key, version=0) for key in missing], ignore_conflicts=True)
+    VersionTag.objects.filter(key__in=missing).update(version=F("version") + 1)
+
+
+def transaction_keys(source_user, target_user):
+    '''
+        :return: the keys of the reads showing a transaction between the two users
+    '''
+    return transactions_key(source_user), history_key(source_user), history_key(target_user)
+
+
+def compute_etag(request, keys, scope=()):
+    '''
+        :param scope: values the view resolved from defaults rather than from the request, e.g. the
+                      current month, so the etag changes when they do
+        :return: an etag for the response to the request, built from the key versions only
+    '''
+    versions = dict(VersionTag.objects.filter(key__in=keys).values_list("key", "version"))
+    tag = ";".join(f'{key}:{versions.get(key, 0)}' for key in sorted(keys))
+    # query parameters select different data, the browsable api renders the same data differently
+    tag = f'{tag};{request.get_full_path()};{request.accepted_renderer.format}'
+    if scope:
+        tag = f'{tag};{";".join(str(value) for value in scope)}'
+    return quote_etag(hashlib.md5(tag.encode()).hexdigest())
+
+
+def conditional_response(request, keys, payload, scope=()):
+    '''
+        :param keys: version keys of the data behind the response
+        :param scope: values the data depends on besides the request and the keys, see compute_etag
+        :param payload: builds the response data, only called when the client copy is stale
+        :return: 304 Not Modified when If-None-Match holds the current etag, the data otherwise
+    '''
+    # imported here, the processors bump versions but never build responses and skip loading drf
+    from rest_framework import status
+    from rest_framework.response import Response
+
+    etag = compute_etag(request, keys, scope)
+    client_etags = parse_etags(request.META.get("HTTP_IF_NONE_MATCH", ""))
+
+    if "*" in client_etags or etag in [client_etag.replace("W/", "", 1) for client_etag in client_etags]:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(payload(), status=status.HTTP_200_OK)
+
+    response["ETag"] = etag
+    # clients may keep the response but must revalidate it on every use
+    response["Cache-Control"] = "private, no-cache"
+    return response
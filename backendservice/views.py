@@ -1,14 +1,27 @@
+import datetime
+import contextlib
+from django.conf import settings
+from django.db import transaction as db_transaction
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import generics, status
 from rest_framework.response import Response
 from rest_framework.exceptions import NotFound
 from rest_framework.permissions import IsAuthenticated
+import sentry_sdk
 from sentry_sdk import capture_exception
 
 
 from utils.producer import transaction_producer
-from backendservice.serializers import (UserRegisterSerializer, UserLoginSerializer, BitcoinWalletSerializer, EthereumWalletSerializer, TransactionsSerializer, TransactionHistorySerializer)
-from backendservice.models import User, BitcoinWallet, EthereumWallet, Transaction, TransactionHistory
+from backendservice.serializers import (UserRegisterSerializer, UserLoginSerializer, BitcoinWalletSerializer, EthereumWalletSerializer, TransactionsSerializer, TransactionHistorySerializer,
+                                        TransactionHistoryQuerySerializer, TransactionStatsQuerySerializer, TransactionTotalsSerializer, DailyTransactionAggregateSerializer,
+                                        StatementQuerySerializer)
+from backendservice.models import (User, BitcoinWallet, EthereumWallet, Transaction, DailyTransactionAggregate,
+                                   ArchivedTransaction)
+from backendservice.fast_serializers import serialize_wallets, serialize_transactions, serialize_history
+from backendservice import idempotency
+from backendservice.checkpoints import currency_types, rounded, transfers, opening
+from backendservice.versioning import conditional_response, wallets_keys, history_key, transactions_keys
 from utils.gen_key_sign_verify import GenKeySignAndVerify
 
 
@@ -45,22 +58,21 @@ class BitcoinWalletAPIView(generics.ListCreateAPIView):
 
     def post(self, request):
         request.data["user"] = request.user.identifier
-        private_key, public_key = GenKeySignAndVerify.generate_keys()
+        with sentry_sdk.start_span(op="wallet.keygen"):
+            private_key, public_key = GenKeySignAndVerify.generate_keys(settings.WALLET_DEFAULT_CURVE)
         request.data["private_key"] = private_key
         request.data["public_key"] = public_key
+        request.data["curve"] = settings.WALLET_DEFAULT_CURVE
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        with sentry_sdk.start_span(op="db.commit", description="create wallet"):
+            serializer.save()
         payload = serializer.data
 
         return Response(payload, status=status.HTTP_201_CREATED)
 
     def list(self, request):
-        queryset = BitcoinWallet.objects.all()
-        serializer = BitcoinWalletSerializer(queryset, many=True)
-        payload = serializer.data
-
-        return Response(payload, status=status.HTTP_200_OK)
+        return conditional_response(request, wallets_keys("Bitcoin"), lambda: serialize_wallets(BitcoinWallet))
 
 
 class EthereumWalletAPIView(generics.ListCreateAPIView):
@@ -69,22 +81,21 @@ class EthereumWalletAPIView(generics.ListCreateAPIView):
 
     def post(self, request):
         request.data["user"] = request.user.identifier
-        private_key, public_key = GenKeySignAndVerify.generate_keys()
+        with sentry_sdk.start_span(op="wallet.keygen"):
+            private_key, public_key = GenKeySignAndVerify.generate_keys(settings.WALLET_DEFAULT_CURVE)
         request.data["private_key"] = private_key
         request.data["public_key"] = public_key
+        request.data["curve"] = settings.WALLET_DEFAULT_CURVE
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        with sentry_sdk.start_span(op="db.commit", description="create wallet"):
+            serializer.save()
         payload = serializer.data
 
         return Response(payload, status=status.HTTP_201_CREATED)
 
     def list(self, request):
-        queryset = EthereumWallet.objects.all()
-        serializer = EthereumWalletSerializer(queryset, many=True)
-        payload = serializer.data
-
-        return Response(payload, status=status.HTTP_200_OK)
+        return conditional_response(request, wallets_keys("Ethereum"), lambda: serialize_wallets(EthereumWallet))
 
 
 class TransactionsAPIView(generics.ListCreateAPIView):
@@ -92,6 +103,21 @@ class TransactionsAPIView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
+        # a retry with the Idempotency-Key of an earlier request gets the response of that request
+        reservation, response = idempotency.reserve(request)
+        if response is not None:
+            return response
+
+        try:
+            response = self.create_transaction(request, reservation)
+        except Exception:
+            idempotency.release(reservation)
+            raise
+        if response.status_code >= status.HTTP_400_BAD_REQUEST:
+            idempotency.release(reservation)
+        return response
+
+    def create_transaction(self, request, reservation):
         # target user
         target_user_pk = request.data["target_user"]
         currency_type = request.data["currency_type"]
@@ -109,49 +135,55 @@ class TransactionsAPIView(generics.ListCreateAPIView):
 
         WalletType = currency_types[currency_type]
 
-        try:
-            User.objects.get(pk=target_user_pk)
-        except User.DoesNotExist:
-            raise NotFound("Target user does not exist")
-
-        try:
-            WalletType.objects.get(user=target_user_pk)
-        except WalletType.DoesNotExist:
-            raise NotFound("Target user does not have a wallet")
-
-        # source user
-        source_user_pk = request.user.identifier
-        request.data["source_user"] = source_user_pk
-        source_user_wallet = None
-        try:
-            source_user_wallet = WalletType.objects.get(user=source_user_pk)
-        except WalletType.DoesNotExist:
-            raise NotFound("You don't have a wallet, please create one")
+        with sentry_sdk.start_span(op="wallet.fetch", description="target user and wallets"):
+            try:
+                User.objects.get(pk=target_user_pk)
+            except User.DoesNotExist:
+                raise NotFound("Target user does not exist")
+
+            try:
+                WalletType.objects.get(user=target_user_pk)
+            except WalletType.DoesNotExist:
+                raise NotFound("Target user does not have a wallet")
+
+            # source user
+            source_user_pk = request.user.identifier
+            request.data["source_user"] = source_user_pk
+            source_user_wallet = None
+            try:
+                source_user_wallet = WalletType.objects.get(user=source_user_pk)
+            except WalletType.DoesNotExist:
+                raise NotFound("You don't have a wallet, please create one")
 
         private_key = source_user_wallet.private_key
-        signature = GenKeySignAndVerify.sign_transaction(private_key, request.data)
+        with sentry_sdk.start_span(op="transaction.sign", description=currency_type):
+            signature = GenKeySignAndVerify.sign_transaction(private_key, request.data, source_user_wallet.curve)
         request.data["signature"] = signature
 
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        with sentry_sdk.start_span(op="db.commit", description="create transaction"):
+            # with a key, the transfer is only created while the key is still reserved by this request
+            with db_transaction.atomic() if reservation is not None else contextlib.nullcontext():
+                serializer.save()
 
-        payload = serializer.data
+                payload = serializer.data
 
-        payload["source_user"] = str(payload["source_user"])
-        payload["target_user"] = str(payload["target_user"])
+                payload["source_user"] = str(payload["source_user"])
+                payload["target_user"] = str(payload["target_user"])
+                idempotency.renew(reservation)
 
-        # add the transaction to rabbitmq for processing
-        transaction_producer(payload)
+        # add the transaction to rabbitmq for processing, batch clients can ask for
+        # the bulk lane with an X-Transfer-Lane header
+        with sentry_sdk.start_span(op="queue.publish", description="transactions"):
+            transaction_producer(payload, request.headers.get("X-Transfer-Lane"))
 
+        # stored once the transfer is queued, a failed publish releases the key and its retry runs again
+        idempotency.complete(reservation, payload, status.HTTP_201_CREATED)
         return Response(payload, status=status.HTTP_201_CREATED)
 
     def list(self, request):
-        queryset = Transaction.objects.all()
-        serializer = TransactionsSerializer(queryset, many=True)
-        payload = serializer.data
-
-        return Response(payload, status=status.HTTP_200_OK)
+        return conditional_response(request, transactions_keys(), serialize_transactions)
 
 
 class TransactionStatusAPIView(generics.ListAPIView):
@@ -160,8 +192,13 @@ class TransactionStatusAPIView(generics.ListAPIView):
 
     def get(self, request, transaction_identifier):
         try:
-            transaction = Transaction.objects.get(identifier=transaction_identifier)
-            payload = {"identifier": transaction.identifier, "status": transaction.state}
+            transaction = Transaction.objects.filter(identifier=transaction_identifier).values(
+                "identifier", "state").first()
+            if transaction is None:
+                # settled transactions end up in the archive
+                transaction = ArchivedTransaction.objects.values("identifier", "state").get(
+                    identifier=transaction_identifier)
+            payload = {"identifier": transaction["identifier"], "status": transaction["state"]}
 
             return Response(payload, status=status.HTTP_200_OK)
         except Exception as e:
@@ -173,13 +210,109 @@ class TransactionHistoryAPIView(generics.ListAPIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
+        query = TransactionHistoryQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        include_archived = query.validated_data["include_archived"]
+
         user = request.user.identifier
         try:
-            queryset = TransactionHistory.objects.filter(user=user)
-            serializer = TransactionHistorySerializer(queryset, many=True)
-
-            payload = serializer.data
-
-            return Response(payload, status=status.HTTP_200_OK)
+            return conditional_response(request, [history_key(user)], lambda: serialize_history(user, include_archived))
         except Exception as e:
             capture_exception(e)
+
+
+class TransactionStatsAPIView(generics.GenericAPIView):
+    serializer_class = DailyTransactionAggregateSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        query = TransactionStatsQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        user = request.user.identifier
+        # defaults to the current month
+        until = query.validated_data.get("until", timezone.localdate())
+        since = query.validated_data.get("since", until.replace(day=1))
+        currency_type = query.validated_data.get("currency_type", None)
+
+        def payload():
+            # read from the daily aggregates, one row per day and currency instead of one per transaction
+            days = DailyTransactionAggregate.objects.filter(user=user, day__range=(since, until)).order_by("day")
+            if currency_type is not None:
+                days = days.filter(currency_type=currency_type)
+            days = list(days)
+
+            totals = {}
+            for day in days:
+                if day.currency_type not in totals:
+                    totals[day.currency_type] = DailyTransactionAggregate(currency_type=day.currency_type)
+                total = totals[day.currency_type]
+                total.sent_amount += day.sent_amount
+                total.sent_count += day.sent_count
+                total.received_amount += day.received_amount
+                total.received_count += day.received_count
+
+            return {
+                "since": since,
+                "until": until,
+                "totals": TransactionTotalsSerializer(totals.values(), many=True).data,
+                "days": DailyTransactionAggregateSerializer(days, many=True).data,
+            }
+
+        # the aggregates of a user only change along with the user's history, the window
+        # defaults to the current month and moves on with it
+        return conditional_response(request, [history_key(user)], payload, scope=(since, until, currency_type))
+
+
+class StatementAPIView(generics.GenericAPIView):
+    serializer_class = StatementQuerySerializer
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        query = StatementQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        user = request.user.identifier
+        currency_type = query.validated_data["currency_type"]
+        # open ended by default, the statement runs up to the last transfer
+        until = query.validated_data.get("until")
+        if until is not None:
+            since = query.validated_data.get("since", until - datetime.timedelta(days=30))
+        else:
+            # the last 30 days and today, from the start of the day so the window moves once a day
+            start = timezone.localdate() - datetime.timedelta(days=30)
+            since = query.validated_data.get("since", timezone.make_aware(
+                datetime.datetime.combine(start, datetime.time())))
+
+        def payload():
+            # one snapshot, the checkpoints, balances and transfers read agree with each other
+            with db_transaction.atomic():
+                wallet = currency_types[currency_type].objects.filter(user=user).first()
+                if wallet is None:
+                    raise NotFound(f'No {currency_type} wallet found')
+
+                # starts from the nearest checkpoint, the cost does not grow with the wallet's history
+                opening_balance = balance = opening(user, currency_type, wallet, since)
+                entries = []
+                for identifier, processed, counterparty, amount in transfers(user, currency_type, since, until):
+                    balance = rounded(currency_type, balance + amount)
+                    entries.append({
+                        "transaction": identifier,
+                        "processed": processed,
+                        "counterparty": counterparty,
+                        "amount": str(amount),
+                        "balance": str(balance),
+                    })
+
+            return {
+                "currency_type": currency_type,
+                "since": since,
+                "until": until if until is not None else timezone.now(),
+                "opening_balance": str(opening_balance),
+                "closing_balance": str(balance),
+                "entries": entries,
+            }
+
+        # the statement of a user only changes along with the user's history, an open ended
+        # window takes in new transfers as they bump it
+        return conditional_response(request, [history_key(user)], payload, scope=(since, until, currency_type))
@@ -0,0 +1,233 @@
+import gc
+import os
+import sys
+import math
+import time
+import signal
+import logging
+import argparse
+import pika
+
+# sets up django once, every worker is forked from this initialised process
+from transactionprocessor import TransactionProcessor, consumed_queues
+from django.db import connections
+from utils.metrics import metrics
+from utils.producer import CURRENCY_TYPES
+
+# create logger
+logger = logging.getLogger("Processor Supervisor")
+# set logging level to info
+logger.setLevel(logging.INFO)
+
+# log to stdout next to gunicorn
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+logger.addHandler(stream_handler)
+
+
+class ProcessorSupervisor:
+
+    def __init__(self, min_workers, max_workers, messages_per_worker, poll_interval, scale_down_delay, drain_timeout,
+                 currency_type=None):
+        # the pool of one currency, run one supervisor per currency to size them independently
+        self.currency_type = currency_type
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.messages_per_worker = messages_per_worker
+        self.poll_interval = poll_interval
+        self.scale_down_delay = scale_down_delay
+        self.drain_timeout = drain_timeout
+
+        # pids of the running workers
+        self.workers = set()
+        # pids of workers asked to drain and exit
+        self.retiring = set()
+        self.stopping = False
+        self.scale_down_requested = None
+
+        self.connection = None
+        self.channel = None
+
+    def spawn(self):
+        # never share database sockets with the children
+        connections.close_all()
+        # the objects loaded so far move out of reach of the garbage collector, collections in
+        # the workers would otherwise write to them and copy every page they share with the supervisor
+        gc.collect()
+        gc.freeze()
+
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # the worker writes its own metrics, not the copy of the supervisor's
+            metrics.reset()
+            exit_code = 0
+            try:
+                TransactionProcessor(self.currency_type).consumer()
+            except Exception:
+                logger.exception(f'Worker {os.getpid()} crashed')
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        self.workers.add(pid)
+        logger.info(f'Started worker {pid} in {(time.perf_counter() - started) * 1000:.1f}ms, '
+                    f'{len(self.workers)} running')
+
+    def retire(self, count):
+        for pid in sorted(self.workers - self.retiring)[:count]:
+            # the worker finishes its current message and returns the rest to the queue
+            os.kill(pid, signal.SIGTERM)
+            self.retiring.add(pid)
+            logger.info(f'Draining worker {pid}')
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers.clear()
+                return
+            if pid == 0:
+                return
+
+            self.workers.discard(pid)
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                logger.info(f'Worker {pid} drained')
+            elif not self.stopping:
+                exit_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                # replaced on the next scaling pass
+                logger.warning(f'Worker {pid} exited unexpectedly with code {exit_code}')
+
+    def queue_depth(self):
+        '''
+            - reads the ready message count of the consumed queues with passive declares,
+              which never create the queues
+        '''
+        try:
+            if self.connection is None or self.connection.is_closed:
+                self.connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(host='localhost'))
+
+            depth = 0
+            for queue in consumed_queues(self.currency_type):
+                if self.channel is None or self.channel.is_closed:
+                    self.channel = self.connection.channel()
+                try:
+                    queue_depth = self.channel.queue_declare(queue=queue, passive=True).method.message_count
+                except pika.exceptions.ChannelClosedByBroker:
+                    # the queue does not exist yet, nothing to consume
+                    queue_depth = 0
+                metrics.set("processor_queue_depth", queue_depth, queue=queue)
+                depth += queue_depth
+            metrics.flush()
+            return depth
+        except pika.exceptions.AMQPError as e:
+            logger.warning(f'Could not read the queue depth: {e!r}')
+            self.connection = None
+            return None
+
+    def desired_workers(self, depth):
+        if depth is None:
+            # keep the current size until the broker answers again
+            return max(self.min_workers, len(self.workers - self.retiring))
+
+        desired = math.ceil(depth / self.messages_per_worker)
+        return max(self.min_workers, min(self.max_workers, desired))
+
+    def scale(self, desired):
+        active = len(self.workers - self.retiring)
+
+        if desired >= active:
+            self.scale_down_requested = None
+            # also replaces crashed workers
+            for _ in range(desired - active):
+                self.spawn()
+            return
+
+        # only scale down once the backlog has stayed small for a while
+        if self.scale_down_requested is None:
+            self.scale_down_requested = time.monotonic()
+        elif time.monotonic() - self.scale_down_requested >= self.scale_down_delay:
+            self.retire(active - desired)
+            self.scale_down_requested = None
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def drain(self):
+        for pid in self.workers:
+            os.kill(pid, signal.SIGTERM)
+        self.retiring.update(self.workers)
+
+        deadline = time.monotonic() + self.drain_timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+
+        for pid in self.workers:
+            # unacked messages of killed workers are redelivered by the broker
+            logger.warning(f'Worker {pid} did not drain in time, killing it')
+            os.kill(pid, signal.SIGKILL)
+        self.reap()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for _ in range(self.min_workers):
+            self.spawn()
+
+        while not self.stopping:
+            self.reap()
+            depth = self.queue_depth()
+            self.scale(self.desired_workers(depth))
+            time.sleep(self.poll_interval)
+
+        logger.info(f'Stopping, draining {len(self.workers)} workers')
+        self.drain()
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+        metrics.remove()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs a pool of transaction processors sized by the queue depth")
+    parser.add_argument(
+        "--min-workers", type=int, default=int(os.environ.get("PROCESSOR_MIN_WORKERS", 1)))
+    parser.add_argument(
+        "--max-workers", type=int, default=int(os.environ.get("PROCESSOR_MAX_WORKERS", os.cpu_count())))
+    parser.add_argument(
+        "--messages-per-worker", type=int, default=int(os.environ.get("PROCESSOR_MESSAGES_PER_WORKER", 100)),
+        help="Queued messages each worker is expected to absorb before another one is started")
+    parser.add_argument(
+        "--poll-interval", type=float, default=float(os.environ.get("PROCESSOR_POLL_INTERVAL", 5)),
+        help="Seconds between queue depth checks")
+    parser.add_argument(
+        "--scale-down-delay", type=float, default=float(os.environ.get("PROCESSOR_SCALE_DOWN_DELAY", 60)),
+        help="Seconds the queue must stay small before workers are retired")
+    parser.add_argument(
+        "--drain-timeout", type=float, default=float(os.environ.get("PROCESSOR_DRAIN_TIMEOUT", 30)),
+        help="Seconds workers get to finish their current message on shutdown")
+    parser.add_argument(
+        "--currency", choices=CURRENCY_TYPES,
+        help="Only run processors for the transfers of this currency, defaults to all currencies")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # the supervisors of each currency share stdout
+    stream_handler.setFormatter(logging.Formatter(f'%(asctime)s - {args.currency or "all currencies"} - %(message)s'))
+    ProcessorSupervisor(
+        min_workers=args.min_workers,
+        max_workers=args.max_workers,
+        messages_per_worker=args.messages_per_worker,
+        poll_interval=args.poll_interval,
+        scale_down_delay=args.scale_down_delay,
+        drain_timeout=args.drain_timeout,
+        currency_type=args.currency,
+    ).run()
@@ -3,8 +3,13 @@
 
 python manage.py makemigrations
 python manage.py migrate
+python manage.py generate_schema
 
-#run the app with gunicorn
-exec gunicorn backendservice.wsgi:application --bind 0.0.0.0:8000
-# start to consume transactions
-python3 transactionprocessor.py
\ No newline at end of file
+# start a pool of transaction processors per currency, each scaled with its queue depth
+python3 processorsupervisor.py --currency Bitcoin &
+python3 processorsupervisor.py --currency Ethereum &
+# the queue from before the split holds transfers of both currencies, drained by its own processor
+python3 transactionprocessor.py --legacy &
+
+#run the app with gunicorn, on uvicorn workers to serve the asgi app and its event streams
+exec gunicorn analoguebailout.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
\ No newline at end of file
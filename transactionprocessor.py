@@ -1,7 +1,12 @@
 import os
 import pika
+import argparse
+import functools
 import json
+import time
+import signal
 import django
+import contextlib
 import decimal
 import logging
 # create logger
@@ -20,19 +25,121 @@ file_handler.setFormatter(formatter)
 # add file handler to the logger
 logger.addHandler(file_handler)
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "analoguebailout.settings")
+# the web settings without the web only apps
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "analoguebailout.processor_settings")
 django.setup()
 
+from django.conf import settings
 from django.utils import timezone
-from django.db import transaction as db_transaction
+from django.utils.dateparse import parse_datetime
+from django.db import transaction as db_transaction, connections, OperationalError, InterfaceError
+import sentry_sdk
 from sentry_sdk import capture_exception
 from backendservice.models import User, BitcoinWallet, EthereumWallet, Transaction
+from backendservice.aggregates import record_transfer
+from backendservice.checkpoints import count_transfer
+from backendservice.versioning import bump, wallets_key, transaction_keys
+from utils.events import publish_state_change
 from utils.gen_key_sign_verify import GenKeySignAndVerify
+from utils.metrics import metrics
+from utils.backpressure import PrefetchController
+from utils.profiling import MessageProfiler
+from utils.tracing import sampled_transaction
+from utils.lanes import LaneScheduler
+from utils.producer import currency_queue, lane_queue, LEGACY_QUEUE, CURRENCY_TYPES, LANES, INTERACTIVE_LANE
+
+# database timeouts, deadlocks and dropped connections, worth trying again later
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+# each retry tier waits RETRY_BASE_DELAY * RETRY_BACKOFF ** (attempt - 1) milliseconds
+MAX_RETRIES = int(os.environ.get("PROCESSOR_MAX_RETRIES", 5))
+RETRY_BASE_DELAY = int(os.environ.get("PROCESSOR_RETRY_BASE_DELAY", 1000))
+RETRY_BACKOFF = int(os.environ.get("PROCESSOR_RETRY_BACKOFF", 4))
+
+# bounds of the prefetch window and the commit latency, in milliseconds, it is steered towards
+PREFETCH_MIN = int(os.environ.get("PROCESSOR_PREFETCH_MIN", 1))
+PREFETCH_MAX = int(os.environ.get("PROCESSOR_PREFETCH_MAX", 256))
+PREFETCH_INITIAL = int(os.environ.get("PROCESSOR_PREFETCH_INITIAL", 16))
+COMMIT_LATENCY_TARGET = int(os.environ.get("PROCESSOR_COMMIT_LATENCY_TARGET", 50))
+
+# messages profiled once the profiler is armed, a value set in the environment arms it at startup
+PROFILE_MESSAGES = int(os.environ.get("PROCESSOR_PROFILE_MESSAGES", 0))
+
+
+class AlreadySettled(Exception):
+    # another delivery of the same message settled the transaction meanwhile
+    pass
+
+
+def consumed_queues(currency_type=None, lane=None):
+    '''
+        - LEGACY_QUEUE holds transfers of every currency, only processors of all currencies drain it
+        :param currency_type: consume only the transfers of this currency, all currencies when None
+        :param lane: consume only the queues of this lane, all lanes when None
+        :return: the queues to consume, the queues from before the lanes are drained
+                 as part of the interactive lane
+    '''
+    currency_types = [currency_type] if currency_type else CURRENCY_TYPES
+    lanes = [lane] if lane else LANES
+    queues = [lane_queue(currency_type, lane) for lane in lanes for currency_type in currency_types]
+    if INTERACTIVE_LANE in lanes:
+        queues += [currency_queue(currency_type) for currency_type in currency_types]
+        if currency_type is None:
+            queues.append(LEGACY_QUEUE)
+    return queues
+
+
+def retry_queues(queue):
+    '''
+        - messages wait out their ttl in a retry queue, then dead-letter back to the queue they came from
+    '''
+    return [
+        (f'{queue}.retry.{attempt}', {
+            "x-message-ttl": RETRY_BASE_DELAY * RETRY_BACKOFF ** (attempt - 1),
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": queue,
+        })
+        for attempt in range(1, MAX_RETRIES + 1)
+    ]
+
+
+def failure_route(queue, headers, error):
+    '''
+        - transient errors go to the next retry tier of the queue until the retries run out
+        - everything else is parked
+        :param queue: the queue the message was consumed from
+        :return: the queue to republish the message to and its new headers
+    '''
+    headers = dict(headers or {})
+
+    if isinstance(error, TRANSIENT_ERRORS):
+        attempt = headers.get("x-retry-count", 0) + 1
+        if attempt <= MAX_RETRIES:
+            headers["x-retry-count"] = attempt
+            return f'{queue}.retry.{attempt}', headers
+
+    headers["x-error"] = repr(error)
+    return f'{queue}.parking', headers
+
+
+def record_failure(queue, headers, error):
+    if queue.endswith('.parking'):
+        capture_exception(error)
+        metrics.incr("processor_messages_parked_total", error=error.__class__.__name__)
+        logger.error(f'Transaction processing failed with {error!r}, message parked')
+    else:
+        attempt = headers["x-retry-count"]
+        metrics.incr("processor_messages_retried_total", attempt=attempt)
+        logger.warning(f'Transaction processing failed with {error!r}, retry {attempt} of {MAX_RETRIES} scheduled')
 
 
 class TransactionProcessor:
 
-    def __init__(self):
+    def __init__(self, currency_type=None, legacy=False):
+        # transfers of this currency only, all of them when None
+        self.currency_type_filter = currency_type
+        # drains LEGACY_QUEUE only, next to pools that each consume a single currency
+        self.legacy = legacy
         self.currency_type = {
             "Bitcoin": BitcoinWallet,
             "Ethereum": EthereumWallet
@@ -43,95 +150,313 @@ class TransactionProcessor:
             "Ethereum": "ETH"
         }
 
-    def processor(self, body):
+        # seconds the last database commit took, None when the message did not commit
+        self.last_commit_latency = None
+        # the last decoded message, None when it could not be decoded
+        self.last_transaction_info = None
 
+        # SIGUSR1 profiles the next messages, 100 unless PROCESSOR_PROFILE_MESSAGES says otherwise
+        self.profiler = MessageProfiler(PROFILE_MESSAGES or 100, armed=bool(PROFILE_MESSAGES))
+
+    @contextlib.contextmanager
+    def commit(self):
+        started = time.perf_counter()
+        with db_transaction.atomic():
+            yield
+        self.last_commit_latency = time.perf_counter() - started
+
+    def decode(self, body):
         transaction_info = json.loads(body)
+        transaction_info["amount"] = float(transaction_info['amount'])
+        return transaction_info
+
+    def fetch(self, transaction_info):
+        '''
+            :return: the source wallet and the transaction, no wallet when the transaction is already settled
+        '''
+        WalletType = self.currency_type[transaction_info["currency_type"]]
+
+        # get the transaction first, a redelivered message of a settled transaction stops here
+        transaction = Transaction.objects.get(identifier=transaction_info["identifier"])
+        if transaction.state != "Unconfirmed":
+            return None, transaction
+
+        # get the source wallet
+        source_wallet = WalletType.objects.get(user=transaction_info['source_user'])
+        # make sure the target wallet exists
+        WalletType.objects.get(user=transaction_info['target_user'])
+
+        return source_wallet, transaction
+
+    def skip(self, transaction_info, transaction):
+        metrics.incr("processor_messages_skipped_total", currency=transaction_info["currency_type"])
+        logger.info(f'{transaction_info["currency_type"]} transaction {transaction.identifier} skipped: already settled')
+
+    @staticmethod
+    def save_state(transaction):
+        '''
+            - saves the state and processed time of the transaction, as long as it is still unconfirmed
+            - raises AlreadySettled otherwise, which rolls back the surrounding commit
+        '''
+        updated = Transaction.objects.filter(identifier=transaction.identifier, state="Unconfirmed").update(
+            state=transaction.state, processed=transaction.processed)
+        if not updated:
+            raise AlreadySettled(transaction.identifier)
+
+    @staticmethod
+    def signed_data(transaction_info):
+        return {
+            "target_user": transaction_info['target_user'],
+            "currency_type": transaction_info["currency_type"],
+            "amount": transaction_info['amount'],
+            "source_user": transaction_info['source_user'],
+        }
+
+    def settle(self, transaction_info, transaction, is_transaction_valid):
         currency_type = transaction_info["currency_type"]
         source_user_uid = transaction_info['source_user']
         target_user_uid = transaction_info['target_user']
-        signature = transaction_info['signature']
-        transaction_amount = float(transaction_info['amount'])
+        transaction_amount = transaction_info['amount']
 
         currency_type_abb = self.currency_type_abb[currency_type]
         WalletType = self.currency_type[currency_type]
 
-        try:
-            # get the source wallet
-            source_wallet = WalletType.objects.get(user=source_user_uid)
-            # get the target wallet
-            target_user_wallet = WalletType.objects.get(user=target_user_uid)
-            # get the transaction
-            transaction = Transaction.objects.get(identifier=transaction_info["identifier"])
-            # get the private key to verify the transaction
-            signed_data = {
-                "target_user": target_user_uid,
-                "currency_type": currency_type,
-                "amount": transaction_amount,
-                "source_user": source_user_uid,
-            }
-            is_transaction_valid = GenKeySignAndVerify.verify_transaction_signature(
-                source_wallet.public_key, signature, signed_data)
+        # if transaction is valid
+        if is_transaction_valid:
 
-            # if transaction is valid
-            if is_transaction_valid:
+            if source_user_uid == target_user_uid:
+                with self.commit():
+                    transaction.state = "Rejected"
+                    transaction.processed = timezone.now()
+                    self.save_state(transaction)
+                    publish_state_change(transaction)
+                    bump(*transaction_keys(source_user_uid, target_user_uid))
+                logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  rejected: Cannot send coins to your own account')
+            else:
+                with self.commit():
+                    # lock both wallets in a fixed order, other workers may be moving money on them
+                    locked_wallets = {
+                        str(wallet.user_id): wallet
+                        for wallet in WalletType.objects.select_for_update().filter(
+                            user__in=[source_user_uid, target_user_uid]).order_by("identifier")
+                    }
+                    source_wallet = locked_wallets[source_user_uid]
+                    target_user_wallet = locked_wallets[target_user_uid]
 
-                if source_user_uid == target_user_uid:
-                    with db_transaction.atomic():
-                        transaction.state = "Rejected"
-                        transaction.processed = timezone.now()
-                        transaction.save()
-                    logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  rejected: Cannot send coins to your own account')
-                else:
                     # check the ballance
-                    source_wallet_balance = source_wallet.balance
-
-                    if source_wallet_balance > transaction_amount:
-                        with db_transaction.atomic():
-                            # increase balance to the target
-                            target_user_wallet.balance = target_user_wallet.balance + decimal.Decimal(transaction_amount)
-                            target_user_wallet.save()
-                            # decrese balance from the source
-                            source_wallet.balance = source_wallet.balance - decimal.Decimal(transaction_amount)
-                            source_wallet.save()
-                            # update transaction state and time
-                            transaction.state = "Confirmed"
-                            transaction.processed = timezone.now()
-                            transaction.save()
-                        logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  successful')
-                    else:
-                        with db_transaction.atomic():
-                            transaction.state = "Rejected"
-                            transaction.processed = timezone.now()
-                            transaction.save()
-                        logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  rejected: Balance to low to complete transaction')
-            else:
-                with db_transaction.atomic():
-                    transaction.state = "Rejected"
+                    is_balance_enough = source_wallet.balance > transaction_amount
+
                     transaction.processed = timezone.now()
-                    transaction.save()
-                logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  rejected: Transaction is in valid')
-        except Exception as e:
-            capture_exception(e)
+                    if is_balance_enough:
+                        # increase balance to the target
+                        target_user_wallet.balance = target_user_wallet.balance + decimal.Decimal(transaction_amount)
+                        count_transfer(target_user_wallet, currency_type, transaction)
+                        target_user_wallet.save()
+                        # decrese balance from the source
+                        source_wallet.balance = source_wallet.balance - decimal.Decimal(transaction_amount)
+                        count_transfer(source_wallet, currency_type, transaction)
+                        source_wallet.save()
+                        # update transaction state
+                        transaction.state = "Confirmed"
+                    else:
+                        transaction.state = "Rejected"
+                    self.save_state(transaction)
+                    publish_state_change(transaction)
+                    if is_balance_enough:
+                        record_transfer(currency_type, source_user_uid, target_user_uid, transaction.amount,
+                                        transaction.processed)
+                        bump(wallets_key(currency_type, source_user_uid), wallets_key(currency_type, target_user_uid),
+                             *transaction_keys(source_user_uid, target_user_uid))
+                    else:
+                        bump(*transaction_keys(source_user_uid, target_user_uid))
+
+                if is_balance_enough:
+                    logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  successful')
+                else:
+                    logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  rejected: Balance to low to complete transaction')
+        else:
+            with self.commit():
+                transaction.state = "Rejected"
+                transaction.processed = timezone.now()
+                self.save_state(transaction)
+                publish_state_change(transaction)
+                bump(*transaction_keys(source_user_uid, target_user_uid))
+            logger.info(f'{currency_type} transaction of value {transaction_amount} {currency_type_abb} from {source_user_uid} to {target_user_uid}  rejected: Transaction is in valid')
+
+    def processor(self, body):
+        with self.profiler.profile():
+            self.process(body)
+
+    def record_lag(self, transaction_info, lane):
+        '''
+            - seconds from the submission of the transfer to the end of its processing, per currency and lane
+        '''
+        created = parse_datetime(transaction_info.get("created") or "")
+        if created is not None:
+            metrics.observe("processor_lag_seconds", (timezone.now() - created).total_seconds(),
+                            currency=transaction_info["currency_type"], lane=lane)
+
+    def process(self, body):
+
+        transaction_info = self.decode(body)
+        self.last_transaction_info = transaction_info
+        with sentry_sdk.start_span(op="wallet.fetch", description="source wallet and transaction"):
+            source_wallet, transaction = self.fetch(transaction_info)
+        if source_wallet is None:
+            return self.skip(transaction_info, transaction)
+
+        # verify the transaction with the source wallet public key
+        with sentry_sdk.start_span(op="signature.verify", description=transaction_info["currency_type"]):
+            is_transaction_valid = GenKeySignAndVerify.verify_transaction_signature(
+                source_wallet.public_key, transaction_info['signature'], self.signed_data(transaction_info),
+                source_wallet.curve)
+
+        with sentry_sdk.start_span(op="db.commit", description="settle transaction"):
+            try:
+                self.settle(transaction_info, transaction, is_transaction_valid)
+            except AlreadySettled:
+                self.skip(transaction_info, transaction)
+
+    def queues(self, lane=None):
+        '''
+            :return: the queues this processor consumes, of the given lane or of all lanes when None
+        '''
+        if self.legacy:
+            return [LEGACY_QUEUE] if lane in (None, INTERACTIVE_LANE) else []
+        return consumed_queues(self.currency_type_filter, lane)
+
+    def declare_queues(self, channel):
+        for queue in self.queues():
+            channel.queue_declare(queue=queue, durable=True)
+
+            for retry_queue, arguments in retry_queues(queue):
+                channel.queue_declare(queue=retry_queue, durable=True, arguments=arguments)
+
+            # messages that can never succeed, kept for inspection and manual replay
+            channel.queue_declare(queue=f'{queue}.parking', durable=True)
+
+    def publish(self, channel, queue, body, headers):
+        channel.basic_publish(exchange='',
+                              routing_key=queue,
+                              body=body,
+                              properties=pika.BasicProperties(
+                                  delivery_mode=2,
+                                  headers=headers,
+                              ))
+
+    def fail(self, channel, method, properties, body, error):
+        queue, headers = failure_route(method.routing_key, properties.headers, error)
+        with sentry_sdk.start_span(op="queue.publish", description=queue):
+            self.publish(channel, queue, body, headers)
+        record_failure(queue, headers, error)
 
     def consumer(self):
         connection = pika.BlockingConnection(
             pika.ConnectionParameters(host='localhost'))
 
-        channel = connection.channel()
+        prefetch_controller = PrefetchController(
+            minimum=PREFETCH_MIN,
+            maximum=PREFETCH_MAX,
+            initial=PREFETCH_INITIAL,
+            target_latency=COMMIT_LATENCY_TARGET / 1000,
+        )
+
+        # a channel per lane so bulk deliveries can not fill the prefetch window of the
+        # interactive lane, a channel wide limit, unlike a per consumer one, can be resized
+        # while consuming
+        channels = {}
+        for lane in LANES:
+            channel = connection.channel()
+            # retried and parked messages must reach the broker before the original is acked
+            channel.confirm_delivery()
+            channel.basic_qos(prefetch_count=prefetch_controller.prefetch, global_qos=True)
+            channels[lane] = channel
+        metrics.set("processor_prefetch_count", prefetch_controller.prefetch)
 
-        channel.queue_declare(queue='transactions', durable=True)
+        self.declare_queues(channels[INTERACTIVE_LANE])
+
+        # deliveries wait here until the scheduler picks their lane
+        scheduler = LaneScheduler(settings.TRANSFER_LANE_WEIGHTS, settings.TRANSFER_LANE_MAX_WAIT)
 
         print(' [*] Waiting for logs. To exit press CTRL+C')
 
-        def callback(ch, method, properties, body):
-            self.processor(body)
+        def deliver(lane, ch, method, properties, body):
+            scheduler.push(lane, (ch, method, properties, body, time.perf_counter()))
+
+        def handle(lane, ch, method, properties, body):
+            self.last_commit_latency = None
+            self.last_transaction_info = None
+            with sampled_transaction("queue.process", "TransactionProcessor.processor") as trace:
+                try:
+                    self.processor(body)
+                    metrics.incr("processor_messages_processed_total", currency=self.last_transaction_info["currency_type"])
+                except TRANSIENT_ERRORS as e:
+                    trace.set_status("unavailable")
+                    # the connection may be broken, the next message reconnects
+                    connections.close_all()
+                    self.fail(ch, method, properties, body, e)
+                except Exception as e:
+                    trace.set_status("internal_error")
+                    self.fail(ch, method, properties, body, e)
             ch.basic_ack(delivery_tag=method.delivery_tag)
+            if self.last_transaction_info is not None:
+                self.record_lag(self.last_transaction_info, lane)
+
+            if self.last_commit_latency is not None:
+                # delivered messages still buffered locally, plus the one just handled
+                in_flight = len(scheduler) + 1
+                prefetch = prefetch_controller.observe(self.last_commit_latency, in_flight)
+                if prefetch is not None:
+                    for channel in channels.values():
+                        channel.basic_qos(prefetch_count=prefetch, global_qos=True)
+                    metrics.set("processor_prefetch_count", prefetch)
+                metrics.set("processor_commit_latency_seconds", prefetch_controller.latency)
+
+        stopping = []
+
+        def stop(signum, frame):
+            # the message being processed is still committed and acked,
+            # unacked deliveries go back to the queue when the connection closes
+            stopping.append(signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        self.profiler.install()
+
+        for lane, channel in channels.items():
+            for queue in self.queues(lane):
+                channel.basic_consume(queue=queue, on_message_callback=functools.partial(deliver, lane))
+
+        while not stopping:
+            # wait for deliveries only when there is nothing buffered to work on
+            connection.process_data_events(time_limit=0 if len(scheduler) else 1)
+            scheduled = scheduler.pop()
+            if scheduled is None:
+                continue
+
+            lane, (ch, method, properties, body, delivered), waited = scheduled
+            handle(lane, ch, method, properties, body)
+            metrics.observe("processor_lane_wait_seconds", waited, lane=lane)
+            metrics.observe("processor_lane_latency_seconds", time.perf_counter() - delivered, lane=lane)
+            metrics.set("processor_lane_buffered", len(scheduler.buffers[lane]), lane=lane)
+            metrics.flush()
+
+        connection.close()
+        metrics.remove()
 
-        channel.basic_consume(
-            queue="transactions", on_message_callback=callback)
 
-        channel.start_consuming()
+def parse_args():
+    parser = argparse.ArgumentParser(description="Processes transactions")
+    parser.add_argument(
+        "--currency", choices=CURRENCY_TYPES,
+        help="Only process the transfers of this currency, defaults to all currencies")
+    parser.add_argument(
+        "--legacy", action="store_true",
+        help=f'Only drain the {LEGACY_QUEUE} queue, run one next to processors started with --currency')
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    TransactionProcessor().consumer()
+    args = parse_args()
+    if args.legacy and args.currency:
+        raise SystemExit("--legacy drains the transfers of every currency, it can not be combined with --currency")
+    TransactionProcessor(args.currency, legacy=args.legacy).consumer()
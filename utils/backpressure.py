@@ -0,0 +1,98 @@
+import time
+import threading
+
+
+class PrefetchController:
+    '''
+        - sizes the consumer prefetch window from the observed commit latency
+        - halves the window while commits are slower than the target latency
+        - grows it by one step while commits are fast and the whole window is in use
+    '''
+
+    def __init__(self, minimum, maximum, initial, target_latency, smoothing=0.2, step=1):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.prefetch = max(minimum, min(maximum, initial))
+        self.target_latency = target_latency
+        self.smoothing = smoothing
+        self.step = step
+        self.latency = None
+        # observations to skip before the window may change again
+        self.cooldown = 0
+
+    def observe(self, commit_latency, in_flight):
+        '''
+            :param commit_latency: seconds the last commit took
+            :param in_flight: messages delivered to the consumer and not yet acked
+            :return: the new prefetch count, or None when it did not change
+        '''
+        if self.latency is None:
+            self.latency = commit_latency
+        else:
+            # exponentially weighted moving average, a single slow commit is not a trend
+            self.latency += self.smoothing * (commit_latency - self.latency)
+
+        if self.cooldown:
+            self.cooldown -= 1
+            return None
+
+        prefetch = self.prefetch
+        if self.latency > self.target_latency:
+            prefetch = max(self.minimum, self.prefetch // 2)
+        elif self.latency < self.target_latency / 2 and in_flight >= self.prefetch:
+            prefetch = min(self.maximum, self.prefetch + self.step)
+
+        if prefetch == self.prefetch:
+            return None
+
+        # let a full window of messages go through at the new size before judging it
+        self.cooldown = prefetch
+        self.prefetch = prefetch
+        return prefetch
+
+
+class CircuitBreaker:
+    '''
+        - opens after failure_threshold failures in a row, calls then fail fast without
+          touching the failing service
+        - once reset_timeout seconds passed a single trial call is let through, its
+          success closes the circuit and its failure opens it for another reset_timeout
+    '''
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        # monotonic time the circuit opened at, None while closed
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened is not None
+
+    def allow(self):
+        '''
+            :return: whether the call may go to the service
+        '''
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.monotonic() - self.opened < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened = time.monotonic()
+            self.trial = False
@@ -0,0 +1,123 @@
+import json
+import asyncio
+import threading
+import pika
+from django.conf import settings
+from django.db import transaction as db_transaction
+from sentry_sdk import capture_exception
+
+
+# fanout exchange of the transaction state changes, every subscribed web worker gets each event
+EVENTS_EXCHANGE = "transaction-events"
+
+
+class EventBus:
+    '''
+        - in-process pub/sub of transaction state changes, subscribers are asyncio queues per user
+        - publish is thread safe, events are handed to the event loop of each subscriber
+        - a subscriber that does not keep up loses events and gets an "overflow" event instead,
+          it is told to read the current state from the api
+    '''
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user, loop):
+        queue = asyncio.Queue(settings.EVENTS_SUBSCRIBER_BUFFER)
+        with self._lock:
+            self._subscribers.setdefault(user, set()).add((loop, queue))
+        return queue
+
+    def unsubscribe(self, user, loop, queue):
+        with self._lock:
+            subscribers = self._subscribers.get(user, set())
+            subscribers.discard((loop, queue))
+            if not subscribers:
+                self._subscribers.pop(user, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    @staticmethod
+    def _put(queue, event):
+        if queue.full():
+            # keep the last slot for the overflow marker
+            return
+        if queue.qsize() == queue.maxsize - 1:
+            event = {"event": "overflow"}
+        queue.put_nowait(event)
+
+    def publish(self, event):
+        users = {event["source_user"], event["target_user"]}
+        with self._lock:
+            subscribers = [subscriber for user in users for subscriber in self._subscribers.get(user, ())]
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, event)
+            except RuntimeError:
+                # the loop of a web worker that is shutting down
+                pass
+
+
+bus = EventBus()
+
+
+class FanoutPublisher:
+    '''
+        - publishes events to the fanout exchange on one connection per process
+        - events are a hint to stop polling, a broker failure drops them instead of failing the transfer
+    '''
+
+    def __init__(self):
+        self._connection = None
+        self._channel = None
+        # the asyncio processor settles transfers on several threads
+        self._lock = threading.Lock()
+
+    def publish(self, body):
+        with self._lock:
+            try:
+                if self._channel is None or self._channel.is_closed:
+                    if self._connection is None or self._connection.is_closed:
+                        self._connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
+                    self._channel = self._connection.channel()
+                    self._channel.exchange_declare(exchange=EVENTS_EXCHANGE, exchange_type="fanout")
+                self._channel.basic_publish(exchange=EVENTS_EXCHANGE, routing_key='', body=body)
+            except (pika.exceptions.AMQPError, OSError) as e:
+                capture_exception(e)
+                self._connection = None
+                self._channel = None
+
+
+fanout_publisher = FanoutPublisher()
+
+
+def state_change(transaction):
+    return {
+        "event": "state",
+        "identifier": str(transaction.identifier),
+        "state": transaction.state,
+        "currency_type": transaction.currency_type,
+        "amount": str(transaction.amount),
+        "source_user": str(transaction.source_user_id),
+        "target_user": str(transaction.target_user_id),
+        "processed": transaction.processed.isoformat() if transaction.processed else None,
+    }
+
+
+def publish_state_change(transaction):
+    '''
+        - announces the new state of the transaction once the surrounding database transaction commits
+        - the local transport publishes on the in-process bus, rabbitmq on the fanout exchange
+    '''
+    event = state_change(transaction)
+
+    def publish():
+        if settings.TRANSACTION_TRANSPORT == "local":
+            bus.publish(event)
+        else:
+            fanout_publisher.publish(json.dumps(event))
+
+    db_transaction.on_commit(publish)
@@ -1,16 +1,41 @@
 import json
+import hashlib
 from uuid import UUID
-from ecdsa import SigningKey, VerifyingKey
+from ecdsa import SigningKey, VerifyingKey, curves
 from sentry_sdk import capture_exception
 
 
+# curve name: (curve, hash function of the signed data)
+# NIST192p with sha1 are the ecdsa library defaults every wallet used before curves were selectable
+CURVES = {
+    "NIST192p": (curves.NIST192p, hashlib.sha1),
+    "NIST256p": (curves.NIST256p, hashlib.sha256),
+    "SECP256k1": (curves.SECP256k1, hashlib.sha256),
+}
+
+# ed25519 hashes the data itself, it is only available from ecdsa 0.18
+if hasattr(curves, "Ed25519"):
+    CURVES["Ed25519"] = (curves.Ed25519, None)
+
+LEGACY_CURVE = "NIST192p"
+
+
+def get_curve(curve_name):
+    '''
+        :return: the curve and the hash function to sign with
+    '''
+    if curve_name not in CURVES:
+        raise ValueError(f'Curve {curve_name} is not supported by the installed ecdsa package')
+    return CURVES[curve_name]
+
+
 class GenKeySignAndVerify:
 
     @staticmethod
-    def generate_keys():
+    def generate_keys(curve_name=LEGACY_CURVE):
         try:
-            # uses NIST192p as the curve
-            private_key = SigningKey.generate()
+            curve, _ = get_curve(curve_name)
+            private_key = SigningKey.generate(curve=curve)
             public_key = private_key.verifying_key
 
             private_key_string = private_key.to_string().hex()
@@ -30,7 +55,7 @@ class GenKeySignAndVerify:
         return f'{source}-{target}-{currency_type}-{amount}'
 
     @staticmethod
-    def sign_transaction(private_key_hex, data):
+    def sign_transaction(private_key_hex, data, curve_name=LEGACY_CURVE):
         try:
 
             signature_data = GenKeySignAndVerify.format_sig_data(data)
@@ -39,22 +64,24 @@ class GenKeySignAndVerify:
             # convert hex to by string
             private_key_bytes = bytes.fromhex(private_key_hex)
             # get the privatekey from the byte string vesrison
-            private_key = SigningKey.from_string(private_key_bytes)
-            signature = private_key.sign(data_in_byte_str)
+            curve, hashfunc = get_curve(curve_name)
+            private_key = SigningKey.from_string(private_key_bytes, curve=curve)
+            signature = private_key.sign(data_in_byte_str, hashfunc=hashfunc)
 
             return signature.hex()
         except Exception as e:
             capture_exception(e)
 
     @staticmethod
-    def verify_transaction_signature(public_key_hex, signature_hex, data):
+    def verify_transaction_signature(public_key_hex, signature_hex, data, curve_name=LEGACY_CURVE):
 
         public_key_bytes = bytes.fromhex(public_key_hex)
-        verifying_key = VerifyingKey.from_string(public_key_bytes)
+        curve, hashfunc = get_curve(curve_name)
+        verifying_key = VerifyingKey.from_string(public_key_bytes, curve=curve)
         signature = bytes.fromhex(signature_hex)
         signature_data = GenKeySignAndVerify.format_sig_data(data)
         data_in_byte_str = signature_data.encode('utf-8')
         try:
-            return verifying_key.verify(signature, data_in_byte_str)
+            return verifying_key.verify(signature, data_in_byte_str, hashfunc=hashfunc)
         except Exception as e:
             capture_exception(e)
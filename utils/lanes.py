@@ -0,0 +1,59 @@
+import time
+import collections
+
+
+class LaneScheduler:
+    '''
+        - buffers delivered messages per priority lane and hands them out with
+          weighted round robin: in every round a lane is served up to its weight
+          in messages, an idle lane's turn goes to the others
+        - starvation protection: a message that has waited longer than max_wait is
+          served next whatever its lane's weight
+    '''
+
+    def __init__(self, weights, max_wait):
+        # a lane without weight would never get credit, pop() would spin on its messages forever
+        invalid = {lane: weight for lane, weight in weights.items() if weight < 1}
+        if invalid:
+            raise ValueError(f'Lane weights must be at least 1, got {invalid}')
+        self.weights = dict(weights)
+        self.max_wait = max_wait
+        self.buffers = {lane: collections.deque() for lane in self.weights}
+        # messages each lane may still take in the current round
+        self.credits = dict(self.weights)
+        self.lanes = list(self.weights)
+        self.current = 0
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def push(self, lane, item):
+        self.buffers[lane].append((time.monotonic(), item))
+
+    def _take(self, lane):
+        received, item = self.buffers[lane].popleft()
+        return lane, item, time.monotonic() - received
+
+    def pop(self):
+        '''
+            :return: (lane, item, seconds it waited in the buffer), None when every lane is empty
+        '''
+        if not len(self):
+            return None
+
+        # the oldest head of line message, if it waited too long
+        now = time.monotonic()
+        oldest = min((buffer[0][0], lane) for lane, buffer in self.buffers.items() if buffer)
+        if now - oldest[0] > self.max_wait:
+            return self._take(oldest[1])
+
+        while True:
+            lane = self.lanes[self.current]
+            if self.buffers[lane] and self.credits[lane] > 0:
+                self.credits[lane] -= 1
+                return self._take(lane)
+
+            # the lane used its share or has nothing to send, on to the next one
+            self.current = (self.current + 1) % len(self.lanes)
+            if self.current == 0:
+                self.credits = dict(self.weights)
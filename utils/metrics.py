@@ -0,0 +1,105 @@
+import os
+import time
+import threading
+
+
+class Metrics:
+    '''
+        - in-process counters, gauges and summaries, labelled like prometheus metrics
+        - when METRICS_DIR is set they are periodically written there in the
+          prometheus text format, for the node exporter textfile collector
+    '''
+
+    def __init__(self, flush_interval=10):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # name and labels: [sum, count]
+        self._summaries = {}
+        self.flush_interval = flush_interval
+        self._last_flush = 0.0
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def incr(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            summary = self._summaries.setdefault(key, [0, 0])
+            summary[0] += value
+            summary[1] += 1
+
+    def value(self, name, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric_type, values in (("counter", self._counters), ("gauge", self._gauges)):
+                declared = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in declared:
+                        lines.append(f'# TYPE {name} {metric_type}')
+                        declared.add(name)
+                    label_string = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+                    lines.append(f'{name}{{{label_string}}} {value}' if label_string else f'{name} {value}')
+
+            declared = set()
+            for (name, labels), (total, count) in sorted(self._summaries.items()):
+                if name not in declared:
+                    lines.append(f'# TYPE {name} summary')
+                    declared.add(name)
+                label_string = ",".join(f'{label}="{label_value}"' for label, label_value in labels)
+                label_string = f'{{{label_string}}}' if label_string else ""
+                lines.append(f'{name}_sum{label_string} {total}')
+                lines.append(f'{name}_count{label_string} {count}')
+        return "\n".join(lines) + "\n"
+
+    def _path(self):
+        metrics_dir = os.environ.get("METRICS_DIR")
+        if not metrics_dir:
+            return None
+        return os.path.join(metrics_dir, f'processor-{os.getpid()}.prom')
+
+    def flush(self, force=False):
+        path = self._path()
+        if path is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+
+        # the collector must never read a half written file
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(tmp_path, path)
+
+    def remove(self):
+        path = self._path()
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+metrics = Metrics()
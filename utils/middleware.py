@@ -0,0 +1,105 @@
+import time
+import logging
+import contextlib
+import sentry_sdk
+from collections import Counter
+from django.conf import settings
+from django.db import connections
+from django.urls import resolve, Resolver404
+from django.core.exceptions import MiddlewareNotUsed
+
+from utils.profiling import Capture
+from utils.tracing import tail_sample
+
+
+class ProfilingMiddleware:
+    '''
+        - profiles one request in every PROFILE_SAMPLE_EVERY for the url names in PROFILE_VIEWS
+    '''
+
+    def __init__(self, get_response):
+        if not settings.PROFILE_VIEWS:
+            # removed from the middleware chain, no overhead when profiling is off
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+        self.requests = Counter()
+
+    def __call__(self, request):
+        try:
+            url_name = resolve(request.path_info).url_name
+        except Resolver404:
+            url_name = None
+
+        if url_name not in settings.PROFILE_VIEWS:
+            return self.get_response(request)
+
+        self.requests[url_name] += 1
+        if self.requests[url_name] % settings.PROFILE_SAMPLE_EVERY:
+            return self.get_response(request)
+
+        capture = Capture()
+        with capture:
+            response = self.get_response(request)
+        capture.dump(f'view-{url_name}')
+        return response
+
+
+class TailSamplingMiddleware:
+    '''
+        - keeps the sentry trace of slow and failed requests, samples the rest
+    '''
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+
+        transaction = sentry_sdk.Hub.current.scope.transaction
+        tail_sample(transaction, time.perf_counter() - started, response.status_code >= 500)
+        return response
+
+
+class QueryCountMiddleware:
+    '''
+        - counts the queries each request runs and the time spent in the database
+        - logs them, warns above QUERY_COUNT_WARN_THRESHOLD queries and, with
+          QUERY_COUNT_HEADERS, returns them as X-DB-Query-Count and X-DB-Query-Time
+    '''
+
+    def __init__(self, get_response):
+        if not settings.QUERY_COUNT_ENABLED:
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+        self.logger = logging.getLogger("Query Count")
+
+    def __call__(self, request):
+        queries = {"count": 0, "time": 0.0}
+
+        def count_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries["count"] += 1
+                queries["time"] += time.perf_counter() - started
+
+        with contextlib.ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(count_query))
+            response = self.get_response(request)
+
+        query_time = queries["time"] * 1000
+        message = f'{request.method} {request.path} ran {queries["count"]} queries in {query_time:.2f}ms'
+        if queries["count"] > settings.QUERY_COUNT_WARN_THRESHOLD:
+            self.logger.warning(message)
+        else:
+            self.logger.info(message)
+
+        if settings.QUERY_COUNT_HEADERS:
+            response["X-DB-Query-Count"] = str(queries["count"])
+            response["X-DB-Query-Time"] = f'{query_time:.2f}'
+        return response
@@ -0,0 +1,91 @@
+import threading
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, check_password, make_password
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+
+class ConfigurablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    '''
+        - PBKDF2 with PASSWORD_HASH_ITERATIONS rounds
+        - keeps the "pbkdf2_sha256" algorithm name so existing hashes still verify, a
+          password hashed with other rounds is rehashed on its next successful login
+    '''
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
+
+
+class LoginUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Too many logins in progress, try again shortly"
+    default_code = "login_unavailable"
+
+
+class PasswordHashLimiter:
+    '''
+        - bounds the password hashes running at once per web worker, the hash runs on the
+          request thread, hashlib releases the GIL while hashing so the threads use the cores
+        - logins waiting beyond LOGIN_HASH_QUEUE or longer than LOGIN_HASH_TIMEOUT seconds are
+          answered with 503 instead of piling up on every web worker thread
+    '''
+
+    def __init__(self):
+        self._running = None
+        self._admitted = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # sized on first use, once the settings are loaded
+        with self._lock:
+            if self._running is None:
+                self._admitted = threading.BoundedSemaphore(settings.LOGIN_HASH_WORKERS + settings.LOGIN_HASH_QUEUE)
+                self._running = threading.BoundedSemaphore(settings.LOGIN_HASH_WORKERS)
+
+    def run(self, function, *args):
+        if self._running is None:
+            self._start()
+
+        # a full queue sheds the login at once
+        if not self._admitted.acquire(blocking=False):
+            raise LoginUnavailable()
+        try:
+            if not self._running.acquire(timeout=settings.LOGIN_HASH_TIMEOUT):
+                raise LoginUnavailable()
+            try:
+                return function(*args)
+            finally:
+                self._running.release()
+        finally:
+            self._admitted.release()
+
+
+password_hash_limiter = PasswordHashLimiter()
+
+
+def authenticate(email, password):
+    '''
+        - what the default ModelBackend authenticate() does, with the hashing bounded by the limiter
+        :return: the user, None when the credentials are wrong
+    '''
+    UserModel = get_user_model()
+    try:
+        user = UserModel._default_manager.get_by_natural_key(email)
+    except UserModel.DoesNotExist:
+        # hash anyway so an unknown email takes as long as a wrong password
+        password_hash_limiter.run(make_password, password)
+        return None
+
+    rehash = []
+    if not password_hash_limiter.run(check_password, password, user.password, rehash.append):
+        return None
+    if not getattr(user, "is_active", True):
+        return None
+
+    if rehash:
+        # hashed with other rounds than PASSWORD_HASH_ITERATIONS
+        user.password = password_hash_limiter.run(make_password, password)
+        user.save(update_fields=["password"])
+    return user
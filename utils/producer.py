@@ -1,28 +1,189 @@
+import os
+import time
 import json
+import threading
+import collections
 import pika
+from django.conf import settings
+from sentry_sdk import capture_exception
 
+from utils.backpressure import CircuitBreaker
+from utils.spool import Spool, drain
 
-def transaction_producer(transaction):
+
+# in-memory queue backing the local transport
+local_queue = collections.deque()
+
+# queue every transfer went to before each currency had its own, still drained by the processors
+LEGACY_QUEUE = 'transactions'
+
+CURRENCY_TYPES = ["Bitcoin", "Ethereum"]
+
+
+def currency_queue(currency_type):
     '''
-        - create a producer connection and connects to rabbitmq instance
-        - creates a channel
+        - the transfers of a currency went to this queue before they were split in lanes,
+          it is still drained as part of the interactive lane
+        :return: the queue of the transfers of a currency, e.g. transactions.bitcoin
     '''
-    transaction = json.dumps(transaction)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host='localhost'))
+    return f'transactions.{currency_type.lower()}'
 
-    channel = connection.channel()
 
-    channel.queue_declare(queue='transactions', durable=True)
+# priority lanes, interactive first, see settings.TRANSFER_LANE_WEIGHTS
+INTERACTIVE_LANE = "interactive"
+BULK_LANE = "bulk"
+LANES = [INTERACTIVE_LANE, BULK_LANE]
+
+
+def lane_queue(currency_type, lane):
+    '''
+        :return: the queue of a lane of a currency, e.g. transactions.bitcoin.bulk
+    '''
+    return f'{currency_queue(currency_type)}.{lane}'
+
 
-    # publish a transaction to transactions exchange
+def priority_lane(transaction, lane=None):
+    '''
+        - the lane the caller asked for, e.g. batch payouts ask for the bulk lane
+        - otherwise transfers of at least the bulk amount of their currency go to the bulk lane
+    '''
+    if lane in LANES:
+        return lane
+    if float(transaction["amount"]) >= settings.TRANSFER_BULK_AMOUNTS[transaction["currency_type"]]:
+        return BULK_LANE
+    return INTERACTIVE_LANE
+
+
+def connection_parameters():
+    # fail fast, a request must not hang on a broker that does not answer
+    return pika.ConnectionParameters(
+        host='localhost',
+        connection_attempts=1,
+        socket_timeout=settings.PRODUCER_CONNECT_TIMEOUT,
+        stack_timeout=settings.PRODUCER_CONNECT_TIMEOUT,
+        blocked_connection_timeout=settings.PRODUCER_CONNECT_TIMEOUT,
+    )
+
+
+def publish_transaction(channel, queue, transaction):
+    channel.queue_declare(queue=queue, durable=True)
+
+    # publish a transaction to the queue of its currency and lane
     channel.basic_publish(exchange='',
-                          routing_key='transactions',
+                          routing_key=queue,
                           body=transaction,
                           properties=pika.BasicProperties(
                               delivery_mode=2,
                           ))
 
-    print(f'Transaction - {transaction} sent')
 
-    connection.close()
+def drain_spool(directory, spool=None):
+    '''
+        - publishes the spooled transactions no live process owns, plus the ones of the given spool
+        - every message is confirmed by the broker before the spool moves past it
+        :return: transactions published
+    '''
+    if spool is not None:
+        spool.rotate()
+
+    connection = None
+    channel = None
+
+    def publish(queue, transaction):
+        nonlocal connection, channel
+        if channel is None:
+            connection = pika.BlockingConnection(connection_parameters())
+            channel = connection.channel()
+            channel.confirm_delivery()
+        publish_transaction(channel, queue, transaction)
+
+    try:
+        return drain(directory, publish)
+    finally:
+        if connection is not None and connection.is_open:
+            connection.close()
+
+
+class SpoolingPublisher:
+    '''
+        - publishes through a circuit breaker, while the broker fails or the circuit is open
+          transactions go to the local spool instead of failing the request
+        - a background thread drains the spool once the broker answers again
+    '''
+
+    def __init__(self):
+        self.breaker = None
+        self.spool = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # started on first use, after gunicorn forked the worker
+        with self._lock:
+            if self.spool is None:
+                self.breaker = CircuitBreaker(settings.PRODUCER_FAILURE_THRESHOLD, settings.PRODUCER_RESET_TIMEOUT)
+                self.spool = Spool(settings.PRODUCER_SPOOL_DIR)
+                threading.Thread(target=self._drainer, name="spool-drainer", daemon=True).start()
+
+    def publish(self, queue, transaction):
+        '''
+            :return: whether the transaction reached the broker, False when it was spooled
+        '''
+        if self.spool is None:
+            self._start()
+
+        if self.breaker.allow():
+            try:
+                connection = pika.BlockingConnection(connection_parameters())
+                try:
+                    publish_transaction(connection.channel(), queue, transaction)
+                finally:
+                    if connection.is_open:
+                        connection.close()
+                self.breaker.success()
+                return True
+            except (pika.exceptions.AMQPError, OSError) as e:
+                self.breaker.failure()
+                capture_exception(e)
+
+        self.spool.append({"queue": queue, "body": transaction})
+        return False
+
+    def _drainer(self):
+        while True:
+            time.sleep(settings.PRODUCER_SPOOL_DRAIN_INTERVAL)
+            if not os.path.isdir(self.spool.directory) or not os.listdir(self.spool.directory):
+                continue
+            if not self.breaker.allow():
+                continue
+            try:
+                drain_spool(self.spool.directory, self.spool)
+                self.breaker.success()
+            except (pika.exceptions.AMQPError, OSError) as e:
+                self.breaker.failure()
+                capture_exception(e)
+            except Exception as e:
+                # the drainer must outlive any bad record, it is retried on the next pass
+                capture_exception(e)
+
+
+publisher = SpoolingPublisher()
+
+
+def transaction_producer(transaction, lane=None):
+    '''
+        - publishes the transaction to the queue of its currency and lane
+        - spools it on local disk when the broker is down, see SpoolingPublisher
+        :param lane: priority lane of the transfer, picked from its amount when None
+    '''
+    queue = lane_queue(transaction["currency_type"], priority_lane(transaction, lane))
+    transaction = json.dumps(transaction)
+
+    # the local transport keeps transactions in process, no broker needed
+    if settings.TRANSACTION_TRANSPORT == "local":
+        local_queue.append(transaction)
+        return
+
+    if publisher.publish(queue, transaction):
+        print(f'Transaction - {transaction} sent')
+    else:
+        print(f'Transaction - {transaction} spooled')
@@ -0,0 +1,119 @@
+import os
+import time
+import signal
+import cProfile
+import threading
+import contextlib
+from collections import Counter
+from django.conf import settings
+
+
+class StackSampler:
+    '''
+        - samples the main thread stack on the process cpu timer
+        - much cheaper than cProfile, results are written as collapsed stacks
+          ready for flamegraph.pl or speedscope
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._previous_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def enable(self):
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler)
+
+    def dump(self, path):
+        with open(path, 'w') as stacks_file:
+            for stack, count in self.samples.most_common():
+                stacks_file.write(f'{stack} {count}\n')
+
+
+class Capture:
+    '''
+        - a cProfile or sampling capture that can be resumed around several calls
+          and written once at the end
+    '''
+
+    def __init__(self, mode=None):
+        mode = mode or settings.PROFILE_MODE
+        # signals are only delivered to the main thread
+        if mode == "sample" and threading.current_thread() is not threading.main_thread():
+            mode = "cprofile"
+
+        self.mode = mode
+        self.profiler = StackSampler() if mode == "sample" else cProfile.Profile()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+
+    def dump(self, name):
+        '''
+            :param name: prefix of the file written to PROFILE_DIR
+            :return: the path of the written file
+        '''
+        os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+        extension = "collapsed" if self.mode == "sample" else "pstats"
+        now = time.time()
+        timestamp = f'{time.strftime("%Y%m%d-%H%M%S", time.localtime(now))}.{int(now * 1000) % 1000:03d}'
+        path = os.path.join(settings.PROFILE_DIR, f'{name}-{timestamp}-{os.getpid()}.{extension}')
+
+        if self.mode == "sample":
+            self.profiler.dump(path)
+        else:
+            self.profiler.dump_stats(path)
+        return path
+
+
+class MessageProfiler:
+    '''
+        - profiles the next N processed messages into a single capture
+        - armed at startup with PROCESSOR_PROFILE_MESSAGES or at any time with SIGUSR1
+    '''
+
+    def __init__(self, messages, armed=False):
+        self.messages = messages
+        self.remaining = messages if armed else 0
+        self.capture = None
+
+    def arm(self, signum=None, frame=None):
+        self.remaining = self.messages
+
+    def install(self):
+        signal.signal(signal.SIGUSR1, self.arm)
+
+    @contextlib.contextmanager
+    def profile(self):
+        if not self.remaining:
+            yield
+            return
+
+        if self.capture is None:
+            self.capture = Capture()
+
+        try:
+            with self.capture:
+                yield
+        finally:
+            self.remaining -= 1
+            if not self.remaining:
+                path = self.capture.dump("processor")
+                self.capture = None
+                print(f' [*] Profile of the last {self.messages} messages written to {path}')
@@ -0,0 +1,149 @@
+import os
+import time
+import glob
+import json
+import fcntl
+import socket
+import threading
+
+
+class Spool:
+    '''
+        - append-only file of the messages that could not be published, one json record per line
+        - the file of a process is named after its host and pid and exclusively locked while
+          the process owns it, a file nobody holds a lock on is left over by a dead process
+        - group commit: a writer returns once an fsync covered its record, writers arriving
+          while an fsync runs share the next one instead of each paying for their own
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, f'{socket.gethostname()}-{os.getpid()}.spool')
+        self._file = None
+        # records written and records known to be on disk, across every file of this process
+        self._written = 0
+        self._synced = 0
+        self._lock = threading.Lock()
+        # taken before _lock whenever both are needed
+        self._sync_lock = threading.Lock()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            spool_file = open(self.path, "ab", buffering=0)
+            fcntl.flock(spool_file, fcntl.LOCK_EX)
+            # a drainer may have taken over a file of a dead process with the same pid meanwhile
+            try:
+                if os.path.samestat(os.fstat(spool_file.fileno()), os.stat(self.path)):
+                    self._file = spool_file
+                    return
+            except FileNotFoundError:
+                pass
+            spool_file.close()
+
+    def append(self, record):
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(line)
+            self._written += 1
+            sequence = self._written
+        self._sync(sequence)
+
+    def _sync(self, sequence):
+        with self._sync_lock:
+            if self._synced >= sequence:
+                # an fsync started after this record was written already covered it
+                return
+            with self._lock:
+                written = self._written
+                file = self._file
+            os.fsync(file.fileno())
+            self._synced = written
+
+    def rotate(self):
+        '''
+            - hands the current file over to the drainers as <name>.<time>.draining, the next append starts a new one
+            :return: whether there was a file to hand over
+        '''
+        with self._sync_lock, self._lock:
+            if self._file is None:
+                return False
+            os.fsync(self._file.fileno())
+            self._synced = self._written
+            os.replace(self.path, _draining_path(self.path))
+            # closing releases the lock, the renamed file is free for any drainer
+            self._file.close()
+            self._file = None
+            return True
+
+
+def _draining_path(path):
+    # unique per hand over, a process may hand over several files before they are drained
+    return f'{path[:-len(".spool")]}.{time.time_ns()}.draining'
+
+
+def _drain_file(path, publish):
+    '''
+        - publishes the records of a spool file from the offset reached by the last drain of it
+        - the offset is saved after every record, a crash repeats at most the record being published
+        :return: records published
+    '''
+    offset_path = f'{path}.offset'
+    offset = 0
+    if os.path.exists(offset_path):
+        with open(offset_path) as offset_file:
+            offset = int(offset_file.read() or 0)
+
+    published = 0
+    with open(path, "rb") as spool_file:
+        spool_file.seek(offset)
+        for line in spool_file:
+            offset += len(line)
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the end of a record torn by a crash while it was written, never acknowledged
+                continue
+            publish(record["queue"], record["body"])
+            published += 1
+            with open(offset_path, "w") as offset_file:
+                offset_file.write(str(offset))
+
+    os.remove(path)
+    if os.path.exists(offset_path):
+        os.remove(offset_path)
+    return published
+
+
+def drain(directory, publish):
+    '''
+        - publishes the records of every spool file in the directory no live process owns
+        - stops at the first record publish raises on, the rest is drained next time
+        :param publish: called with the queue and the body of each record
+        :return: records published
+    '''
+    published = 0
+    paths = glob.glob(os.path.join(directory, "*.spool")) + glob.glob(os.path.join(directory, "*.draining"))
+    for path in sorted(paths):
+        try:
+            lock_file = open(path, "rb")
+        except FileNotFoundError:
+            # drained by another process meanwhile
+            continue
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # owned by a live process or drained by another drainer right now
+                continue
+            if not os.path.exists(path):
+                continue
+            if path.endswith(".spool"):
+                # left over by a dead process, the lock moves with the file
+                draining_path = _draining_path(path)
+                os.replace(path, draining_path)
+                path = draining_path
+            published += _drain_file(path, publish)
+    return published
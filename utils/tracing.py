@@ -0,0 +1,40 @@
+import time
+import random
+import contextlib
+import sentry_sdk
+from django.conf import settings
+
+
+def keep_trace(duration, failed):
+    '''
+        - tail sampling decision, taken once the outcome of the work is known
+        - slow and failed traces are always kept, the rest at TRACES_BASELINE_RATE
+    '''
+    if failed or duration >= settings.TRACES_SLOW_THRESHOLD:
+        return True
+    return random.random() < settings.TRACES_BASELINE_RATE
+
+
+def tail_sample(transaction, duration, failed):
+    if transaction is None or not transaction.sampled:
+        return
+
+    failed = failed or transaction.status not in (None, "ok")
+    if not keep_trace(duration, failed):
+        # an unsampled transaction is dropped by sentry when it finishes
+        transaction.sampled = False
+
+
+@contextlib.contextmanager
+def sampled_transaction(op, name):
+    '''
+        - traces a unit of work outside a request, such as a queue message
+    '''
+    started = time.perf_counter()
+    with sentry_sdk.start_transaction(op=op, name=name) as transaction:
+        failed = True
+        try:
+            yield transaction
+            failed = False
+        finally:
+            tail_sample(transaction, time.perf_counter() - started, failed)